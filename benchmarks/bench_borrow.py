@@ -0,0 +1,41 @@
+""" Benchmark short single-socket waits with a fresh DefaultSelector
+for every wait against borrowing the per-thread cached selector. """
+
+import sys
+
+import selectors2
+from .support import socketpair, measure_rate, print_results
+
+
+def wait_fresh(sock):
+    selector = selectors2.DefaultSelector()
+    try:
+        selector.register(sock, selectors2.EVENT_WRITE)
+        return selector.select(0)
+    finally:
+        selector.close()
+
+
+def wait_borrowed(sock):
+    with selectors2.borrow_selector() as selector:
+        selector.register(sock, selectors2.EVENT_WRITE)
+        return selector.select(0)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 1000000
+    rd, wr = socketpair()
+    try:
+        results = [
+            ('DefaultSelector()', measure_rate(lambda: wait_fresh(wr), iterations, repeat=1)),
+            ('borrow_selector()', measure_rate(lambda: wait_borrowed(wr), iterations, repeat=1))
+        ]
+    finally:
+        rd.close()
+        wr.close()
+    print_results("Short waits ({0:,} iterations)".format(iterations), results, unit="waits/sec")
+
+
+if __name__ == "__main__":
+    main()
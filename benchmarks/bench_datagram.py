@@ -0,0 +1,116 @@
+""" Benchmark receiving UDP datagrams over loopback from sender processes
+which send as fast as they can. Compares reading one datagram with
+recvfrom() per readable socket per select() against draining every queued
+datagram with DatagramReader::
+
+    $ python -m benchmarks.bench_datagram --senders 2 --size 512
+"""
+
+import argparse
+import multiprocessing
+import socket
+import sys
+import time
+
+import selectors2
+from .support import selector_classes, get_time
+
+SOCKETS = 4
+
+
+def sender(addresses, size, stop):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    message = b"x" * size
+    while not stop.is_set():
+        for _ in range(100):
+            for address in addresses:
+                try:
+                    sock.sendto(message, address)
+                except socket.error:
+                    pass
+    sock.close()
+
+
+def receive_one(selector, deadline):
+    received = selects = 0
+    while get_time() < deadline:
+        selects += 1
+        for key, events in selector.select(0.1):
+            try:
+                key.fileobj.recvfrom(65536)
+            except socket.error:
+                continue
+            received += 1
+    return received, selects
+
+
+def receive_drain(selector, deadline):
+    received = selects = 0
+    reader = selectors2.DatagramReader()
+    while get_time() < deadline:
+        selects += 1
+        for key, events, datagrams in reader.drain_ready(selector.select(0.1)):
+            received += len(datagrams)
+    return received, selects
+
+
+def run(selector_class, receive, senders, size, duration):
+    """ Returns (datagrams/sec, datagrams per select()) """
+    socks = []
+    for _ in range(SOCKETS):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        socks.append(sock)
+    addresses = [sock.getsockname() for sock in socks]
+    stop = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=sender, args=(addresses, size, stop))
+                 for _ in range(senders)]
+    for process in processes:
+        process.start()
+
+    selector = selector_class()
+    try:
+        for sock in socks:
+            selector.register(sock, selectors2.EVENT_READ)
+        # Let the senders start up and fill the socket buffers.
+        time.sleep(0.2)
+        start = get_time()
+        received, selects = receive(selector, start + duration)
+        elapsed = get_time() - start
+    finally:
+        stop.set()
+        for process in processes:
+            process.join()
+        selector.close()
+        for sock in socks:
+            sock.close()
+    return received / elapsed, received / float(max(selects, 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_datagram",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--senders", type=int, default=2, help="number of sender processes")
+    parser.add_argument("--size", type=int, default=512, help="datagram size in bytes")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per run")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    sys.stdout.write("{0} sockets, {1} senders, {2} byte datagrams\n".format(
+        SOCKETS, args.senders, args.size))
+    line = "  {0:<28} {1:>16} {2:>18}\n"
+    sys.stdout.write(line.format("", "datagrams/sec", "datagrams/select"))
+    for name, selector_class in selector_classes():
+        if args.backend and name not in args.backend:
+            continue
+        for label, receive in (("recvfrom", receive_one), ("DatagramReader", receive_drain)):
+            rate, batch = run(selector_class, receive, args.senders, args.size, args.duration)
+            sys.stdout.write(line.format("{0} {1}".format(name[:-len("Selector")], label),
+                                         "{0:,.0f}".format(rate), "{0:.1f}".format(batch)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
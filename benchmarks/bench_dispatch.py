@@ -0,0 +1,60 @@
+""" Benchmark the rate at which Dispatcher runs callbacks compared
+to a hand-written select() loop. Every socket is always writable
+so each select() call returns a full batch of ready keys. """
+
+import sys
+
+import selectors2
+from .support import socketpair, get_time, print_results
+
+
+def callback(key, events):
+    pass
+
+
+def hand_written(selector, rounds):
+    dispatched = 0
+    for _ in range(rounds):
+        for key, events in selector.select(0):
+            key.data(key, events)
+            dispatched += 1
+    return dispatched
+
+
+def dispatcher(selector, rounds):
+    run_once = selectors2.Dispatcher(selector).run_once
+    dispatched = 0
+    for _ in range(rounds):
+        dispatched += run_once(0)
+    return dispatched
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    sockets = int(argv[0]) if argv else 100
+    rounds = int(argv[1]) if len(argv) > 1 else 2000
+
+    selector = selectors2.DefaultSelector()
+    pairs = [socketpair() for _ in range(sockets)]
+    try:
+        for _, wr in pairs:
+            selector.register(wr, selectors2.EVENT_WRITE, callback)
+        best = {}
+        for _ in range(3):
+            for name, func in [('hand-written loop', hand_written), ('Dispatcher', dispatcher)]:
+                start = get_time()
+                dispatched = func(selector, rounds)
+                rate = dispatched / (get_time() - start)
+                best[name] = max(rate, best.get(name, 0))
+        results = [(name, best[name]) for name in ('hand-written loop', 'Dispatcher')]
+    finally:
+        selector.close()
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+    print_results("Callback dispatch with {0} ready sockets".format(sockets), results,
+                  unit="callbacks/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+""" End-to-end load test of an echo server, and optionally a TCP proxy in
+front of it, built on each selectors2 selector. Everything runs over
+loopback: the server, the proxy and several client processes which each
+drive many connections. Every connection sends a message, waits for the
+whole message to be echoed back and records the latency before sending
+the next one. The server and proxy toggle EVENT_WRITE when a send() is
+partial and stop reading when the other side can't keep up::
+
+    $ python -m benchmarks.bench_echo --connections 100 --size 4096 --proxy
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import selectors2
+from .support import get_time, selector_classes
+
+try:  # Windows doesn't have the resource module.
+    import resource
+except ImportError:
+    resource = None
+
+HIGH_WATER = 256 * 1024
+RECV_SIZE = 65536
+
+
+def cpu_time():
+    if resource is None:
+        return sum(os.times()[:2])
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Stream(object):
+    """ One side of a connection. Data read from a stream is written to its
+    peer which is the stream itself for the echo server and the other side
+    of the connection for the proxy. """
+
+    def __init__(self, selector, sock):
+        self.selector = selector
+        self.sock = sock
+        self.peer = self
+        self.buffer = bytearray()
+        self.events = 0
+        self.eof = False
+        sock.setblocking(False)
+
+    def update(self):
+        """ Reads while the peer's buffer has room and writes while this
+        stream's buffer has data. Only calls modify() on changes. """
+        events = 0
+        if not self.eof and len(self.peer.buffer) < HIGH_WATER:
+            events |= selectors2.EVENT_READ
+        if self.buffer:
+            events |= selectors2.EVENT_WRITE
+        if events == self.events:
+            return
+        if not self.events:
+            self.selector.register(self.sock, events, self.handle)
+        elif not events:
+            self.selector.unregister(self.sock)
+        else:
+            self.selector.modify(self.sock, events, self.handle)
+        self.events = events
+
+    def handle(self, key, events):
+        if events & selectors2.EVENT_READ:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error:
+                data = b''
+            if data:
+                self.peer.buffer += data
+                self.peer.flush()
+            else:
+                self.eof = True
+        if events & selectors2.EVENT_WRITE:
+            self.flush()
+        if self.eof and not self.peer.buffer:
+            self.close()
+        else:
+            self.update()
+            if self.peer is not self:
+                self.peer.update()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            sent = self.sock.send(self.buffer)
+        except socket.error:
+            # The other side went away so the data can be dropped.
+            sent = len(self.buffer)
+        del self.buffer[:sent]
+
+    def close(self):
+        for stream in (self, self.peer):
+            if stream.events:
+                stream.selector.unregister(stream.sock)
+                stream.events = 0
+            stream.sock.close()
+
+
+def listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(selector_name, control, upstream=None):
+    """ Runs an echo server, or a proxy to upstream if given, until told
+    to stop over control. Reports the CPU time used while measuring. """
+    selector = getattr(selectors2, selector_name)()
+    listener = listen()
+
+    def accept(key, events):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            stream = Stream(selector, sock)
+            if upstream is not None:
+                other = socket.create_connection(upstream)
+                other.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                stream.peer = Stream(selector, other)
+                stream.peer.peer = stream
+                stream.peer.update()
+            stream.update()
+
+    started = [None]
+
+    def command(key, events):
+        message = control.recv()
+        if message == "start":
+            started[0] = cpu_time()
+        else:
+            control.send(cpu_time() - started[0])
+            dispatcher.stop()
+
+    selector.register(listener, selectors2.EVENT_READ, accept)
+    selector.register(control, selectors2.EVENT_READ, command)
+    control.send(listener.getsockname())
+    dispatcher = selectors2.Dispatcher(selector)
+    dispatcher.run_forever()
+    listener.close()
+    selector.close()
+
+
+def client(address, connections, size, duration, ready, start, results):
+    """ Drives connections until duration has passed and puts the
+    (requests, latencies) tuple in results. """
+    message = b"x" * size
+    selector = selectors2.DefaultSelector()
+    socks = []
+    for _ in range(connections):
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        socks.append(sock)
+    ready.put(True)
+    start.wait()
+
+    # Per connection: [bytes left to send, bytes left to receive, send time]
+    state = {}
+    for sock in socks:
+        state[sock] = [size, size, get_time()]
+        selector.register(sock, selectors2.EVENT_READ | selectors2.EVENT_WRITE)
+
+    latencies = []
+    deadline = get_time() + duration
+    while get_time() < deadline:
+        for key, events in selector.select(0.1):
+            sock = key.fileobj
+            conn = state[sock]
+            if events & selectors2.EVENT_WRITE and conn[0]:
+                conn[0] -= sock.send(message[size - conn[0]:])
+                if not conn[0]:
+                    selector.modify(sock, selectors2.EVENT_READ)
+            if events & selectors2.EVENT_READ:
+                conn[1] -= len(sock.recv(RECV_SIZE))
+                if conn[1] <= 0:
+                    now = get_time()
+                    latencies.append(now - conn[2])
+                    conn[:] = [size, size, now]
+                    selector.modify(sock, selectors2.EVENT_READ | selectors2.EVENT_WRITE)
+    selector.close()
+    for sock in socks:
+        sock.close()
+    results.put(latencies)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(selector_name, connections, size, duration, processes, proxy):
+    """ Returns (requests/sec, p50, p99, p999, CPU seconds per request) for
+    one selector. Latencies are in seconds. """
+    servers = []
+
+    def start_server(upstream=None):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve, args=(selector_name, child, upstream))
+        process.start()
+        servers.append((process, parent))
+        return parent.recv()
+
+    address = start_server()
+    if proxy:
+        address = start_server(address)
+
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    clients = []
+    for i in range(processes):
+        count = connections // processes + (1 if i < connections % processes else 0)
+        if count:
+            clients.append(multiprocessing.Process(target=client, args=(
+                address, count, size, duration, ready, start, results)))
+    for process in clients:
+        process.start()
+    for _ in clients:
+        ready.get()
+
+    for _, control in servers:
+        control.send("start")
+    started = get_time()
+    start.set()
+    latencies = []
+    for _ in clients:
+        latencies.extend(results.get())
+    elapsed = get_time() - started
+    for process in clients:
+        process.join()
+
+    cpu = 0.0
+    for process, control in servers:
+        control.send("stop")
+        cpu += control.recv()
+        process.join()
+
+    latencies.sort()
+    requests = len(latencies)
+    return (requests / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99),
+            percentile(latencies, 0.999), cpu / max(requests, 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_echo",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--size", type=int, default=1024, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per selector")
+    parser.add_argument("--processes", type=int, default=min(4, multiprocessing.cpu_count()),
+                        help="number of client processes")
+    parser.add_argument("--proxy", action="store_true",
+                        help="put a proxy between the clients and the echo server")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    sys.stdout.write("{0} connections, {1} byte messages{2}\n".format(
+        args.connections, args.size, ", through a proxy" if args.proxy else ""))
+    line = "  {0:<18} {1:>12} {2:>10} {3:>10} {4:>10} {5:>14}\n"
+    sys.stdout.write(line.format("", "requests/sec", "p50", "p99", "p999", "CPU/request"))
+    for name, _ in selector_classes():
+        if args.backend and name not in args.backend:
+            continue
+        rate, p50, p99, p999, cpu = run(name, args.connections, args.size, args.duration,
+                                        args.processes, args.proxy)
+        sys.stdout.write(line.format(
+            name, "{0:,.0f}".format(rate), "{0:.3f}ms".format(p50 * 1000),
+            "{0:.3f}ms".format(p99 * 1000), "{0:.3f}ms".format(p999 * 1000),
+            "{0:.1f}us".format(cpu * 1e6)))
+        sys.stdout.flush()
+        time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+""" Benchmark how many worker wake-ups each accepted connection costs when
+every worker process has its own EpollSelector watching one shared listening
+socket, with and without EpollSelector.register(..., exclusive=True).
+Without EPOLLEXCLUSIVE the kernel wakes every idle worker for every
+connection. epoll re-checks readiness before returning so most of those
+wake-ups don't return from select() and are counted as the voluntary
+context switches of the workers instead. """
+
+import errno
+import multiprocessing
+import socket
+import sys
+import time
+
+import selectors2
+
+try:  # Windows doesn't have the resource module.
+    import resource
+except ImportError:
+    resource = None
+
+WORKERS = (1, 2, 4, 8, 16)
+
+
+def worker(listener, exclusive, stop, results):
+    selector = selectors2.EpollSelector()
+    selector.register(listener, selectors2.EVENT_READ, exclusive=exclusive)
+    selector.register(stop, selectors2.EVENT_READ)
+    wakeups = accepted = 0
+    switches = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw
+    try:
+        while True:
+            ready = [key.fileobj for key, _ in selector.select()]
+            if stop in ready:
+                break
+            wakeups += 1
+            try:
+                conn, _ = listener.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                continue
+            accepted += 1
+            conn.close()
+    finally:
+        selector.close()
+    switches = resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw - switches
+    results.put((wakeups, accepted, switches))
+
+
+def run(workers, exclusive, connections):
+    """ Returns (select() returns, accepted connections, context switches)
+    summed over all workers. """
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        # Workers inherit the listening socket so they must be forked.
+        context = multiprocessing.get_context("fork")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+    listener.setblocking(False)
+    stop_rd, stop_wr = socket.socketpair()
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(listener, exclusive, stop_rd, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    time.sleep(0.2)
+
+    address = listener.getsockname()
+    for _ in range(connections):
+        sock = socket.create_connection(address)
+        # Give idle workers time to wake up like spread out connections would.
+        time.sleep(0.0005)
+        sock.close()
+    time.sleep(0.2)
+
+    stop_wr.send(b"x")
+    totals = [0, 0, 0]
+    for _ in processes:
+        for i, value in enumerate(results.get()):
+            totals[i] += value
+    for process in processes:
+        process.join()
+    for sock in (listener, stop_rd, stop_wr):
+        sock.close()
+    return totals
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    connections = int(argv[0]) if argv else 500
+    if not hasattr(selectors2, "EpollSelector") or resource is None:
+        sys.stdout.write("EpollSelector isn't available on this platform\n")
+        return
+    sys.stdout.write("Per accepted connection ({0} connections)\n".format(connections))
+    line = "  {0:<24} {1:>16} {2:>18}\n"
+    sys.stdout.write(line.format("", "select() returns", "context switches"))
+    for workers in WORKERS:
+        for exclusive in (False, True):
+            wakeups, accepted, switches = run(workers, exclusive, connections)
+            accepted = float(max(accepted, 1))
+            sys.stdout.write(line.format(
+                "{0} workers{1}".format(workers, ", exclusive" if exclusive else ""),
+                "{0:.2f}".format(wakeups / accepted), "{0:.2f}".format(switches / accepted)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+""" Benchmark a Dispatcher running a mix of fast and slow callbacks
+inline against one that runs them in a thread pool.
+
+Every connection receives one message. Most callbacks only read it
+while every Nth callback also blocks for a while to imitate a handler
+doing blocking I/O or CPU work.
+"""
+
+import sys
+import time
+
+import selectors2
+from .support import socketpair, get_time, max_socketpairs, print_results
+
+try:  # Python 2.x doesn't have concurrent.futures.
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+SLOW_EVERY = 10
+SLOW_SECONDS = 0.001
+
+
+def run(connections, executor):
+    selector = selectors2.DefaultSelector()
+    dispatcher = selectors2.Dispatcher(selector, executor=executor)
+    pairs = [socketpair() for _ in range(connections)]
+    handled = []
+
+    def callback(key, events):
+        key.fileobj.recv(1)
+        if key.fd % SLOW_EVERY == 0:
+            time.sleep(SLOW_SECONDS)
+        handled.append(key.fd)
+        if len(handled) == connections:
+            dispatcher.stop()
+
+    try:
+        for rd, wr in pairs:
+            rd.setblocking(False)
+            selector.register(rd, selectors2.EVENT_READ, callback)
+            wr.send(b'x')
+
+        start = get_time()
+        while len(handled) < connections:
+            dispatcher.run_once(timeout=1.0)
+        return connections / (get_time() - start)
+    finally:
+        dispatcher.close()
+        selector.close()
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    connections = max_socketpairs(int(argv[0]) if argv else 10000)
+    workers = int(argv[1]) if len(argv) > 1 else 64
+
+    results = [('inline', run(connections, None))]
+    if futures is not None:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            results.append(('ThreadPoolExecutor({0})'.format(workers), run(connections, executor)))
+        finally:
+            executor.shutdown()
+    print_results("Mixed callbacks for {0} connections, 1 in {1} sleeps {2}ms".format(
+        connections, SLOW_EVERY, SLOW_SECONDS * 1000), results, unit="callbacks/sec")
+
+
+if __name__ == "__main__":
+    main()
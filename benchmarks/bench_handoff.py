@@ -0,0 +1,156 @@
+""" Benchmark the latency from connecting to receiving the first byte back
+when an acceptor process hands accepted connections off to worker
+processes with HandoffBalancer, against the acceptor serving them itself.
+A client connects, sends one byte and waits for the reply over loopback.
+Every other connection is kept open so that the workers' loads differ::
+
+    $ python -m benchmarks.bench_handoff --workers 4 --connections 2000
+"""
+
+import argparse
+import multiprocessing
+import socket
+import sys
+
+import selectors2
+from .support import get_time, max_socketpairs
+
+
+def serve(selector, on_close=None):
+    def on_readable(key, events):
+        try:
+            data = key.fileobj.recv(1)
+        except socket.error:
+            data = b''
+        if data:
+            key.fileobj.send(b'y')
+            return
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+        if on_close is not None:
+            on_close()
+    return on_readable
+
+
+def worker(channel, others, stop, results):
+    for other in others:
+        other.close()
+    selector = selectors2.DefaultSelector()
+    handoff = [None]
+    on_readable = serve(selector, lambda: handoff[0].report())
+    handoff[0] = selectors2.HandoffWorker(selector, channel, selectors2.EVENT_READ, on_readable)
+    dispatcher = selectors2.Dispatcher(selector)
+    while not stop.is_set():
+        dispatcher.run_once(0.05)
+    results.put(handoff[0].received)
+
+
+def acceptor(listener, channels, stop):
+    selector = selectors2.DefaultSelector()
+    balancer = None
+    if channels:
+        balancer = selectors2.HandoffBalancer(selector)
+        for channel in channels:
+            balancer.add_worker(channel)
+    on_readable = serve(selector)
+
+    def on_accept(key, events):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.error:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if balancer is not None:
+                balancer.send(conn)
+            else:
+                conn.setblocking(False)
+                selector.register(conn, selectors2.EVENT_READ, on_readable)
+
+    listener.setblocking(False)
+    selector.register(listener, selectors2.EVENT_READ, on_accept)
+    dispatcher = selectors2.Dispatcher(selector)
+    while not stop.is_set():
+        dispatcher.run_once(0.05)
+
+
+def run(workers, connections):
+    """ Returns (sorted latencies, connections received per worker) """
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        # The children inherit their sockets so they must be forked.
+        context = multiprocessing.get_context("fork")
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+    channels = [selectors2.handoff_channel() for _ in range(workers)]
+    stop = context.Event()
+    results = context.Queue()
+
+    processes = []
+    for balancer_end, worker_end in channels:
+        others = [listener] + [end for pair in channels for end in pair if end is not worker_end]
+        processes.append(context.Process(target=worker, args=(worker_end, others, stop, results)))
+    processes.append(context.Process(target=acceptor, args=(
+        listener, [balancer_end for balancer_end, _ in channels], stop)))
+    for process in processes:
+        process.start()
+    for pair in channels:
+        for end in pair:
+            end.close()
+
+    address = listener.getsockname()
+    listener.close()
+    latencies = []
+    held = []
+    for i in range(connections):
+        start = get_time()
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.send(b'x')
+        sock.recv(1)
+        latencies.append(get_time() - start)
+        if i % 2:
+            sock.close()
+        else:
+            held.append(sock)
+    for sock in held:
+        sock.close()
+
+    stop.set()
+    received = [results.get() for _ in range(workers)]
+    for process in processes:
+        process.join()
+    latencies.sort()
+    return latencies, received
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_handoff",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=2000)
+    args = parser.parse_args(argv)
+    # Half of the connections are held open by both the client and a server.
+    args.connections = 2 * max_socketpairs(args.connections // 2)
+
+    sys.stdout.write("Accept to first byte over {0} connections\n".format(args.connections))
+    line = "  {0:<24} {1:>10} {2:>10} {3:>10}  {4}\n"
+    sys.stdout.write(line.format("", "p50", "p99", "p999", "per worker"))
+    for label, workers in (("acceptor only", 0), ("{0} workers".format(args.workers),
+                                                  args.workers)):
+        latencies, received = run(workers, args.connections)
+        sys.stdout.write(line.format(
+            label, "{0:.1f}us".format(percentile(latencies, 0.5) * 1e6),
+            "{0:.1f}us".format(percentile(latencies, 0.99) * 1e6),
+            "{0:.1f}us".format(percentile(latencies, 0.999) * 1e6),
+            " ".join(str(count) for count in received)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
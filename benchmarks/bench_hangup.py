@@ -0,0 +1,61 @@
+""" Benchmark reaping connections whose peer has closed. Registering for
+EVENT_READ alone needs a recv() returning b'' to notice the hang-up while
+registering for EVENT_RDHUP and EVENT_HUP reports it directly so the
+connection can be closed without that system call. """
+
+import sys
+
+import selectors2
+from .support import socketpair, selector_classes, max_socketpairs, get_time, print_results
+
+HANGUP = selectors2.EVENT_RDHUP | selectors2.EVENT_HUP
+
+
+def reap(selector_class, connections, events):
+    """ Returns (seconds, recv() calls) spent reaping every connection. """
+    selector = selector_class()
+    pairs = [socketpair() for _ in range(connections)]
+    try:
+        for sock, peer in pairs:
+            selector.register(sock, events)
+            peer.close()
+
+        calls = 0
+        start = get_time()
+        while selector.get_map():
+            for key, ready in selector.select(0):
+                if not ready & HANGUP:
+                    calls += 1
+                    if key.fileobj.recv(4096):
+                        continue
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+        return get_time() - start, calls
+    finally:
+        selector.close()
+        for sock, _ in pairs:
+            sock.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    connections = max_socketpairs(int(argv[0]) if argv else 1000)
+    results = []
+    for name, selector_class in selector_classes():
+        if name == "SelectSelector":
+            # select() can't report hang-ups and is limited to FD_SETSIZE.
+            continue
+        for label, events in (("READ", selectors2.EVENT_READ),
+                              ("RDHUP", selectors2.EVENT_READ | HANGUP)):
+            best = None
+            for _ in range(3):
+                elapsed, calls = reap(selector_class, connections, events)
+                best = elapsed if best is None else min(best, elapsed)
+            results.append(("{0} {1} {2:.0f} recv/close".format(
+                name[:-len("Selector")], label, calls / float(connections)), connections / best))
+    print_results("Reaping {0} closed connections".format(connections), results,
+                  unit="connections/sec")
+
+
+if __name__ == "__main__":
+    main()
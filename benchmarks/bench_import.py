@@ -0,0 +1,54 @@
+""" Benchmark the cost of importing selectors2 and of the first
+call to DefaultSelector() in a fresh interpreter.
+
+Each sample is taken in a new subprocess so that nothing is
+cached in sys.modules or in selectors2._DEFAULT_SELECTOR.
+"""
+
+import os
+import subprocess
+import sys
+
+_SNIPPET = """
+try:
+    from time import perf_counter as get_time
+except ImportError:
+    from time import time as get_time
+start = get_time()
+import selectors2
+imported = get_time()
+selector = selectors2.DefaultSelector()
+created = get_time()
+selector.close()
+print('%f %f %s' % (imported - start, created - imported, type(selector).__name__))
+"""
+
+
+def sample(env=None):
+    output = subprocess.check_output([sys.executable, '-c', _SNIPPET], env=env)
+    import_time, first_selector_time, name = output.decode('ascii').split()
+    return float(import_time), float(first_selector_time), name
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    samples = int(argv[0]) if argv else 20
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root
+
+    for label, pinned in [('detected', None), ('pinned', 'select')]:
+        run_env = dict(env)
+        run_env.pop('SELECTORS2_DEFAULT_SELECTOR', None)
+        if pinned is not None:
+            run_env['SELECTORS2_DEFAULT_SELECTOR'] = pinned
+        results = [sample(run_env) for _ in range(samples)]
+        sys.stdout.write("{0} ({1}, best of {2})\n".format(label, results[0][2], samples))
+        sys.stdout.write("  {0:<24} {1:>10.1f} us\n".format(
+            'import selectors2', min(r[0] for r in results) * 1e6))
+        sys.stdout.write("  {0:<24} {1:>10.1f} us\n".format(
+            'first DefaultSelector()', min(r[1] for r in results) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+""" Benchmark reading from the sockets returned by select() with recv(),
+which allocates a bytes object for every read, against BufferPool which
+receives into preallocated bytearrays with recv_into(). Every round sends
+one message to each socket pair and reads everything select() reports::
+
+    $ python -m benchmarks.bench_recv --pairs 100 --size 1024
+
+Each read function is timed without tracing and then run again under
+tracemalloc to report the peak memory allocated above what was in use
+before the run, and how many times the garbage collector ran per 1000
+reads, which counts the container objects (tuples, memoryviews...)
+allocated along the way.
+"""
+
+import argparse
+import gc
+import sys
+
+import selectors2
+from .support import socketpair, selector_classes, max_socketpairs, get_time
+
+try:  # Python 2.x doesn't have tracemalloc.
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+RECV_SIZE = 65536
+
+
+def read_recv(selector, rounds, send):
+    """ Returns the number of reads """
+    reads = 0
+    for _ in range(rounds):
+        send()
+        for key, events in selector.select(0):
+            data = key.fileobj.recv(RECV_SIZE)
+            reads += bool(len(data))
+    return reads
+
+
+def read_recv_into(selector, rounds, send):
+    """ A single bytearray reused for every read, the least work possible. """
+    reads = 0
+    buffer = bytearray(RECV_SIZE)
+    for _ in range(rounds):
+        send()
+        for key, events in selector.select(0):
+            reads += bool(key.fileobj.recv_into(buffer))
+    return reads
+
+
+def read_pool(selector, rounds, send):
+    reads = 0
+    pool = selectors2.BufferPool(RECV_SIZE)
+    for _ in range(rounds):
+        send()
+        for key, events, data in pool.recv_ready(selector.select(0)):
+            reads += bool(len(data))
+            pool.release(data)
+    return reads
+
+
+def run(selector_class, read, pairs, size, rounds):
+    """ Returns (reads, seconds) """
+    selector = selector_class()
+    message = b"x" * size
+    writers = [wr for _, wr in pairs]
+
+    def send():
+        for wr in writers:
+            wr.send(message)
+
+    try:
+        for rd, _ in pairs:
+            selector.register(rd, selectors2.EVENT_READ)
+        start = get_time()
+        reads = read(selector, rounds, send)
+        elapsed = get_time() - start
+    finally:
+        selector.close()
+    return reads, elapsed
+
+
+def measure_memory(selector_class, read, pairs, size, rounds):
+    """ Returns (peak bytes allocated above the start, gc runs per 1000 reads)
+    where either is None if tracemalloc or gc.callbacks aren't available. """
+    collections = [0]
+
+    def count(phase, info):
+        if phase == "start":
+            collections[0] += 1
+
+    callbacks = getattr(gc, "callbacks", None)
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    if callbacks is not None:
+        callbacks.append(count)
+    try:
+        start = tracemalloc.get_traced_memory()[0] if tracemalloc else 0
+        reads, _ = run(selector_class, read, pairs, size, rounds)
+        peak = tracemalloc.get_traced_memory()[1] - start if tracemalloc else None
+    finally:
+        if callbacks is not None:
+            callbacks.remove(count)
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    if callbacks is None:
+        return peak, None
+    return peak, collections[0] * 1000.0 / max(reads, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_recv",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pairs", type=int, default=100, help="number of socket pairs")
+    parser.add_argument("--size", type=int, default=1024, help="message size in bytes")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    count = max_socketpairs(args.pairs)
+    pairs = [socketpair() for _ in range(count)]
+    for rd, wr in pairs:
+        rd.setblocking(False)
+    try:
+        sys.stdout.write("{0} socket pairs, {1} byte messages\n".format(count, args.size))
+        line = "  {0:<28} {1:>12} {2:>12} {3:>18}\n"
+        sys.stdout.write(line.format("", "reads/sec", "peak KiB", "gc runs/1000 reads"))
+        readers = (("recv", read_recv), ("recv_into", read_recv_into), ("BufferPool", read_pool))
+        for name, selector_class in selector_classes():
+            if args.backend and name not in args.backend:
+                continue
+            for label, read in readers:
+                rate = max(reads / elapsed for reads, elapsed in (
+                    run(selector_class, read, pairs, args.size, args.rounds)
+                    for _ in range(3)))
+                peak, collections = measure_memory(selector_class, read, pairs,
+                                                   args.size, args.rounds)
+                sys.stdout.write(line.format(
+                    "{0} {1}".format(name[:-len("Selector")], label),
+                    "{0:,.0f}".format(rate),
+                    "n/a" if peak is None else "{0:,.0f}".format(peak / 1024.0),
+                    "n/a" if collections is None else "{0:.2f}".format(collections)))
+                sys.stdout.flush()
+    finally:
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+
+
+if __name__ == "__main__":
+    main()
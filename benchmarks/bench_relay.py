@@ -0,0 +1,131 @@
+""" Benchmark relaying a bulk transfer between two TCP connections over
+loopback with Relay, once moving the data with os.splice() and once
+copying it through Python with recv_into() and send(). A source process
+sends the data to the relay which passes it on to a sink process. Reports
+the throughput and the CPU time used by the relay process::
+
+    $ python -m benchmarks.bench_relay --size 256
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+
+import selectors2
+from .support import selector_classes, get_time
+
+try:  # Windows doesn't have the resource module.
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+
+
+def cpu_time():
+    if resource is None:
+        return sum(os.times()[:2])
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def source(sock, others, size):
+    for other in others:
+        other.close()
+    chunk = b"x" * MB
+    for _ in range(size):
+        sock.sendall(chunk)
+    sock.close()
+
+
+def sink(sock, others, results):
+    for other in others:
+        other.close()
+    received = 0
+    buffer = bytearray(MB)
+    while True:
+        read = sock.recv_into(buffer)
+        if not read:
+            break
+        received += read
+    results.put(received)
+
+
+def run(selector_class, splice, size):
+    """ Returns (MB/sec, relay CPU seconds per GB) """
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        # The children inherit their sockets so they must be forked.
+        context = multiprocessing.get_context("fork")
+    source_sock, relay_a = tcp_pair()
+    relay_b, sink_sock = tcp_pair()
+    sockets = [source_sock, relay_a, relay_b, sink_sock]
+    results = context.Queue()
+    processes = [
+        context.Process(target=source, args=(
+            source_sock, [s for s in sockets if s is not source_sock], size)),
+        context.Process(target=sink, args=(
+            sink_sock, [s for s in sockets if s is not sink_sock], results))]
+    selector = selector_class()
+    start = get_time()
+    started = cpu_time()
+    for process in processes:
+        process.start()
+    source_sock.close()
+    sink_sock.close()
+
+    relay = selectors2.Relay(selector, relay_a, relay_b, buffer_size=MB, splice=splice)
+    selectors2.Dispatcher(selector).run_forever()
+    used = cpu_time() - started
+    received = results.get()
+    elapsed = get_time() - start
+    for process in processes:
+        process.join()
+    relay_a.close()
+    relay_b.close()
+    selector.close()
+    if relay.error is not None:
+        raise relay.error
+    if received != size * MB:
+        raise RuntimeError("Received {0} of {1} bytes".format(received, size * MB))
+    return size / elapsed, used * 1024.0 / size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_relay",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=256, help="MB to relay per run")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    modes = [("copy", False)]
+    if hasattr(os, "splice"):
+        modes.append(("splice", True))
+    sys.stdout.write("Relaying {0} MB\n".format(args.size))
+    line = "  {0:<28} {1:>10} {2:>18}\n"
+    sys.stdout.write(line.format("", "MB/sec", "relay CPU sec/GB"))
+    for name, selector_class in selector_classes():
+        if args.backend and name not in args.backend:
+            continue
+        for label, splice in modes:
+            rate, cpu = max(run(selector_class, splice, args.size) for _ in range(3))
+            sys.stdout.write(line.format("{0} {1}".format(name[:-len("Selector")], label),
+                                         "{0:,.0f}".format(rate), "{0:.2f}".format(cpu)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
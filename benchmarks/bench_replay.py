@@ -0,0 +1,90 @@
+""" Replay a trace recorded with BaseSelector.record_trace() through a
+Dispatcher so that dispatch code can be benchmarked against recorded load
+without any sockets. Without a trace argument a trace is recorded first
+from sockets which become readable in a fixed, pseudo-random order::
+
+    $ python -m benchmarks.bench_replay [TRACE]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import selectors2
+from .support import socketpair, get_time, print_results
+
+
+def callback(key, events):
+    pass
+
+
+def record_synthetic_trace(path, sockets=200, rounds=2000):
+    """ Records a trace where a few sockets out of many become readable
+    every round and are drained by the next round. """
+    rng = random.Random(0)
+    selector = selectors2.DefaultSelector()
+    pairs = [socketpair() for _ in range(sockets)]
+    try:
+        for rd, _ in pairs:
+            selector.register(rd, selectors2.EVENT_READ)
+        selector.record_trace(path)
+        for _ in range(rounds):
+            for _, wr in rng.sample(pairs, rng.randint(1, 16)):
+                wr.send(b'x')
+            for key, _ in selector.select(0):
+                key.fileobj.recv(4096)
+    finally:
+        selector.close()
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+
+
+def replay(path):
+    """ Returns (select() calls, callbacks) for one replay of the trace. """
+    selector = selectors2.ReplaySelector(path, data=callback)
+    run_once = selectors2.Dispatcher(selector).run_once
+    selects = dispatched = 0
+    try:
+        while True:
+            dispatched += run_once(0)
+            selects += 1
+    except EOFError:
+        pass
+    finally:
+        selector.close()
+    return selects, dispatched
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    directory = None
+    if argv:
+        path = argv[0]
+    else:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "synthetic.trace")
+        record_synthetic_trace(path)
+
+    try:
+        best = None
+        for _ in range(3):
+            start = get_time()
+            selects, dispatched = replay(path)
+            elapsed = get_time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        size = os.path.getsize(path)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print_results("Replay of {0} select() calls ({1} bytes)".format(selects, size),
+                  [("select() calls", selects / best), ("callbacks", dispatched / best)],
+                  unit="per sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+""" Benchmark the cost of an empty select(0) call for each selector.
+
+A single idle socket is registered so that every selector has to
+perform the underlying system call instead of short-circuiting.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import selectors2
+from .support import socketpair, selector_classes, measure_rate, print_results
+
+
+def bench_empty_select(selector_class, iterations, stall_handler=False, stats=False,
+                       publish=None):
+    selector = selector_class()
+    rd, wr = socketpair()
+    try:
+        selector.register(rd, selectors2.EVENT_READ)
+        if stall_handler:
+            selector.set_stall_handler(60.0)
+        if stats:
+            selector.enable_stats()
+        if publish is not None:
+            selector.publish_stats(publish)
+        return measure_rate(lambda: selector.select(0), iterations)
+    finally:
+        selector.close()
+        rd.close()
+        wr.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 100000
+    directory = tempfile.mkdtemp()
+    page = os.path.join(directory, "selector.stats")
+    results = []
+    for name, selector_class in selector_classes():
+        results.append((name, bench_empty_select(selector_class, iterations)))
+        results.append((name + " (stalls)", bench_empty_select(selector_class, iterations,
+                                                               stall_handler=True)))
+        results.append((name + " (stats)", bench_empty_select(selector_class, iterations,
+                                                              stats=True)))
+        results.append((name + " (published)", bench_empty_select(selector_class, iterations,
+                                                                  publish=page)))
+    shutil.rmtree(directory)
+    print_results("Empty select(0) calls", results)
+
+
+if __name__ == "__main__":
+    main()
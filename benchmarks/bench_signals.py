@@ -0,0 +1,126 @@
+""" Benchmark a loop doing request/response round trips with an echo process
+while another process sends it SIGUSR1 at a fixed rate. Signals are handled
+three ways and compared with a loop which isn't sent any signals:
+
+* handler: a Python signal handler, so signals interrupt select() and the
+  other system calls of the loop.
+* self-pipe: SignalSource(signalfd=False), a handler plus a wakeup fd
+  registered with the selector.
+* signalfd: SignalSource() on Linux, signals are blocked and read from a
+  signalfd registered with the selector.
+
+Reports round trips per second and how many signals the loop saw::
+
+    $ python -m benchmarks.bench_signals --rate 20000 --duration 2
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+import selectors2
+from .support import socketpair, get_time
+
+
+def echo(sock, other):
+    other.close()
+    try:
+        while True:
+            data = sock.recv(1)
+            if not data:
+                break
+            sock.send(data)
+    except socket.error:
+        pass  # The loop closed its end with a byte still queued.
+
+
+def send_signals(pid, interval, stop):
+    while not stop.is_set():
+        os.kill(pid, signal.SIGUSR1)
+        time.sleep(interval)
+
+
+def run(mode, rate, duration):
+    """ Returns (round trips/sec, signals seen) """
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        # The echo process inherits its end of the socket pair.
+        context = multiprocessing.get_context("fork")
+    sock, other = socketpair()
+    peer = context.Process(target=echo, args=(other, sock))
+    peer.start()
+    other.close()
+    sock.setblocking(False)
+
+    seen = [0]
+    source = previous = None
+    if mode == "handler":
+        def on_signal(signum, frame):
+            seen[0] += 1
+        previous = signal.signal(signal.SIGUSR1, on_signal)
+    elif mode != "none":
+        source = selectors2.SignalSource([signal.SIGUSR1], signalfd=mode == "signalfd")
+
+    selector = selectors2.DefaultSelector()
+    selector.register(sock, selectors2.EVENT_READ)
+    if source is not None:
+        selector.register(source, selectors2.EVENT_READ)
+
+    stop = context.Event()
+    sender = context.Process(target=send_signals, args=(os.getpid(), 1.0 / rate, stop))
+    if mode != "none":
+        sender.start()
+    trips = 0
+    sock.send(b"x")
+    start = get_time()
+    end = start + duration
+    while get_time() < end:
+        for key, events in selector.select():
+            if key.fileobj is source:
+                seen[0] += len(source.read())
+                continue
+            if sock.recv(1):
+                trips += 1
+                sock.send(b"x")
+    elapsed = get_time() - start
+
+    # Signals still in flight must be consumed before they're unblocked.
+    stop.set()
+    if mode != "none":
+        sender.join()
+    if source is not None:
+        source.read()
+        source.close()
+    elif previous is not None:
+        signal.signal(signal.SIGUSR1, previous)
+    selector.close()
+    sock.close()
+    peer.join()
+    return trips / elapsed, seen[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_signals",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rate", type=int, default=20000, help="signals sent per second")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per run")
+    args = parser.parse_args(argv)
+
+    modes = ["none", "handler", "self-pipe"]
+    if selectors2._load_signalfd() is not None:
+        modes.append("signalfd")
+    sys.stdout.write("Round trips while receiving up to {0} signals/sec\n".format(args.rate))
+    line = "  {0:<12} {1:>16} {2:>14}\n"
+    sys.stdout.write(line.format("", "round trips/sec", "signals seen"))
+    for mode in modes:
+        rate, seen = max(run(mode, args.rate, args.duration) for _ in range(3))
+        sys.stdout.write(line.format(mode, "{0:,.0f}".format(rate), "{0:,}".format(seen)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+""" Benchmark how Dispatcher scales with the number of registered file
+descriptors using SimulatedSelector so that no sockets are opened. A small
+hot set of file descriptors receives most of the bursty readiness::
+
+    $ python -m benchmarks.bench_simulated [CALLBACKS]
+"""
+
+import sys
+
+import selectors2
+from .support import get_time, print_results
+
+
+def callback(key, events):
+    pass
+
+
+def bench_dispatch(registered, callbacks):
+    selector = selectors2.SimulatedSelector(rate=100000.0, burst_size=8.0, hot_fraction=0.01,
+                                            hot_share=0.9, seed=0)
+    try:
+        for fd in range(registered):
+            selector.register(fd, selectors2.EVENT_READ, callback)
+        run_once = selectors2.Dispatcher(selector).run_once
+        dispatched = 0
+        start = get_time()
+        while dispatched < callbacks:
+            dispatched += run_once()
+        return dispatched / (get_time() - start)
+    finally:
+        selector.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    callbacks = int(argv[0]) if argv else 200000
+    results = []
+    for registered in (1000, 10000, 100000, 1000000):
+        results.append(("{0:,} registered".format(registered),
+                        bench_dispatch(registered, callbacks)))
+    print_results("Dispatcher with simulated readiness", results, unit="callbacks/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+""" Benchmark waiting on timers and child process exits with TimerSource and
+ChildSource registered with a selector, against sleeping between ticks and
+polling waitpid() between sleeps::
+
+    $ python -m benchmarks.bench_sources --ticks 1000 --children 50
+
+Timers tick every --interval seconds. Each report shows how late the last
+tick was compared to the schedule, how often the loop woke up and the CPU
+time it used. Children exit one every --spacing seconds and the report
+shows how long after exiting they were noticed on average.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import selectors2
+from .support import get_time
+
+try:  # os.times() only counts in clock ticks, usually of 10ms.
+    import resource
+except ImportError:
+    resource = None
+
+
+def cpu_time():
+    if resource is None:
+        times = os.times()
+        return times[0] + times[1]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def tick_sleep(ticks, interval):
+    """ Returns (seconds late, wakeups) """
+    start = get_time()
+    for _ in range(ticks):
+        time.sleep(interval)
+    return get_time() - start - ticks * interval, ticks
+
+
+def tick_select(ticks, interval):
+    selector = selectors2.DefaultSelector()
+    start = get_time()
+    deadline = start
+    wakeups = 0
+    for _ in range(ticks):
+        deadline += interval
+        while True:
+            remaining = deadline - get_time()
+            if remaining <= 0:
+                break
+            selector.select(remaining)
+            wakeups += 1
+    selector.close()
+    return get_time() - start - ticks * interval, wakeups
+
+
+def tick_timer(ticks, interval):
+    selector = selectors2.DefaultSelector()
+    timer = selectors2.TimerSource(interval, interval)
+    selector.register(timer, selectors2.EVENT_READ)
+    start = get_time()
+    ticked = wakeups = 0
+    while ticked < ticks:
+        for _ in selector.select():
+            ticked += timer.read()
+        wakeups += 1
+    late = get_time() - start - ticks * interval
+    timer.close()
+    selector.close()
+    return late, wakeups
+
+
+def spawn(children, spacing):
+    """ Returns {pid: time the child exits} """
+    exits = {}
+    start = get_time()
+    for i in range(children):
+        delay = (i + 1) * spacing
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(max(0, start + delay - get_time()))
+            os._exit(0)
+        exits[pid] = start + delay
+    return exits
+
+
+def reap_waitpid(exits, poll_interval):
+    """ Returns (total seconds from exiting to being reaped, wakeups) """
+    pending = set(exits)
+    total = 0.0
+    wakeups = 0
+    while pending:
+        for pid in list(pending):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                total += get_time() - exits[pid]
+                pending.discard(pid)
+        if pending:
+            time.sleep(poll_interval)
+            wakeups += 1
+    return total, wakeups
+
+
+def reap_pidfd(exits, poll_interval):
+    selector = selectors2.DefaultSelector()
+    for pid in exits:
+        selector.register(selectors2.ChildSource(pid), selectors2.EVENT_READ)
+    total = 0.0
+    wakeups = 0
+    while selector.get_map():
+        ready = selector.select()
+        wakeups += 1
+        for key, _ in ready:
+            key.fileobj.read()
+            total += get_time() - exits[key.fileobj.pid]
+            selector.unregister(key.fileobj)
+            key.fileobj.close()
+    selector.close()
+    return total, wakeups
+
+
+def measure(func, *args):
+    """ Returns func()'s results and the CPU time it used """
+    start = cpu_time()
+    results = func(*args)
+    return results + (cpu_time() - start,)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_sources",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=0.001, help="seconds per tick")
+    parser.add_argument("--children", type=int, default=50)
+    parser.add_argument("--spacing", type=float, default=0.01,
+                        help="seconds between child exits")
+    parser.add_argument("--poll", type=float, default=0.005,
+                        help="seconds between waitpid() polls")
+    args = parser.parse_args(argv)
+
+    line = "  {0:<24} {1:>12} {2:>10} {3:>10}\n"
+    sys.stdout.write("{0} ticks every {1}ms\n".format(args.ticks, args.interval * 1000))
+    sys.stdout.write(line.format("", "last tick", "wakeups", "CPU"))
+    ticks = [("sleep()", tick_sleep), ("select() timeout", tick_select)]
+    if selectors2._load_timerfd() is not None:
+        ticks.append(("TimerSource", tick_timer))
+    for label, func in ticks:
+        late, wakeups, cpu = measure(func, args.ticks, args.interval)
+        sys.stdout.write(line.format(label, "{0:+.1f}ms".format(late * 1000), wakeups,
+                                     "{0:.1f}ms".format(cpu * 1000)))
+        sys.stdout.flush()
+
+    sys.stdout.write("\n{0} children exiting every {1}ms\n".format(
+        args.children, args.spacing * 1000))
+    sys.stdout.write(line.format("", "mean delay", "wakeups", "CPU"))
+    reapers = [("waitpid() every {0}ms".format(args.poll * 1000), reap_waitpid)]
+    if hasattr(os, "pidfd_open"):
+        reapers.append(("ChildSource", reap_pidfd))
+    for label, func in reapers:
+        exits = spawn(args.children, args.spacing)
+        total, wakeups, cpu = measure(func, exits, args.poll)
+        sys.stdout.write(line.format(label, "{0:.2f}ms".format(total / len(exits) * 1000),
+                                     wakeups, "{0:.1f}ms".format(cpu * 1000)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
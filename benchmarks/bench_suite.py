@@ -0,0 +1,205 @@
+""" Microbenchmark suite which runs the same benchmarks against the
+selectors2 selectors and the standard library's selectors module:
+
+* register_unregister: register() then unregister() of 100 sockets.
+* modify: modify() of one socket between two sets of events.
+* empty_select: select(0) with one idle socket registered.
+* select_ready: select(0) with N sockets registered of which M are ready.
+
+Every benchmark is repeated and each repeat after a warm up is kept as a
+sample so that runs can be compared with benchmarks.compare. Results are
+printed as a table or written as JSON with --json::
+
+    $ python -m benchmarks.bench_suite --json results.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import selectors2
+from .support import socketpair, selector_classes, max_socketpairs, measure_rates, print_results
+
+try:  # Python 2.x doesn't have the selectors module.
+    import selectors
+except ImportError:
+    selectors = None
+
+FORMAT_VERSION = 1
+REGISTER_BATCH = 100
+SELECT_SIZES = ((10, 1), (100, 1), (100, 10), (1000, 1), (1000, 10), (1000, 100))
+
+
+def backends():
+    """ Return a list of (name, class) tuples for every selector in
+    selectors2 and the selectors module on the current platform. """
+    classes = [("selectors2." + name, cls) for name, cls in selector_classes()]
+    if selectors is not None:
+        for name in ['SelectSelector', 'PollSelector', 'EpollSelector',
+                     'DevpollSelector', 'KqueueSelector']:
+            if hasattr(selectors, name):
+                classes.append(("selectors." + name, getattr(selectors, name)))
+    return classes
+
+
+def bench_register_unregister(selector, pairs, iterations, repeat):
+    sockets = [rd for rd, _ in pairs[:REGISTER_BATCH]]
+
+    def register_unregister():
+        for sock in sockets:
+            selector.register(sock, selectors2.EVENT_READ)
+        for sock in sockets:
+            selector.unregister(sock)
+
+    operations = 2 * len(sockets)
+    return [rate * operations for rate in
+            measure_rates(register_unregister, iterations, repeat)]
+
+
+def bench_modify(selector, pairs, iterations, repeat):
+    sock = pairs[0][0]
+    selector.register(sock, selectors2.EVENT_READ)
+    both = selectors2.EVENT_READ | selectors2.EVENT_WRITE
+
+    def modify():
+        selector.modify(sock, both)
+        selector.modify(sock, selectors2.EVENT_READ)
+
+    return [rate * 2 for rate in measure_rates(modify, iterations, repeat)]
+
+
+def bench_empty_select(selector, pairs, iterations, repeat):
+    selector.register(pairs[0][0], selectors2.EVENT_READ)
+    return measure_rates(lambda: selector.select(0), iterations, repeat)
+
+
+def bench_select_ready(selector, pairs, iterations, repeat, registered, ready):
+    for rd, _ in pairs[:registered]:
+        selector.register(rd, selectors2.EVENT_READ)
+    for _, wr in pairs[:ready]:
+        wr.send(b'x')
+    try:
+        if len(selector.select(0)) != ready:
+            raise RuntimeError("Expected {0} ready sockets".format(ready))
+        return measure_rates(lambda: selector.select(0), iterations, repeat)
+    finally:
+        for rd, _ in pairs[:ready]:
+            rd.recv(1)
+
+
+def benchmarks(scale, max_pairs):
+    """ Return a list of (benchmark, params, unit, pairs, iterations, func) tuples. """
+    cases = [
+        ("register_unregister", {}, "operations/sec", REGISTER_BATCH,
+         max(1, int(200 * scale)), bench_register_unregister),
+        ("modify", {}, "operations/sec", 1, max(1, int(20000 * scale)), bench_modify),
+        ("empty_select", {}, "calls/sec", 1, max(1, int(20000 * scale)), bench_empty_select),
+    ]
+    for registered, ready in SELECT_SIZES:
+        if registered > max_pairs:
+            continue
+
+        def func(selector, pairs, iterations, repeat, registered=registered, ready=ready):
+            return bench_select_ready(selector, pairs, iterations, repeat, registered, ready)
+
+        cases.append(("select_ready", {"registered": registered, "ready": ready},
+                      "calls/sec", registered,
+                      max(1, int(20000 * scale / max(1, registered // 10))), func))
+    return cases
+
+
+def result_name(result):
+    params = ",".join("{0}={1}".format(name, value)
+                      for name, value in sorted(result["params"].items()))
+    return "{0}({1})".format(result["benchmark"], params) if params else result["benchmark"]
+
+
+def run(repeat=5, scale=1.0, backend_names=None):
+    """ Runs the suite and returns the results as a JSON-compatible dict. """
+    max_pairs = max_socketpairs(max(size for size, _ in SELECT_SIZES))
+    pairs = [socketpair() for _ in range(max(max_pairs, REGISTER_BATCH))]
+    results = []
+    try:
+        for name, selector_class in backends():
+            if backend_names and name not in backend_names:
+                continue
+            for benchmark, params, unit, needed, iterations, func in benchmarks(scale, max_pairs):
+                selector = selector_class()
+                try:
+                    # The first sample warms up the selector and is dropped.
+                    samples = func(selector, pairs[:needed], iterations, repeat + 1)[1:]
+                except ValueError:
+                    # select() can't watch file descriptors above FD_SETSIZE.
+                    continue
+                finally:
+                    selector.close()
+                results.append({"benchmark": benchmark, "params": params, "backend": name,
+                                "unit": unit, "iterations": iterations, "samples": samples})
+    finally:
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+
+    return {
+        "format": FORMAT_VERSION,
+        "metadata": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": sys.platform,
+            "machine": platform.machine(),
+            "selectors2": selectors2.__version__,
+            "repeat": repeat,
+            "scale": scale,
+            "timestamp": time.time()
+        },
+        "results": results
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def print_suite(suite):
+    names = []
+    for result in suite["results"]:
+        if result_name(result) not in names:
+            names.append(result_name(result))
+    for name in names:
+        results = [r for r in suite["results"] if result_name(r) == name]
+        print_results("{0} (median of {1})".format(name, len(results[0]["samples"])),
+                      [(r["backend"], median(r["samples"])) for r in results],
+                      unit=results[0]["unit"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_suite",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the results as JSON to PATH ('-' for stdout)")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per benchmark")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the iterations of every benchmark by SCALE")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: selectors2.EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    suite = run(repeat=args.repeat, scale=args.scale, backend_names=args.backend)
+    if args.json == "-":
+        json.dump(suite, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(suite, f, indent=2, sort_keys=True)
+        print_suite(suite)
+
+
+if __name__ == "__main__":
+    main()
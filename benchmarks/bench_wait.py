@@ -0,0 +1,62 @@
+""" Benchmark waiting on a single ready socket with wait_for()
+against creating, registering and closing a DefaultSelector. """
+
+import os
+import sys
+
+import selectors2
+from .support import socketpair, measure_rate, print_results
+
+try:  # Python 2.6 doesn't have the resource module.
+    import resource
+except ImportError:
+    resource = None
+
+
+def wait_selector(sock):
+    selector = selectors2.DefaultSelector()
+    try:
+        selector.register(sock, selectors2.EVENT_WRITE)
+        return selector.select(0)
+    finally:
+        selector.close()
+
+
+def high_fd(sock):
+    """ Duplicate sock onto a file descriptor above FD_SETSIZE
+    so that wait_for() has to use poll(). Returns None if the
+    file descriptor limit is too low. """
+    if resource is None or not hasattr(os, 'dup2'):
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    fd = selectors2._FD_SETSIZE + 16
+    if soft <= fd:
+        return None
+    os.dup2(sock.fileno(), fd)
+    return fd
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 200000
+    rd, wr = socketpair()
+    fd = high_fd(wr)
+    try:
+        results = [
+            ('DefaultSelector()', measure_rate(lambda: wait_selector(wr), iterations)),
+            ('wait_for() select', measure_rate(
+                lambda: selectors2.wait_for(wr, selectors2.EVENT_WRITE, 0), iterations))
+        ]
+        if fd is not None:
+            results.append(('wait_for() poll', measure_rate(
+                lambda: selectors2.wait_for(fd, selectors2.EVENT_WRITE, 0), iterations)))
+    finally:
+        if fd is not None:
+            os.close(fd)
+        rd.close()
+        wr.close()
+    print_results("Single socket waits", results, unit="waits/sec")
+
+
+if __name__ == "__main__":
+    main()
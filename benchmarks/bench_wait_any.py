@@ -0,0 +1,49 @@
+""" Benchmark a one-shot wait on N sockets with wait_for_any()
+against a fresh selector that is created, filled and closed
+for every wait. Only one of the N sockets is ready. """
+
+import sys
+
+import selectors2
+from .support import socketpair, measure_rate, print_results
+
+SIZES = (2, 4, 8, 16, 32, 64)
+
+
+def wait_selector(selector_class, events):
+    selector = selector_class()
+    try:
+        for fileobj, mask in events.items():
+            selector.register(fileobj, mask)
+        return selector.select(0)
+    finally:
+        selector.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 20000
+    selector_class = getattr(selectors2, 'EpollSelector', selectors2.DefaultSelector)
+    selector_name = getattr(selector_class, '__name__', 'DefaultSelector')
+
+    pairs = [socketpair() for _ in range(max(SIZES))]
+    try:
+        for size in SIZES:
+            events = dict((rd, selectors2.EVENT_READ) for rd, _ in pairs[:size - 1])
+            events[pairs[size - 1][1]] = selectors2.EVENT_WRITE
+            results = [
+                (selector_name, measure_rate(
+                    lambda: wait_selector(selector_class, events), iterations)),
+                ('wait_for_any()', measure_rate(
+                    lambda: selectors2.wait_for_any(events, 0), iterations))
+            ]
+            print_results("One-shot wait on {0} sockets".format(size), results,
+                          unit="waits/sec")
+    finally:
+        for rd, wr in pairs:
+            rd.close()
+            wr.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+""" Benchmark a bulk transfer through a socket pair to a reader process with
+three ways of buffering the sender's output:
+
+* always: queues every write and registers EVENT_WRITE until it's sent.
+* bytearray: sends right away and copies what's left into a bytearray,
+  toggling EVENT_WRITE while the bytearray isn't empty.
+* BufferedWriter: sends right away and queues memoryviews which are
+  flushed together with sendmsg().
+
+The sender writes one chunk per select() call like a server writing a
+response per pass through its loop. Reports the throughput and how many
+register(), modify() and unregister() calls were made per MB::
+
+    $ python -m benchmarks.bench_writer --size 64 --chunk 16384
+"""
+
+import argparse
+import errno
+import multiprocessing
+import socket
+import sys
+
+import selectors2
+from .support import socketpair, selector_classes, get_time
+
+HIGH_WATER = 1024 * 1024
+MB = 1024 * 1024
+
+
+class AlwaysWriter(object):
+    def __init__(self, selector, sock):
+        self.selector = selector
+        self.sock = sock
+        self.buffer = bytearray()
+
+    @property
+    def buffered(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        if not self.buffer:
+            self.selector.register(self.sock, selectors2.EVENT_WRITE)
+        self.buffer += data
+
+    def flush(self):
+        del self.buffer[:send(self.sock, self.buffer)]
+        if not self.buffer:
+            self.selector.unregister(self.sock)
+
+
+class BytearrayWriter(AlwaysWriter):
+    def write(self, data):
+        if self.buffer:
+            self.buffer += data
+            return
+        sent = send(self.sock, data)
+        if sent < len(data):
+            self.buffer += data[sent:]
+            self.selector.register(self.sock, selectors2.EVENT_WRITE)
+
+
+def send(sock, data):
+    try:
+        return sock.send(data)
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+        return 0
+
+
+STRATEGIES = (("always", AlwaysWriter), ("bytearray", BytearrayWriter),
+              ("BufferedWriter", selectors2.BufferedWriter))
+
+
+def reader(sock, other, results):
+    other.close()
+    received = 0
+    buffer = bytearray(256 * 1024)
+    while True:
+        read = sock.recv_into(buffer)
+        if not read:
+            break
+        received += read
+    results.put(received)
+
+
+def transfer(selector_class, writer_class, size, chunk):
+    """ Returns (MB/sec, selector changes per MB) for sending size MB """
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context"):
+        # The reader inherits its end of the socket pair so it must be forked.
+        context = multiprocessing.get_context("fork")
+    rd, wr = socketpair()
+    results = context.Queue()
+    process = context.Process(target=reader, args=(rd, wr, results))
+    process.start()
+    rd.close()
+    wr.setblocking(False)
+
+    selector = selector_class()
+    selector.enable_stats()
+    writer = writer_class(selector, wr)
+    data = b"x" * chunk
+    total = size * MB
+    written = 0
+    start = get_time()
+    while written < total or writer.buffered:
+        # Like a server writing one response per pass through its loop.
+        timeout = None
+        if written < total and writer.buffered < HIGH_WATER:
+            writer.write(data)
+            written += chunk
+            timeout = 0
+        for _ in selector.select(timeout):
+            writer.flush()
+    wr.close()
+    received = results.get()
+    elapsed = get_time() - start
+    process.join()
+
+    stats = selector.stats()
+    selector.close()
+    if received != total:
+        raise RuntimeError("Received {0} of {1} bytes".format(received, total))
+    changes = stats.registers + stats.modifies + stats.unregisters
+    return size / elapsed, changes / float(size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_writer",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=64, help="MB to send per run")
+    parser.add_argument("--chunk", type=int, default=16384, help="bytes per write")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: EpollSelector (repeatable)")
+    args = parser.parse_args(argv)
+
+    sys.stdout.write("Sending {0} MB in {1} byte writes\n".format(args.size, args.chunk))
+    line = "  {0:<32} {1:>10} {2:>16}\n"
+    sys.stdout.write(line.format("", "MB/sec", "changes/MB"))
+    for name, selector_class in selector_classes():
+        if args.backend and name not in args.backend:
+            continue
+        for label, writer_class in STRATEGIES:
+            rate, changes = max(transfer(selector_class, writer_class, args.size, args.chunk)
+                                for _ in range(3))
+            sys.stdout.write(line.format("{0} {1}".format(name[:-len("Selector")], label),
+                                         "{0:,.0f}".format(rate), "{0:.1f}".format(changes)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
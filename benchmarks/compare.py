@@ -0,0 +1,175 @@
+""" Stores results of benchmarks.bench_suite as JSON baselines and checks
+new runs against them. Baselines are stored per Python implementation and
+version and results are matched by benchmark and backend::
+
+    $ python -m benchmarks.compare record
+    $ python -m benchmarks.compare check --threshold 0.1
+    $ python -m benchmarks.compare diff old.json new.json
+
+Each comparison bootstraps a confidence interval for the ratio of the
+mean new rate to the mean baseline rate from the repeated samples.
+A metric has regressed when the whole interval is below 1 - threshold so
+noisy metrics aren't reported unless the slowdown is clear. The interval
+only covers the noise within each run so the threshold should be larger
+than how much the machine drifts between runs. 'check' and 'diff' exit
+with status 1 if any metric regressed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+
+from . import bench_suite
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+def baseline_path(directory, metadata=None):
+    """ Return the path of the baseline for the Python that wrote
+    metadata, or the running Python if no metadata is given. """
+    if metadata is None:
+        implementation = platform.python_implementation()
+        version = platform.python_version()
+    else:
+        implementation = metadata["implementation"]
+        version = metadata["python"]
+    version = ".".join(version.split(".")[:2])
+    return os.path.join(directory, "{0}-{1}.json".format(implementation.lower(), version))
+
+
+def load(path):
+    with open(path) as f:
+        suite = json.load(f)
+    if suite.get("format") != bench_suite.FORMAT_VERSION:
+        raise ValueError("{0} has an unsupported format".format(path))
+    return suite
+
+
+def save(suite, path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "w") as f:
+        json.dump(suite, f, indent=2, sort_keys=True)
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+def bootstrap_ratio(baseline, samples, confidence=0.95, resamples=2000, seed=0):
+    """ Returns (ratio, low, high) where ratio is the mean of samples
+    divided by the mean of baseline and low and high bound the bootstrapped
+    confidence interval of that ratio. """
+    rng = random.Random(seed)
+    ratios = []
+    for _ in range(resamples):
+        a = mean([rng.choice(baseline) for _ in baseline])
+        b = mean([rng.choice(samples) for _ in samples])
+        ratios.append(b / a)
+    ratios.sort()
+    tail = (1.0 - confidence) / 2.0
+    low = ratios[int(tail * (resamples - 1))]
+    high = ratios[int((1.0 - tail) * (resamples - 1))]
+    return mean(samples) / mean(baseline), low, high
+
+
+def compare(baseline, new, threshold=0.1, confidence=0.95):
+    """ Returns a list of (name, backend, status, ratio, low, high) tuples
+    where status is 'regressed', 'improved', 'unchanged' or 'missing'. """
+    previous = {}
+    for result in baseline["results"]:
+        previous[(bench_suite.result_name(result), result["backend"])] = result
+
+    rows = []
+    for result in new["results"]:
+        key = (bench_suite.result_name(result), result["backend"])
+        before = previous.pop(key, None)
+        if before is None:
+            continue
+        ratio, low, high = bootstrap_ratio(before["samples"], result["samples"], confidence)
+        if high < 1.0 - threshold:
+            status = "regressed"
+        elif low > 1.0 + threshold:
+            status = "improved"
+        else:
+            status = "unchanged"
+        rows.append(key + (status, ratio, low, high))
+    for key in previous:
+        rows.append(key + ("missing", None, None, None))
+    return rows
+
+
+def print_comparison(rows, confidence):
+    line = "  {0:<40} {1:<26} {2:>8} {3:>18}  {4}\n"
+    sys.stdout.write(line.format("benchmark", "backend", "change",
+                                 "{0:.0%} interval".format(confidence), "status"))
+    for name, backend, status, ratio, low, high in rows:
+        if ratio is None:
+            sys.stdout.write(line.format(name, backend, "", "", status))
+            continue
+        sys.stdout.write(line.format(
+            name, backend, "{0:+.1%}".format(ratio - 1),
+            "[{0:+.1%}, {1:+.1%}]".format(low - 1, high - 1), status))
+
+
+def check(baseline, new, threshold, confidence):
+    if baseline["metadata"]["python"].split(".")[:2] != new["metadata"]["python"].split(".")[:2]:
+        sys.stderr.write("warning: comparing Python {0} with a baseline from Python {1}\n".format(
+            new["metadata"]["python"], baseline["metadata"]["python"]))
+    rows = compare(baseline, new, threshold, confidence)
+    print_comparison(rows, confidence)
+    regressed = [row for row in rows if row[2] == "regressed"]
+    if regressed:
+        sys.stdout.write("{0} of {1} benchmarks regressed by more than {2:.0%}\n".format(
+            len(regressed), len(rows), threshold))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare",
+                                     description=__doc__.split("\n\n")[0])
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY,
+                        help="where baselines are stored (default: benchmarks/baselines)")
+    parser.add_argument("--repeat", type=int, default=10, help="samples per benchmark")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the iterations of every benchmark by SCALE")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fail when a metric is slower by more than this fraction")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="confidence level of the interval")
+    parser.add_argument("--backend", action="append", metavar="NAME",
+                        help="only run NAME, ie: selectors2.EpollSelector (repeatable)")
+    parser.add_argument("--save", metavar="PATH", help="also write the new run to PATH")
+    parser.add_argument("command", choices=["record", "check", "diff"])
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="for diff: the baseline and the new results")
+    args = parser.parse_args(argv)
+
+    if args.command == "diff":
+        if len(args.files) != 2:
+            parser.error("diff needs a baseline file and a results file")
+        return check(load(args.files[0]), load(args.files[1]), args.threshold, args.confidence)
+
+    new = bench_suite.run(repeat=args.repeat, scale=args.scale, backend_names=args.backend)
+    if args.save:
+        save(new, args.save)
+    path = baseline_path(args.directory, new["metadata"])
+    if args.command == "record":
+        save(new, path)
+        sys.stdout.write("Saved baseline of {0} results to {1}\n".format(
+            len(new["results"]), path))
+        return 0
+
+    if not os.path.exists(path):
+        sys.stderr.write("error: no baseline at {0}, run 'record' first\n".format(path))
+        return 2
+    return check(load(path), new, args.threshold, args.confidence)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
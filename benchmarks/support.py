@@ -0,0 +1,89 @@
+""" Shared helpers for the selectors2 benchmarks.
+
+Benchmarks are run as modules from the root of the repository::
+
+    $ python -m benchmarks.bench_select
+"""
+
+import socket
+import sys
+
+import selectors2
+
+try:  # Python 2.6 doesn't have the resource module.
+    import resource
+except ImportError:
+    resource = None
+
+try:  # Python 2.x doesn't define time.perf_counter.
+    from time import perf_counter as get_time
+except ImportError:
+    from time import time as get_time
+
+__all__ = [
+    "get_time",
+    "socketpair",
+    "selector_classes",
+    "max_socketpairs",
+    "measure_rate",
+    "measure_rates",
+    "print_results"
+]
+
+socketpair = socket.socketpair
+
+
+def selector_classes():
+    """ Return a list of (name, class) tuples for every
+    selector that is available on the current platform. """
+    classes = []
+    for name in ['SelectSelector', 'PollSelector', 'EpollSelector',
+                 'DevpollSelector', 'KqueueSelector']:
+        if hasattr(selectors2, name):
+            classes.append((name, getattr(selectors2, name)))
+    return classes
+
+
+def max_socketpairs(wanted):
+    """ Raises the soft file descriptor limit as far as allowed and returns
+    how many of the wanted socket pairs can be opened at the same time. """
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (OSError, ValueError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+
+    # Leave room for file descriptors that are already open.
+    return max(1, min(wanted, (soft - 256) // 2))
+
+
+def measure_rate(func, iterations, repeat=3):
+    """ Call func() iterations times, repeat times, and return
+    the best observed rate of calls per second. """
+    return max(measure_rates(func, iterations, repeat))
+
+
+def measure_rates(func, iterations, repeat=3):
+    """ Call func() iterations times, repeat times, and return
+    the observed rate of calls per second for every repeat. """
+    rates = []
+    for _ in range(repeat):
+        start = get_time()
+        for _ in range(iterations):
+            func()
+        elapsed = get_time() - start
+        rates.append(iterations / max(elapsed, 1e-9))
+    return rates
+
+
+def print_results(title, results, unit="calls/sec"):
+    """ Print a list of (name, value) tuples as an aligned table. """
+    sys.stdout.write("{0}\n".format(title))
+    for name, value in results:
+        sys.stdout.write("  {0:<28} {1:>14,.0f} {2}\n".format(name, value, unit))
@@ -22,20 +22,31 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from collections import namedtuple, Mapping
+from collections import namedtuple, deque
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 import errno
-import math
-import platform
+import os
 import select
-import socket
+import struct
 import sys
 import time
 
+# Modules that only some features use (socket, logging, threading, mmap,
+# random...) are imported where they're needed to keep importing selectors2 cheap.
+
 try:
     monotonic = time.monotonic
 except AttributeError:
     monotonic = time.time
 
+try:  # Python 2.6 doesn't have memoryview.
+    _memoryview = memoryview
+except NameError:
+    _memoryview = buffer  # noqa: F821
+
 __author__ = 'Seth Michael Larson'
 __email__ = 'sethmichaellarson@protonmail.com'
 __version__ = '2.0.2'
@@ -44,15 +55,90 @@ __url__ = 'https://www.github.com/SethMichaelLarson/selectors2'
 
 __all__ = ['EVENT_READ',
            'EVENT_WRITE',
+           'EVENT_HUP',
+           'EVENT_ERROR',
+           'EVENT_RDHUP',
            'SelectorKey',
+           'SelectorStats',
            'DefaultSelector',
-           'BaseSelector']
+           'HandoffBalancer',
+           'HandoffWorker',
+           'handoff_channel',
+           'BaseSelector',
+           'BufferedWriter',
+           'BufferPool',
+           'ChildSource',
+           'DatagramReader',
+           'Dispatcher',
+           'borrow_selector',
+           'read_stats_page',
+           'read_trace',
+           'Relay',
+           'ReplaySelector',
+           'SignalSource',
+           'SimulatedSelector',
+           'TimerSource',
+           'TraceRecord',
+           'wait_for',
+           'wait_for_any',
+           'wait_for_read',
+           'wait_for_write']
 
 EVENT_READ = (1 << 0)
 EVENT_WRITE = (1 << 1)
+
+# Opt-in events reported only by selectors which can detect them natively:
+# PollSelector, EpollSelector and DevpollSelector report all three except
+# EVENT_RDHUP on DevpollSelector. KqueueSelector reports them for file
+# objects also registered for EVENT_READ or EVENT_WRITE but can only tell
+# a closed connection from a peer which shut down writing when EVENT_WRITE
+# is registered, otherwise EVENT_HUP is reported along with EVENT_RDHUP.
+# SelectSelector never reports them. Registering them doesn't change how hang-ups and
+# errors are reported as EVENT_READ and EVENT_WRITE.
+EVENT_HUP = (1 << 2)  # The connection was closed.
+EVENT_ERROR = (1 << 3)  # An error is pending on the file descriptor.
+EVENT_RDHUP = (1 << 4)  # The peer shut down its writing half of the connection.
+_EXTENDED_EVENTS = EVENT_HUP | EVENT_ERROR | EVENT_RDHUP
+_ALL_EVENTS = EVENT_READ | EVENT_WRITE | _EXTENDED_EVENTS
+
+# Linux only, 0 means they can't be registered.
+_POLLRDHUP = getattr(select, 'POLLRDHUP', 0)
+_EPOLLRDHUP = getattr(select, 'EPOLLRDHUP', 0)
+
+# Python 3.6+ defines EPOLLEXCLUSIVE but older kernels ignore flags they
+# don't know so support is detected from the kernel version.
+_EPOLLEXCLUSIVE = getattr(select, 'EPOLLEXCLUSIVE', 1 << 28)
+_EPOLLEXCLUSIVE_SUPPORTED = None
+
+# Most buffers passed to one sendmsg() call, detected on first use.
+_IOV_MAX = None
+
+# socket.SHUT_WR without importing socket, SD_SEND on Windows is the same.
+_SHUT_WR = 1
+
+# Flags of signalfd() and timerfd_create() which are O_NONBLOCK and
+# O_CLOEXEC on every architecture, the size of each struct signalfd_siginfo
+# read from a signalfd and the clock of timerfds. The literals are only
+# for Pythons without os.O_CLOEXEC or time.CLOCK_MONOTONIC.
+_FD_NONBLOCK = os.O_NONBLOCK if hasattr(os, 'O_NONBLOCK') else 0
+_FD_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+_SIGNALFD_SIGINFO_SIZE = 128
+_SIGNALFD_SIGNO_STRUCT = struct.Struct('I')
+_TIMERFD_EXPIRATIONS_STRUCT = struct.Struct('=Q')
+_CLOCK_MONOTONIC = getattr(time, 'CLOCK_MONOTONIC', 1)
 _DEFAULT_SELECTOR = None
+
+# Errors from select() when a registered file descriptor was closed and
+# how many file descriptors prune_stale() checks with each system call.
+_BAD_FD_ERRNOS = (errno.EBADF, getattr(errno, 'WSAENOTSOCK', errno.EBADF))
+_PRUNE_BATCH_SIZE = 512
 _SYSCALL_SENTINEL = object()  # Sentinel in case a system call returns None.
-_ERROR_TYPES = (OSError, IOError, socket.error)
+_ERROR_TYPES = (OSError, IOError)  # socket.error is a subclass of IOError.
+_IS_JYTHON = sys.platform.startswith('java')
+
+# Python 3.5+ retries system calls interrupted by signals (PEP 475) so
+# selectors can call the underlying select functions directly.
+_SYSCALL_RETRIES_EINTR = sys.version_info >= (3, 5)
 
 try:
     _INTEGER_TYPES = (int, long)
@@ -83,6 +169,24 @@ class _SelectorMapping(Mapping):
         return iter(self._selector._fd_to_key)
 
 
+def _socketpair():
+    """ Returns a pair of connected sockets. """
+    import socket
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    # Windows before Python 3.5 doesn't have socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+
 def _fileobj_to_fd(fileobj):
     """ Return a file descriptor from a file object. If
     given an integer will simply return that integer back. """
@@ -102,6 +206,334 @@ def _fileobj_to_fd(fileobj):
     return fd
 
 
+def _fileobj_is_stale(key):
+    """ Returns True if the file object of a key was closed or now has
+    a different file descriptor than when it was registered. """
+    try:
+        return _fileobj_to_fd(key.fileobj) != key.fd
+    except (ValueError,) + _ERROR_TYPES:
+        return True
+
+
+def _log_stale(key):
+    """ Default handler for BaseSelector.enable_pruning() """
+    import logging
+    logging.getLogger('selectors2').warning(
+        "Pruned %r (FD %d) which was closed without being unregistered", key.fileobj, key.fd)
+
+
+def _log_stall(stall_time, ready):
+    """ Default handler for BaseSelector.set_stall_handler() """
+    import logging
+    logging.getLogger('selectors2').warning(
+        "Spent %.3f seconds between calls to select() handling %d ready file "
+        "descriptors: %r", stall_time, len(ready), [key.fd for key, _ in ready])
+
+
+class SelectorStats(object):
+    """ Statistics collected by a selector after enable_stats() is called.
+
+    select_calls: Number of calls to select().
+    blocked_time: Seconds spent waiting inside of select().
+    busy_time: Seconds spent between select() returning and being called again.
+    ready_events: Total number of (key, events) tuples returned by select().
+    max_batch_size: Largest number of tuples returned by one select() call.
+    batch_sizes: List of counts of select() calls by the number of tuples
+        returned, bucketed by the upper bounds in BATCH_SIZE_BUCKETS.
+        The last entry counts calls which returned more than the largest bound.
+    registers, modifies, unregisters: Number of calls to each method.
+    eintr_retries: Number of system calls retried after an interrupt.
+        Python 3.5+ retries these itself so this is always zero there.
+    """
+    BATCH_SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+    def __init__(self, selector_name):
+        self.selector_name = selector_name
+        self.select_calls = 0
+        self.blocked_time = 0.0
+        self.busy_time = 0.0
+        self.ready_events = 0
+        self.max_batch_size = 0
+        self.batch_sizes = [0] * (len(self.BATCH_SIZE_BUCKETS) + 1)
+        self.registers = 0
+        self.modifies = 0
+        self.unregisters = 0
+        self.eintr_retries = 0
+
+    def copy(self):
+        stats = SelectorStats(self.selector_name)
+        stats.__dict__.update(self.__dict__)
+        stats.batch_sizes = list(self.batch_sizes)
+        return stats
+
+    def _add_select(self, blocked_time, ready_events):
+        self.select_calls += 1
+        self.blocked_time += blocked_time
+        self.ready_events += ready_events
+        if ready_events > self.max_batch_size:
+            self.max_batch_size = ready_events
+        if ready_events <= 1:
+            self.batch_sizes[ready_events] += 1
+        else:
+            # Buckets after the first two are powers of two.
+            bucket = len(bin(ready_events - 1)) - 1
+            self.batch_sizes[min(bucket, len(self.batch_sizes) - 1)] += 1
+
+    def _merge(self, other):
+        """ Adds the values of another SelectorStats to this one. """
+        for name in ('select_calls', 'blocked_time', 'busy_time', 'ready_events',
+                     'registers', 'modifies', 'unregisters', 'eintr_retries'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_batch_size = max(self.max_batch_size, other.max_batch_size)
+        self.batch_sizes = [a + b for a, b in zip(self.batch_sizes, other.batch_sizes)]
+
+    def to_prometheus(self, prefix='selectors2', labels=None):
+        """ Formats the statistics in the Prometheus text exposition format.
+        A 'selector' label with the selector class name is always added. """
+        labels = dict(labels or {})
+        labels.setdefault('selector', self.selector_name)
+        label_text = ','.join('{0}="{1}"'.format(name, _escape_label(value))
+                              for name, value in sorted(labels.items()))
+        lines = []
+        for name, help_text, value in (
+                ('select_calls_total', 'Number of calls to select().', self.select_calls),
+                ('blocked_seconds_total', 'Seconds spent waiting in select().',
+                 self.blocked_time),
+                ('busy_seconds_total', 'Seconds spent between calls to select().',
+                 self.busy_time),
+                ('registers_total', 'Number of calls to register().', self.registers),
+                ('modifies_total', 'Number of calls to modify().', self.modifies),
+                ('unregisters_total', 'Number of calls to unregister().', self.unregisters),
+                ('eintr_retries_total', 'System calls retried after EINTR.',
+                 self.eintr_retries)):
+            name = prefix + '_' + name
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{{{1}}} {2!r}'.format(name, label_text, value))
+
+        name = prefix + '_ready_batch_size'
+        lines.append('# HELP {0} Number of ready file objects returned by select().'.format(name))
+        lines.append('# TYPE {0} histogram'.format(name))
+        cumulative = 0
+        bounds = [str(bound) for bound in self.BATCH_SIZE_BUCKETS] + ['+Inf']
+        for bound, count in zip(bounds, self.batch_sizes):
+            cumulative += count
+            bucket_labels = '{0},le="{1}"'.format(label_text, bound)
+            lines.append('{0}_bucket{{{1}}} {2}'.format(name, bucket_labels, cumulative))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, label_text, self.ready_events))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, label_text, self.select_calls))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    """ Escapes a Prometheus label value. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Layout of the file written by BaseSelector.publish_stats(). All values are
+# little-endian. The sequence number is odd while the page is being written.
+_STATS_PAGE_MAGIC = b'SEL2STAT'
+_STATS_PAGE_VERSION = 1
+_STATS_PAGE_FORMAT = '<8sIIQdd32s7Q2d{0}Q'.format(len(SelectorStats.BATCH_SIZE_BUCKETS) + 1)
+_STATS_PAGE_SEQUENCE_OFFSET = 16
+_STATS_PAGE_STRUCT = struct.Struct(_STATS_PAGE_FORMAT)
+_STATS_PAGE_SEQUENCE_STRUCT = struct.Struct('<Q')
+
+
+class _StatsPage(object):
+    """ Memory mapped file that a selector's statistics are copied into after
+    a call to select() once next_write has passed. There is a single writer so
+    the page is updated without locks: the sequence number is made odd before
+    the counters are written and even afterwards. Readers retry if the sequence
+    number is odd or changes while they're reading. """
+
+    def __init__(self, path, selector_name, interval):
+        import mmap
+        self._struct = _STATS_PAGE_STRUCT
+        self._sequence = _STATS_PAGE_SEQUENCE_STRUCT
+        self._file = open(path, 'w+b')
+        try:
+            self._file.truncate(self._struct.size)
+            self._mmap = mmap.mmap(self._file.fileno(), self._struct.size)
+        except Exception:
+            self._file.close()
+            raise
+        self._header = (_STATS_PAGE_MAGIC, _STATS_PAGE_VERSION, os.getpid())
+        self._started = time.time()
+        self._selector_name = selector_name.encode('ascii')[:32]
+        self._count = 0
+        self._interval = interval
+        self.next_write = 0.0
+
+    def write(self, stats, now):
+        self.next_write = now + self._interval
+        count = self._count + 1
+        self._sequence.pack_into(self._mmap, _STATS_PAGE_SEQUENCE_OFFSET, count * 2 - 1)
+        self._struct.pack_into(self._mmap, 0, *(self._header + (
+            count * 2 - 1, self._started, time.time(), self._selector_name,
+            stats.select_calls, stats.ready_events, stats.max_batch_size,
+            stats.registers, stats.modifies, stats.unregisters, stats.eintr_retries,
+            stats.blocked_time, stats.busy_time) + tuple(stats.batch_sizes)))
+        self._sequence.pack_into(self._mmap, _STATS_PAGE_SEQUENCE_OFFSET, count * 2)
+        self._count = count
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def read_stats_page(path, retries=100):
+    """ Reads a file written by BaseSelector.publish_stats() and returns a
+    SelectorStats with extra 'pid', 'started' and 'updated' attributes. The
+    last two are timestamps from time.time(). Raises ValueError if the file
+    isn't a stats page or it couldn't be read while not being written. """
+    page_struct = _STATS_PAGE_STRUCT
+    with open(path, 'rb') as f:
+        for _ in range(retries):
+            f.seek(0)
+            data = f.read(page_struct.size)
+            if len(data) < page_struct.size or data[:8] != _STATS_PAGE_MAGIC:
+                raise ValueError("{0!r} is not a selector stats page".format(path))
+            values = page_struct.unpack(data)
+            sequence = values[3]
+            if sequence % 2 == 0:
+                f.seek(_STATS_PAGE_SEQUENCE_OFFSET)
+                if _STATS_PAGE_SEQUENCE_STRUCT.unpack(f.read(8))[0] == sequence:
+                    break
+        else:
+            raise ValueError("{0!r} was being written to on every read".format(path))
+
+    if values[1] != _STATS_PAGE_VERSION:
+        raise ValueError("{0!r} has unsupported version {1}".format(path, values[1]))
+    stats = SelectorStats(values[6].rstrip(b'\x00').decode('ascii'))
+    stats.pid = values[2]
+    stats.started = values[4]
+    stats.updated = values[5]
+    (stats.select_calls, stats.ready_events, stats.max_batch_size, stats.registers,
+     stats.modifies, stats.unregisters, stats.eintr_retries,
+     stats.blocked_time, stats.busy_time) = values[7:16]
+    stats.batch_sizes = list(values[16:])
+    return stats
+
+
+# Layout of the file written by BaseSelector.record_trace(). Every record
+# starts with an operation, seconds since recording started and either a
+# file descriptor or, for select(), the number of ready file descriptors.
+# register() and modify() records are followed by the events. select()
+# records are followed by the timeout (-1.0 for None), the seconds spent
+# in select() and then the ready file descriptors and their events.
+_TRACE_MAGIC = b'SEL2TRCE'
+_TRACE_VERSION = 1
+_TRACE_REGISTER = 1
+_TRACE_MODIFY = 2
+_TRACE_UNREGISTER = 3
+_TRACE_SELECT = 4
+_TRACE_OPERATIONS = {_TRACE_REGISTER: 'register', _TRACE_MODIFY: 'modify',
+                     _TRACE_UNREGISTER: 'unregister', _TRACE_SELECT: 'select'}
+_TRACE_VERSION_STRUCT = struct.Struct('<I')
+_TRACE_RECORD_STRUCT = struct.Struct('<BdI')
+_TRACE_CHANGE_STRUCT = struct.Struct('<BdIB')
+_TRACE_SELECT_STRUCT = struct.Struct('<BdIff')
+_TRACE_SELECT_ARGS_STRUCT = struct.Struct('<ff')
+_TRACE_FDS_STRUCTS = {}
+
+
+def _trace_fds_struct(count):
+    """ Returns the struct.Struct for the file descriptors of a select()
+    record with count ready file descriptors, compiled once per count. """
+    fds_struct = _TRACE_FDS_STRUCTS.get(count)
+    if fds_struct is None:
+        fds_struct = _TRACE_FDS_STRUCTS[count] = struct.Struct('<{0}I'.format(count))
+    return fds_struct
+
+
+TraceRecord = namedtuple('TraceRecord', ['operation', 'time', 'fd', 'events',
+                                         'timeout', 'duration', 'ready'])
+
+
+class _TraceWriter(object):
+    """ Writes the records of a trace started by BaseSelector.record_trace().
+    Paths are opened by the writer and closed with it, file objects aren't. """
+
+    def __init__(self, trace):
+        self._record = _TRACE_RECORD_STRUCT
+        self._change = _TRACE_CHANGE_STRUCT
+        self._select = _TRACE_SELECT_STRUCT
+        self._owned = not hasattr(trace, 'write')
+        self._file = open(trace, 'wb') if self._owned else trace
+        self._file.write(_TRACE_MAGIC + _TRACE_VERSION_STRUCT.pack(_TRACE_VERSION))
+        self._started = monotonic()
+
+    def change(self, operation, fd, events):
+        self._file.write(self._change.pack(operation, monotonic() - self._started,
+                                           fd, events))
+
+    def unregister(self, fd):
+        self._file.write(self._record.pack(_TRACE_UNREGISTER,
+                                           monotonic() - self._started, fd))
+
+    def select(self, called, timeout, duration, ready):
+        data = self._select.pack(_TRACE_SELECT, called - self._started, len(ready),
+                                 -1.0 if timeout is None else timeout, duration)
+        if ready:
+            data += (_trace_fds_struct(len(ready)).pack(*[key.fd for key, _ in ready]) +
+                     bytes(bytearray([events for _, events in ready])))
+        self._file.write(data)
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+def read_trace(trace):
+    """ Reads a trace written by BaseSelector.record_trace() from a path or
+    binary file object and yields a TraceRecord for each recorded call.
+    The operation is 'register', 'modify', 'unregister' or 'select'. For
+    select() records ready is a list of (fd, events) tuples and fd is None. """
+    owned = not hasattr(trace, 'read')
+    f = open(trace, 'rb') if owned else trace
+    try:
+        header = f.read(12)
+        if len(header) < 12 or header[:8] != _TRACE_MAGIC:
+            raise ValueError("{0!r} is not a selector trace".format(trace))
+        version = _TRACE_VERSION_STRUCT.unpack(header[8:])[0]
+        if version != _TRACE_VERSION:
+            raise ValueError("{0!r} has unsupported version {1}".format(trace, version))
+
+        def read(size):
+            data = f.read(size)
+            if len(data) < size:
+                raise ValueError("{0!r} ends with a partial record".format(trace))
+            return data
+
+        record = _TRACE_RECORD_STRUCT
+        select_args = _TRACE_SELECT_ARGS_STRUCT
+        while True:
+            data = f.read(1)
+            if not data:
+                break
+            operation, when, value = record.unpack(data + read(record.size - 1))
+            name = _TRACE_OPERATIONS.get(operation)
+            if name is None:
+                raise ValueError("{0!r} has an unknown record {1}".format(trace, operation))
+            if operation == _TRACE_UNREGISTER:
+                yield TraceRecord(name, when, value, None, None, None, None)
+            elif operation != _TRACE_SELECT:
+                yield TraceRecord(name, when, value, bytearray(read(1))[0],
+                                  None, None, None)
+            else:
+                timeout, duration = select_args.unpack(read(select_args.size))
+                fds = _trace_fds_struct(value).unpack(read(4 * value))
+                ready = list(zip(fds, bytearray(read(value))))
+                yield TraceRecord(name, when, None, None,
+                                  None if timeout < 0 else timeout, duration, ready)
+    finally:
+        if owned:
+            f.close()
+
+
 class BaseSelector(object):
     """ Abstract Selector class
 
@@ -124,6 +556,23 @@ class BaseSelector(object):
         # Read-only mapping returned by get_map()
         self._map = _SelectorMapping(self)
 
+        # File descriptors which are suspended until re-armed by modify()
+        self._suspended = set()
+
+        # Instrumentation enabled by set_stall_handler(), enable_stats(),
+        # publish_stats() and record_trace()
+        self._stall_threshold = None
+        self._stats = None
+        self._stats_page = None
+        self._trace = None
+
+        # Called with each stale key while pruning is enabled.
+        self._stale_handler = None
+
+        # Set while modify() unregisters and registers a file object again
+        # so only the modify() itself is counted and traced.
+        self._modifying = False
+
     def _fileobj_lookup(self, fileobj):
         """ Return a file descriptor from a file object.
         This wraps _fileobj_to_fd() to do an exhaustive
@@ -146,16 +595,27 @@ class BaseSelector(object):
 
     def register(self, fileobj, events, data=None):
         """ Register a file object for a set of events to monitor. """
-        if (not events) or (events & ~(EVENT_READ | EVENT_WRITE)):
+        if (not events) or (events & ~_ALL_EVENTS):
             raise ValueError("Invalid events: {0!r}".format(events))
 
         key = SelectorKey(fileobj, self._fileobj_lookup(fileobj), events, data)
 
         if key.fd in self._fd_to_key:
-            raise KeyError("{0!r} (FD {1}) is already registered"
-                           .format(fileobj, key.fd))
+            # The file descriptor may have been reused after the file
+            # object registered with it was closed without unregistering.
+            old_key = self._fd_to_key[key.fd]
+            if self._stale_handler is None or not _fileobj_is_stale(old_key):
+                raise KeyError("{0!r} (FD {1}) is already registered"
+                               .format(fileobj, key.fd))
+            self._prune_keys([old_key])
 
         self._fd_to_key[key.fd] = key
+        if self._modifying:
+            return key
+        if self._stats is not None:
+            self._stats.registers += 1
+        if self._trace is not None:
+            self._trace.change(_TRACE_REGISTER, key.fd, events)
         return key
 
     def unregister(self, fileobj):
@@ -166,7 +626,7 @@ class BaseSelector(object):
             raise KeyError("{0!r} is not registered".format(fileobj))
 
         # Getting the fileno of a closed socket on Windows errors with EBADF.
-        except socket.error as err:
+        except _ERROR_TYPES as err:
             if err.errno != errno.EBADF:
                 raise
             else:
@@ -176,6 +636,13 @@ class BaseSelector(object):
                         break
                 else:
                     raise KeyError("{0!r} is not registered".format(fileobj))
+        self._suspended.discard(key.fd)
+        if self._modifying:
+            return key
+        if self._stats is not None:
+            self._stats.unregisters += 1
+        if self._trace is not None:
+            self._trace.unregister(key.fd)
         return key
 
     def modify(self, fileobj, events, data=None):
@@ -186,17 +653,48 @@ class BaseSelector(object):
         except KeyError:
             raise KeyError("{0!r} is not registered".format(fileobj))
 
+        if self._stats is not None:
+            self._stats.modifies += 1
+
+        trace = self._trace
         if events != key.events:
-            self.unregister(fileobj)
-            key = self.register(fileobj, events, data)
+            self._modifying = True
+            try:
+                self.unregister(fileobj)
+                key = self.register(fileobj, events, data)
+            finally:
+                self._modifying = False
+            if trace is not None:
+                trace.change(_TRACE_MODIFY, key.fd, events)
+            return key
 
         elif data != key.data:
             # Use a shortcut to update the data.
             key = key._replace(data=data)
             self._fd_to_key[key.fd] = key
 
+        if trace is not None:
+            trace.change(_TRACE_MODIFY, key.fd, events)
+        if key.fd in self._suspended:
+            self._suspended.remove(key.fd)
+            self._rearm(key)
+
         return key
 
+    def _suspend(self, key):
+        """ Stop reporting events for a registered file object until it
+        is re-armed by a call to modify(). The key stays registered. Used by
+        Dispatcher while a callback is running in an executor. Subclasses
+        extend this to remove the file descriptor from the underlying
+        selector and must tolerate unregister() on a suspended key. """
+        self._suspended.add(key.fd)
+
+    def _rearm(self, key):
+        """ Start reporting events for a suspended file object again.
+        Called by modify() so subclasses only need to add the file
+        descriptor back to the underlying selector. """
+        pass
+
     def select(self, timeout=None):
         """ Perform the actual selection until some monitored file objects
         are ready or the timeout expires. """
@@ -206,7 +704,12 @@ class BaseSelector(object):
         """ Close the selector. This must be called to ensure that all
         underlying resources are freed. """
         self._fd_to_key.clear()
+        self._suspended.clear()
         self._map = None
+        self.publish_stats(None)
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
 
     def get_key(self, fileobj):
         """ Return the key associated with a registered file object. """
@@ -230,6 +733,146 @@ class BaseSelector(object):
         except KeyError:
             return None
 
+    def set_stall_handler(self, threshold, handler=None):
+        """ Detect when more than threshold seconds pass between select()
+        returning and the next call to select(). That time is spent handling
+        the (key, events) tuples returned by the previous select() so when
+        the threshold is exceeded handler(stall_time, ready) is called with
+        those tuples. If no handler is given a warning is logged to the
+        'selectors2' logger instead. A threshold of None disables detection
+        which adds no overhead to select() while disabled. """
+        self._stall_threshold = threshold
+        self._stall_handler = handler or _log_stall
+        self._update_instrumentation()
+
+    def enable_stats(self, enabled=True):
+        """ Start (or stop) collecting the statistics returned by stats().
+        Enabling statistics resets any previously collected values. """
+        if not enabled:
+            self.publish_stats(None)
+        self._stats = SelectorStats(type(self).__name__) if enabled else None
+        self._update_instrumentation()
+
+    def publish_stats(self, path, interval=0.1):
+        """ Enables statistics and copies them into a memory mapped file
+        at path so that other processes can read them with read_stats_page()
+        or 'python -m selectors2 PATH'. The file is created or truncated and
+        is updated by select() at most once every interval seconds, or after
+        every call if interval is 0. Passing None or closing the selector
+        stops publishing after a final update. Processes forked after this is
+        called must publish to their own path. """
+        page = self._stats_page
+        if page is not None:
+            self._stats_page = None
+            page.write(self._stats, monotonic())
+            page.close()
+        if path is not None:
+            if self._stats is None:
+                self.enable_stats()
+            self._stats_page = _StatsPage(path, type(self).__name__, interval)
+            self._stats_page.write(self._stats, monotonic())
+
+    def record_trace(self, trace):
+        """ Records every call to register(), modify(), unregister() and
+        select() along with the ready file descriptors to trace, which is a
+        path or a binary file object. File descriptors that are already
+        registered are recorded as registered first. The trace can be read
+        with read_trace() and replayed with ReplaySelector. Passing None or
+        closing the selector stops recording. """
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+        if trace is not None:
+            self._trace = _TraceWriter(trace)
+            for key in list(self._fd_to_key.values()):
+                self._trace.change(_TRACE_REGISTER, key.fd, key.events)
+        self._update_instrumentation()
+
+    def stats(self):
+        """ Return a snapshot of the SelectorStats collected since
+        enable_stats() was called or None if they aren't enabled. """
+        if self._stats is None:
+            return None
+        return self._stats.copy()
+
+    def enable_pruning(self, enabled=True, handler=None):
+        """ Start (or stop) unregistering stale keys whose file objects were
+        closed without being unregistered. While enabled handler(key) is
+        called for each stale key, or a warning is logged to the 'selectors2'
+        logger if no handler is given. Keys are pruned when register() is
+        given a file descriptor that is still registered to a closed file
+        object, when select.select() fails with EBADF and when poll() reports
+        POLLNVAL. epoll and kqueue silently forget closed file descriptors so
+        call prune_stale() to find those. """
+        self._stale_handler = (handler or _log_stale) if enabled else None
+
+    def prune_stale(self):
+        """ Unregister and return the keys whose file objects were closed or
+        now have a different file descriptor, or whose file descriptors are
+        no longer open. File descriptors are checked in batches with a zero
+        timeout poll() or, where poll() isn't available, by bisecting
+        select.select() calls. The handler from enable_pruning() is called
+        with each key if pruning is enabled. """
+        stale = []
+        fds = []
+        for key in self._fd_to_key.values():
+            if _fileobj_is_stale(key):
+                stale.append(key)
+            else:
+                fds.append(key.fd)
+        stale.extend(self._fd_to_key[fd] for fd in _closed_fds(fds))
+        self._prune_keys(stale)
+        return stale
+
+    def _prune_keys(self, keys):
+        for key in keys:
+            try:
+                self.unregister(key.fd)
+            except _ERROR_TYPES:
+                # The underlying selector may fail on a closed file descriptor
+                # after the key has been removed.
+                pass
+        if self._stale_handler is not None:
+            for key in keys:
+                self._stale_handler(key)
+
+    def _update_instrumentation(self):
+        """ Shadows select() with _instrumented_select() while stall
+        detection, statistics or tracing are enabled and removes it otherwise. """
+        self._select_returned = None
+        self._select_ready = None
+        if self._stall_threshold is None and self._stats is None and self._trace is None:
+            self.__dict__.pop('select', None)
+        else:
+            self.select = self._instrumented_select
+
+    def _instrumented_select(self, timeout=None):
+        """ Wraps select() while stall detection, statistics or tracing are enabled. """
+        stats = self._stats
+        called = monotonic()
+        returned = self._select_returned
+        if returned is not None:
+            busy_time = called - returned
+            if stats is not None:
+                stats.busy_time += busy_time
+            threshold = self._stall_threshold
+            if threshold is not None and busy_time > threshold:
+                ready, self._select_ready = self._select_ready, None
+                self._stall_handler(busy_time, ready)
+
+        ready = type(self).select(self, timeout)
+        returned = monotonic()
+        if stats is not None:
+            stats._add_select(returned - called, len(ready))
+            page = self._stats_page
+            if page is not None and returned >= page.next_write:
+                page.write(stats, returned)
+        if self._trace is not None:
+            self._trace.select(called, timeout, returned - called, ready)
+        self._select_ready = ready
+        self._select_returned = returned
+        return ready
+
     def __enter__(self):
         return self
 
@@ -245,6 +888,7 @@ if hasattr(select, "select"):
             super(SelectSelector, self).__init__()
             self._readers = set()
             self._writers = set()
+            self._select_func = select.select
 
         def register(self, fileobj, events, data=None):
             key = super(SelectSelector, self).register(fileobj, events, data)
@@ -260,6 +904,17 @@ if hasattr(select, "select"):
             self._writers.discard(key.fd)
             return key
 
+        def _suspend(self, key):
+            super(SelectSelector, self)._suspend(key)
+            self._readers.discard(key.fd)
+            self._writers.discard(key.fd)
+
+        def _rearm(self, key):
+            if key.events & EVENT_READ:
+                self._readers.add(key.fd)
+            if key.events & EVENT_WRITE:
+                self._writers.add(key.fd)
+
         def select(self, timeout=None):
             # Selecting on empty lists on Windows errors out.
             if not len(self._readers) and not len(self._writers):
@@ -267,8 +922,22 @@ if hasattr(select, "select"):
 
             timeout = None if timeout is None else max(timeout, 0.0)
             ready = []
-            r, w, _ = _syscall_wrapper(self._wrap_select, True, self._readers,
-                                       self._writers, timeout=timeout)
+            while True:
+                try:
+                    if _SYSCALL_RETRIES_EINTR:
+                        r, w, _ = self._select_func(self._readers, self._writers, [], timeout)
+                    else:
+                        r, w, _ = _syscall_wrapper(self._wrap_select, True, self._readers,
+                                                   self._writers, timeout=timeout,
+                                                   stats=self._stats)
+                    break
+                except (OSError, IOError, select.error) as e:
+                    # One closed file descriptor fails the whole call.
+                    if (self._stale_handler is None or _error_errno(e) not in _BAD_FD_ERRNOS or
+                            not self.prune_stale()):
+                        raise
+                    if not len(self._readers) and not len(self._writers):
+                        return []
             r = set(r)
             w = set(w)
             for fd in r | w:
@@ -285,12 +954,12 @@ if hasattr(select, "select"):
 
         def _wrap_select(self, r, w, timeout=None):
             """ Wrapper for select.select because timeout is a positional arg """
-            return select.select(r, w, [], timeout)
+            return self._select_func(r, w, [], timeout)
 
     __all__.append('SelectSelector')
 
     # Jython has a different implementation of .fileno() for socket objects.
-    if platform.python_implementation() == 'Jython':
+    if _IS_JYTHON:
         class _JythonSelectorMapping(object):
             """ This is an implementation of _SelectorMapping that is built
             for use specifically with Jython, which does not provide a hashable
@@ -354,17 +1023,28 @@ if hasattr(select, "select"):
                 else:
                     raise KeyError("{0!r} is not registered.".format(fileobj))
 
-                if key.events & EVENT_READ:
+                # Suspended sockets were already removed from the lists.
+                if fileobj in self._readers:
                     self._readers.remove(fileobj)
-                if key.events & EVENT_WRITE:
+                if fileobj in self._writers:
                     self._writers.remove(fileobj)
 
                 del self._sockets[i]
                 return key
 
-            def _wrap_select(self, r, w, timeout=None):
-                """ Wrapper for select.select because timeout is a positional arg """
-                return self._select_func(r, w, [], timeout)
+            def _suspend(self, key):
+                # Every key has fd -1 so only the lists track what's suspended.
+                if key.fileobj in self._readers:
+                    self._readers.remove(key.fileobj)
+                if key.fileobj in self._writers:
+                    self._writers.remove(key.fileobj)
+                self._suspended.add(key.fd)
+
+            def _rearm(self, key):
+                if key.events & EVENT_READ and key.fileobj not in self._readers:
+                    self._readers.append(key.fileobj)
+                if key.events & EVENT_WRITE and key.fileobj not in self._writers:
+                    self._writers.append(key.fileobj)
 
         __all__.append('JythonSelectSelector')
         SelectSelector = JythonSelectSelector  # Override so the wrong selector isn't used.
@@ -376,22 +1056,29 @@ if hasattr(select, "poll"):
         def __init__(self):
             super(PollSelector, self).__init__()
             self._poll = select.poll()
+            self._poll_func = self._poll.poll
 
         def register(self, fileobj, events, data=None):
             key = super(PollSelector, self).register(fileobj, events, data)
-            event_mask = 0
-            if events & EVENT_READ:
-                event_mask |= select.POLLIN
-            if events & EVENT_WRITE:
-                event_mask |= select.POLLOUT
-            self._poll.register(key.fd, event_mask)
+            self._poll.register(key.fd, _poll_event_mask(events))
             return key
 
         def unregister(self, fileobj):
             key = super(PollSelector, self).unregister(fileobj)
-            self._poll.unregister(key.fd)
+            try:
+                self._poll.unregister(key.fd)
+            except KeyError:
+                # The file descriptor was suspended.
+                pass
             return key
 
+        def _suspend(self, key):
+            super(PollSelector, self)._suspend(key)
+            self._poll.unregister(key.fd)
+
+        def _rearm(self, key):
+            self._poll.register(key.fd, _poll_event_mask(key.events))
+
         def _wrap_poll(self, timeout=None):
             """ Wrapper function for select.poll.poll() so that
             _syscall_wrapper can work with only seconds. """
@@ -401,23 +1088,35 @@ if hasattr(select, "poll"):
                 else:
                     # select.poll.poll() has a resolution of 1 millisecond,
                     # round away from zero to wait *at least* timeout seconds.
-                    timeout = math.ceil(timeout * 1000)
+                    timeout = int(-(-timeout * 1000 // 1))
 
-            result = self._poll.poll(timeout)
+            result = self._poll_func(timeout)
             return result
 
         def select(self, timeout=None):
             ready = []
-            fd_events = _syscall_wrapper(self._wrap_poll, True, timeout=timeout)
+            if _SYSCALL_RETRIES_EINTR:
+                if timeout is not None:
+                    timeout = 0 if timeout <= 0 else int(-(-timeout * 1000 // 1))
+                fd_events = self._poll_func(timeout)
+            else:
+                fd_events = _syscall_wrapper(self._wrap_poll, True, timeout=timeout,
+                                             stats=self._stats)
             for fd, event_mask in fd_events:
                 events = 0
-                if event_mask & ~select.POLLIN:
+                if event_mask & ~(select.POLLIN | _POLLRDHUP):
                     events |= EVENT_WRITE
                 if event_mask & ~select.POLLOUT:
                     events |= EVENT_READ
 
                 key = self._key_from_fd(fd)
                 if key:
+                    if event_mask & select.POLLNVAL and self._stale_handler is not None:
+                        # The file descriptor was closed without being unregistered.
+                        self._prune_keys([key])
+                        continue
+                    if key.events & _EXTENDED_EVENTS:
+                        events |= _poll_extended_events(event_mask)
                     ready.append((key, events & key.events))
 
             return ready
@@ -430,22 +1129,80 @@ if hasattr(select, "epoll"):
         def __init__(self):
             super(EpollSelector, self).__init__()
             self._epoll = select.epoll()
+            self._poll_func = self._epoll.poll
+
+            # File descriptors re-armed with EPOLLONESHOT after being
+            # suspended. The kernel disables these after each event so
+            # those reported by select() and not suspended again are
+            # registered normally by the next select() or modify().
+            self._oneshot = set()
+            self._fired = []
+
+            # File descriptors registered with EPOLLEXCLUSIVE which
+            # modify() has to add again instead of using EPOLL_CTL_MOD.
+            self._exclusive = set()
+            self._keep_exclusive = False
 
         def fileno(self):
             return self._epoll.fileno()
 
-        def register(self, fileobj, events, data=None):
+        def register(self, fileobj, events, data=None, exclusive=False):
+            """ Register a file object for a set of events to monitor. If
+            exclusive is True the file object is registered with EPOLLEXCLUSIVE
+            so that when several selectors have registered the same file object,
+            ie: a listening socket shared by worker processes, an event only
+            wakes up one of them instead of all of them. Exclusive registrations
+            can't include EVENT_RDHUP and raise RuntimeError on kernels before
+            Linux 4.5. Callers that prefer to fall back can catch the error and
+            register without exclusive. """
+            exclusive = exclusive or (self._keep_exclusive and
+                                      self._fileobj_lookup(fileobj) in self._exclusive)
+            events_mask = _epoll_event_mask(events)
+            if exclusive:
+                if events & EVENT_RDHUP:
+                    raise ValueError("EVENT_RDHUP can't be registered exclusively")
+                if not _epoll_exclusive_supported():
+                    raise RuntimeError("EPOLLEXCLUSIVE requires Linux 4.5 or later")
+                events_mask |= _EPOLLEXCLUSIVE
+
             key = super(EpollSelector, self).register(fileobj, events, data)
-            events_mask = 0
-            if events & EVENT_READ:
-                events_mask |= select.EPOLLIN
-            if events & EVENT_WRITE:
-                events_mask |= select.EPOLLOUT
             _syscall_wrapper(self._epoll.register, False, key.fd, events_mask)
+            if exclusive:
+                self._exclusive.add(key.fd)
             return key
 
+        def modify(self, fileobj, events, data=None):
+            fd = self._fileobj_lookup(fileobj)
+            if fd not in self._exclusive:
+                # modify() re-arms suspended file descriptors with
+                # EPOLLONESHOT and registers others normally again.
+                clear_oneshot = fd in self._oneshot and fd not in self._suspended
+                key = super(EpollSelector, self).modify(fileobj, events, data)
+                if clear_oneshot:
+                    self._clear_oneshot([key.fd])
+                return key
+
+            # EPOLLEXCLUSIVE can only be set when a file descriptor is added
+            # so keep it while modify() unregisters and registers again.
+            # Check what register() would reject first so that a failure
+            # leaves the registration as it was.
+            if (not events) or (events & ~_ALL_EVENTS):
+                raise ValueError("Invalid events: {0!r}".format(events))
+            if events & EVENT_RDHUP:
+                raise ValueError("EVENT_RDHUP can't be registered exclusively")
+            if not _epoll_exclusive_supported():
+                raise RuntimeError("EPOLLEXCLUSIVE requires Linux 4.5 or later")
+            self._keep_exclusive = True
+            try:
+                return super(EpollSelector, self).modify(fileobj, events, data)
+            finally:
+                self._keep_exclusive = False
+
         def unregister(self, fileobj):
             key = super(EpollSelector, self).unregister(fileobj)
+            self._oneshot.discard(key.fd)
+            if not self._keep_exclusive:
+                self._exclusive.discard(key.fd)
             try:
                 _syscall_wrapper(self._epoll.unregister, False, key.fd)
             except _ERROR_TYPES:
@@ -453,7 +1210,50 @@ if hasattr(select, "epoll"):
                 pass
             return key
 
+        def _suspend(self, key):
+            super(EpollSelector, self)._suspend(key)
+            # Keys are only suspended right after select() reports them
+            # so the kernel has already disabled EPOLLONESHOT registrations.
+            if key.fd not in self._oneshot:
+                try:
+                    _syscall_wrapper(self._epoll.unregister, False, key.fd)
+                except _ERROR_TYPES:
+                    pass
+
+        def _rearm(self, key):
+            events_mask = _epoll_event_mask(key.events)
+            if key.fd in self._exclusive:
+                # EPOLLEXCLUSIVE can't be combined with EPOLLONESHOT.
+                _syscall_wrapper(self._epoll.register, False, key.fd,
+                                 events_mask | _EPOLLEXCLUSIVE)
+            elif key.fd in self._oneshot:
+                _syscall_wrapper(self._epoll.modify, False, key.fd,
+                                 events_mask | select.EPOLLONESHOT)
+            elif hasattr(select, 'EPOLLONESHOT'):
+                _syscall_wrapper(self._epoll.register, False, key.fd,
+                                 events_mask | select.EPOLLONESHOT)
+                self._oneshot.add(key.fd)
+            else:
+                _syscall_wrapper(self._epoll.register, False, key.fd, events_mask)
+
+        def _clear_oneshot(self, fds):
+            """ Registers file descriptors which were re-armed with
+            EPOLLONESHOT without it once they're used outside of an
+            executor so they're reported again while they're ready. """
+            for fd in fds:
+                if fd not in self._oneshot or fd in self._suspended:
+                    continue
+                self._oneshot.discard(fd)
+                key = self._fd_to_key.get(fd)
+                if key is not None:
+                    _syscall_wrapper(self._epoll.modify, False, fd,
+                                     _epoll_event_mask(key.events))
+
         def select(self, timeout=None):
+            if self._fired:
+                fired, self._fired = self._fired, []
+                self._clear_oneshot(fired)
+
             if timeout is not None:
                 if timeout <= 0:
                     timeout = 0.0
@@ -461,7 +1261,7 @@ if hasattr(select, "epoll"):
                     # select.epoll.poll() has a resolution of 1 millisecond
                     # but luckily takes seconds so we don't need a wrapper
                     # like PollSelector. Just for better rounding.
-                    timeout = math.ceil(timeout * 1000) * 0.001
+                    timeout = -(-timeout * 1000 // 1) * 0.001
                 timeout = float(timeout)
             else:
                 timeout = -1.0  # epoll.poll() must have a float.
@@ -471,23 +1271,35 @@ if hasattr(select, "epoll"):
             max_events = max(len(self._fd_to_key), 1)
 
             ready = []
-            fd_events = _syscall_wrapper(self._epoll.poll, True,
-                                         timeout=timeout,
-                                         maxevents=max_events)
+            oneshot = self._oneshot
+            if _SYSCALL_RETRIES_EINTR:
+                fd_events = self._poll_func(timeout, max_events)
+            else:
+                fd_events = _syscall_wrapper(self._poll_func, True,
+                                             timeout=timeout,
+                                             maxevents=max_events,
+                                             stats=self._stats)
             for fd, event_mask in fd_events:
                 events = 0
-                if event_mask & ~select.EPOLLIN:
+                if event_mask & ~(select.EPOLLIN | _EPOLLRDHUP):
                     events |= EVENT_WRITE
                 if event_mask & ~select.EPOLLOUT:
                     events |= EVENT_READ
 
                 key = self._key_from_fd(fd)
                 if key:
+                    if key.events & _EXTENDED_EVENTS:
+                        events |= _epoll_extended_events(event_mask)
                     ready.append((key, events & key.events))
+                    if oneshot and fd in oneshot:
+                        self._fired.append(fd)
             return ready
 
         def close(self):
             self._epoll.close()
+            self._oneshot.clear()
+            del self._fired[:]
+            self._exclusive.clear()
             super(EpollSelector, self).close()
 
     __all__.append('EpollSelector')
@@ -500,18 +1312,14 @@ if hasattr(select, "devpoll"):
         def __init__(self):
             super(DevpollSelector, self).__init__()
             self._devpoll = select.devpoll()
+            self._poll_func = self._devpoll.poll
 
         def fileno(self):
             return self._devpoll.fileno()
 
         def register(self, fileobj, events, data=None):
             key = super(DevpollSelector, self).register(fileobj, events, data)
-            poll_events = 0
-            if events & EVENT_READ:
-                poll_events |= select.POLLIN
-            if events & EVENT_WRITE:
-                poll_events |= select.POLLOUT
-            self._devpoll.register(key.fd, poll_events)
+            self._devpoll.register(key.fd, _poll_event_mask(events))
             return key
 
         def unregister(self, fileobj):
@@ -519,6 +1327,13 @@ if hasattr(select, "devpoll"):
             self._devpoll.unregister(key.fd)
             return key
 
+        def _suspend(self, key):
+            super(DevpollSelector, self)._suspend(key)
+            self._devpoll.unregister(key.fd)
+
+        def _rearm(self, key):
+            self._devpoll.register(key.fd, _poll_event_mask(key.events))
+
         def _wrap_poll(self, timeout=None):
             """ Wrapper function for select.poll.poll() so that
             _syscall_wrapper can work with only seconds. """
@@ -528,23 +1343,35 @@ if hasattr(select, "devpoll"):
                 else:
                     # select.devpoll.poll() has a resolution of 1 millisecond,
                     # round away from zero to wait *at least* timeout seconds.
-                    timeout = math.ceil(timeout * 1000)
+                    timeout = int(-(-timeout * 1000 // 1))
 
-            result = self._devpoll.poll(timeout)
+            result = self._poll_func(timeout)
             return result
 
         def select(self, timeout=None):
             ready = []
-            fd_events = _syscall_wrapper(self._wrap_poll, True, timeout=timeout)
+            if _SYSCALL_RETRIES_EINTR:
+                if timeout is not None:
+                    timeout = 0 if timeout <= 0 else int(-(-timeout * 1000 // 1))
+                fd_events = self._poll_func(timeout)
+            else:
+                fd_events = _syscall_wrapper(self._wrap_poll, True, timeout=timeout,
+                                             stats=self._stats)
             for fd, event_mask in fd_events:
                 events = 0
-                if event_mask & ~select.POLLIN:
+                if event_mask & ~(select.POLLIN | _POLLRDHUP):
                     events |= EVENT_WRITE
                 if event_mask & ~select.POLLOUT:
                     events |= EVENT_READ
 
                 key = self._key_from_fd(fd)
                 if key:
+                    if event_mask & select.POLLNVAL and self._stale_handler is not None:
+                        # The file descriptor was closed without being unregistered.
+                        self._prune_keys([key])
+                        continue
+                    if key.events & _EXTENDED_EVENTS:
+                        events |= _poll_extended_events(event_mask)
                     ready.append((key, events & key.events))
 
             return ready
@@ -562,6 +1389,7 @@ if hasattr(select, "kqueue"):
         def __init__(self):
             super(KqueueSelector, self).__init__()
             self._kqueue = select.kqueue()
+            self._control_func = self._kqueue.control
 
         def fileno(self):
             return self._kqueue.fileno()
@@ -605,6 +1433,25 @@ if hasattr(select, "kqueue"):
 
             return key
 
+        def _suspend(self, key):
+            super(KqueueSelector, self)._suspend(key)
+            self._control_filters(key, select.KQ_EV_DELETE)
+
+        def _rearm(self, key):
+            self._control_filters(key, select.KQ_EV_ADD)
+
+        def _control_filters(self, key, flags):
+            """ Applies flags to the read and write filters of a key. """
+            for event, kq_filter in ((EVENT_READ, select.KQ_FILTER_READ),
+                                     (EVENT_WRITE, select.KQ_FILTER_WRITE)):
+                if key.events & event:
+                    kevent = select.kevent(key.fd, kq_filter, flags)
+                    try:
+                        _syscall_wrapper(self._wrap_control, False, [kevent], 0, 0)
+                    except _ERROR_TYPES:
+                        if flags != select.KQ_EV_DELETE:
+                            raise
+
         def select(self, timeout=None):
             if timeout is not None:
                 timeout = max(timeout, 0)
@@ -612,8 +1459,12 @@ if hasattr(select, "kqueue"):
             max_events = len(self._fd_to_key) * 2
             ready_fds = {}
 
-            kevent_list = _syscall_wrapper(self._wrap_control, True,
-                                           None, max_events, timeout=timeout)
+            if _SYSCALL_RETRIES_EINTR:
+                kevent_list = self._control_func(None, max_events, timeout)
+            else:
+                kevent_list = _syscall_wrapper(self._wrap_control, True,
+                                               None, max_events, timeout=timeout,
+                                               stats=self._stats)
 
             for kevent in kevent_list:
                 fd = kevent.ident
@@ -626,6 +1477,20 @@ if hasattr(select, "kqueue"):
 
                 key = self._key_from_fd(fd)
                 if key:
+                    if key.events & _EXTENDED_EVENTS and kevent.flags & select.KQ_EV_EOF:
+                        # The read filter sees EOF when the peer shuts down
+                        # writing and the write filter when the connection
+                        # is closed. Without a write filter the read filter
+                        # is the only one to report a hang-up at all.
+                        # fflags holds any pending socket error.
+                        if event_mask == select.KQ_FILTER_READ:
+                            events |= EVENT_RDHUP
+                            if not key.events & EVENT_WRITE:
+                                events |= EVENT_HUP
+                        else:
+                            events |= EVENT_HUP
+                        if kevent.fflags:
+                            events |= EVENT_ERROR
                     if key.fd not in ready_fds:
                         ready_fds[key.fd] = (key, events & key.events)
                     else:
@@ -639,41 +1504,25 @@ if hasattr(select, "kqueue"):
             super(KqueueSelector, self).close()
 
         def _wrap_control(self, changelist, max_events, timeout):
-            return self._kqueue.control(changelist, max_events, timeout)
+            return self._control_func(changelist, max_events, timeout)
 
     __all__.append('KqueueSelector')
 
 
-def _can_allocate(struct):
-    """ Checks that select structs can be allocated by the underlying
-    operating system, not just advertised by the select module. We don't
-    check select() because we'll be hopeful that most platforms that
-    don't have it available will not advertise it. (ie: GAE) """
-    try:
-        # select.poll() objects won't fail until used.
-        if struct == 'poll':
-            p = select.poll()
-            p.poll(0)
-
-        # All others will fail on allocation.
-        else:
-            getattr(select, struct)().close()
-        return True
-    except (OSError, AttributeError):
-        return False
-
-
 # Python 3.5 uses a more direct route to wrap system calls to increase speed.
-if sys.version_info >= (3, 5):
+if _SYSCALL_RETRIES_EINTR:
     def _syscall_wrapper(func, _, *args, **kwargs):
         """ This is the short-circuit version of the below logic
         because in Python 3.5+ all selectors restart system calls. """
+        kwargs.pop('stats', None)
         return func(*args, **kwargs)
 else:
     def _syscall_wrapper(func, recalc_timeout, *args, **kwargs):
         """ Wrapper function for syscalls that could fail due to EINTR.
         All functions should be retried if there is time left in the timeout
-        in accordance with PEP 475. """
+        in accordance with PEP 475. Retries are counted in the SelectorStats
+        passed as 'stats', which isn't passed on to func. """
+        stats = kwargs.pop('stats', None)
         timeout = kwargs.get("timeout", None)
         if timeout is None:
             expires = None
@@ -710,6 +1559,8 @@ else:
                                                            errcode == errno.WSAEINTR))
 
                 if is_interrupt:
+                    if stats is not None:
+                        stats.eintr_retries += 1
                     if expires is not None:
                         current_time = monotonic()
                         if current_time > expires:
@@ -724,24 +1575,1899 @@ else:
 # Choose the best implementation, roughly:
 # kqueue == devpoll == epoll > poll > select
 # select() also can't accept a FD > FD_SETSIZE (usually around 1024)
+_SELECTOR_PREFERENCE = (('kqueue', 'KqueueSelector'),
+                        ('devpoll', 'DevpollSelector'),
+                        ('epoll', 'EpollSelector'),
+                        ('poll', 'PollSelector'))
+
+
+def _pinned_selector(name):
+    """ Return the selector class named by the SELECTORS2_DEFAULT_SELECTOR
+    environment variable. Accepts either the name of the select function
+    (ie: 'epoll') or the name of the class (ie: 'EpollSelector'). """
+    lowered = name.lower()
+    for select_name, selector_name in _SELECTOR_PREFERENCE + (('select', 'SelectSelector'),):
+        if lowered in (select_name, selector_name.lower()) and selector_name in globals():
+            return globals()[selector_name]
+    raise RuntimeError("Selector {0!r} from SELECTORS2_DEFAULT_SELECTOR is not "
+                       "available on this platform.".format(name))
+
+
+def _try_selector(select_name, selector_class):
+    """ Returns an instance of the selector if it can be allocated
+    and used by the underlying operating system, not just advertised
+    by the select module. The instance is handed back to the caller
+    rather than being closed so detection doesn't allocate anything extra. """
+    try:
+        selector = selector_class()
+    except (OSError, IOError, AttributeError):
+        return None
+
+    # select.poll() objects won't fail until used.
+    if select_name == 'poll':
+        try:
+            selector.select(0)
+        except (OSError, IOError, AttributeError):
+            selector.close()
+            return None
+    return selector
+
+
 def DefaultSelector():
     """ This function serves as a first call for DefaultSelector to
     detect if the select module is being monkey-patched incorrectly
-    by eventlet, greenlet, and preserve proper behavior. """
+    by eventlet, greenlet, and preserve proper behavior. The selector
+    can be pinned with the SELECTORS2_DEFAULT_SELECTOR environment
+    variable to skip detection entirely. """
     global _DEFAULT_SELECTOR
     if _DEFAULT_SELECTOR is None:
-        if platform.python_implementation() == 'Jython':  # Platform-specific: Jython
+        pinned = os.environ.get('SELECTORS2_DEFAULT_SELECTOR')
+        if pinned:
+            _DEFAULT_SELECTOR = _pinned_selector(pinned)
+        elif _IS_JYTHON:  # Platform-specific: Jython
             _DEFAULT_SELECTOR = JythonSelectSelector
-        elif _can_allocate('kqueue'):
-            _DEFAULT_SELECTOR = KqueueSelector
-        elif _can_allocate('devpoll'):
-            _DEFAULT_SELECTOR = DevpollSelector
-        elif _can_allocate('epoll'):
-            _DEFAULT_SELECTOR = EpollSelector
-        elif _can_allocate('poll'):
-            _DEFAULT_SELECTOR = PollSelector
-        elif hasattr(select, 'select'):
-            _DEFAULT_SELECTOR = SelectSelector
-        else:  # Platform-specific: AppEngine
-            raise RuntimeError('Platform does not have a selector.')
+        else:
+            for select_name, selector_name in _SELECTOR_PREFERENCE:
+                if not hasattr(select, select_name) or selector_name not in globals():
+                    continue
+                selector = _try_selector(select_name, globals()[selector_name])
+                if selector is not None:
+                    _DEFAULT_SELECTOR = type(selector)
+                    return selector
+            if hasattr(select, 'select'):
+                _DEFAULT_SELECTOR = SelectSelector
+            else:  # Platform-specific: AppEngine
+                raise RuntimeError('Platform does not have a selector.')
     return _DEFAULT_SELECTOR()
+
+
+_SELECTOR_CACHE = None
+_SELECTOR_CACHE_PID = None
+
+
+def _reset_selector_cache():
+    """ Closes this thread's cached selector and forgets the cache. Called
+    after a fork() so that a child process never shares a kernel selector
+    object (ie: epoll) with its parent. Only the thread that called fork()
+    survives in the child so only its selector needs to be closed. """
+    global _SELECTOR_CACHE
+    cache, _SELECTOR_CACHE = _SELECTOR_CACHE, None
+    selector = getattr(cache, 'selector', None)
+    if selector is not None:
+        cache.selector = None
+        try:
+            selector.close()
+        except _ERROR_TYPES:
+            pass
+
+
+def _new_selector_cache():
+    """ Creates the thread-local storage used by borrow_selector(). """
+    global _SELECTOR_CACHE, _SELECTOR_CACHE_PID
+    _reset_selector_cache()
+    import threading
+    _SELECTOR_CACHE = threading.local()
+    _SELECTOR_CACHE_PID = os.getpid()
+    return _SELECTOR_CACHE
+
+
+# Python 3.7+ can tell us when the process forks so we
+# don't need to check the process ID on every borrow.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_selector_cache)
+
+    def _selector_cache():
+        cache = _SELECTOR_CACHE
+        if cache is None:
+            cache = _new_selector_cache()
+        return cache
+else:
+    def _selector_cache():
+        if _SELECTOR_CACHE_PID != os.getpid():
+            return _new_selector_cache()
+        return _SELECTOR_CACHE
+
+
+class _SelectorLoan(object):
+    """ Context manager returned by borrow_selector() """
+    __slots__ = ('_cache', '_selector')
+
+    def __enter__(self):
+        cache = self._cache = _selector_cache()
+        selector = getattr(cache, 'selector', None)
+        if selector is None:
+            selector = DefaultSelector()
+        else:
+            cache.selector = None
+        self._selector = selector
+        return selector
+
+    def __exit__(self, *_):
+        selector = self._selector
+        self._selector = None
+        if selector.get_map() is None:
+            return  # Closed by the borrower.
+
+        # Instrumentation and pruning only apply to this borrow. They are
+        # turned off before unregistering so that isn't recorded either.
+        if 'select' in selector.__dict__ or selector._stale_handler is not None:
+            selector.set_stall_handler(None)
+            selector.enable_stats(False)
+            selector.record_trace(None)
+            selector.enable_pruning(False)
+
+        fd_to_key = selector._fd_to_key
+        if fd_to_key:
+            try:
+                for fd in list(fd_to_key):
+                    selector.unregister(fd)
+            except (KeyError, ValueError) + _ERROR_TYPES:
+                selector.close()
+                return
+
+        # Jython selectors don't track registrations by fd so can't be cleared.
+        # A selector borrowed across a fork() belongs to the parent process.
+        cache = self._cache
+        if _IS_JYTHON or cache is not _selector_cache() or \
+                getattr(cache, 'selector', None) is not None:
+            selector.close()
+        else:
+            cache.selector = selector
+
+
+def borrow_selector():
+    """ Returns a context manager that lends out a DefaultSelector that
+    is cached per-thread and per-process. Everything registered while the
+    selector is borrowed is unregistered when it's given back so the same
+    underlying selector object can be reused for the next wait instead of
+    being allocated and closed each time. Nested borrows within a thread
+    get a separate selector. """
+    return _SelectorLoan()
+
+
+# select() can't accept a file descriptor larger than FD_SETSIZE.
+# Python doesn't expose the value but it's 1024 on every POSIX
+# platform we support. Windows doesn't have this limitation.
+_FD_SETSIZE = 1024
+
+
+def _select_once(readers, writers, timeout):
+    """ Calls select.select() once, retrying on interrupts for
+    Python versions that don't implement PEP 475. """
+    if _SYSCALL_RETRIES_EINTR:
+        r, w, _ = select.select(readers, writers, [], timeout)
+    else:
+        def _wrap_select(timeout=None):
+            return select.select(readers, writers, [], timeout)
+        r, w, _ = _syscall_wrapper(_wrap_select, True, timeout=timeout)
+    return r, w
+
+
+def _poll_once(poller, timeout):
+    """ Calls poll() once on a select.poll() object with a timeout
+    in seconds, retrying on interrupts for Python versions that
+    don't implement PEP 475. """
+    def _wrap_poll(timeout=None):
+        if timeout is not None:
+            # select.poll.poll() has a resolution of 1 millisecond,
+            # round away from zero to wait *at least* timeout seconds.
+            timeout = int(-(-timeout * 1000 // 1))
+        return poller.poll(timeout)
+
+    if _SYSCALL_RETRIES_EINTR:
+        return _wrap_poll(timeout)
+    return _syscall_wrapper(_wrap_poll, True, timeout=timeout)
+
+
+def _error_errno(error):
+    """ Returns the errno of an error raised by a system call. select.error
+    wasn't a subclass of OSError in the past and only has args. """
+    if getattr(error, 'errno', None) is not None:
+        return error.errno
+    return error.args[0] if error.args else None
+
+
+def _closed_fds(fds):
+    """ Returns the file descriptors in fds which aren't open """
+    closed = []
+    for start in range(0, len(fds), _PRUNE_BATCH_SIZE):
+        batch = fds[start:start + _PRUNE_BATCH_SIZE]
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in batch:
+                poller.register(fd, 0)
+            closed.extend(fd for fd, event_mask in _poll_once(poller, 0)
+                          if event_mask & select.POLLNVAL)
+        elif hasattr(select, 'select'):
+            closed.extend(_bisect_closed_fds(batch))
+        else:
+            closed.extend(fd for fd in batch if not _fd_is_open(fd))
+    return closed
+
+
+def _fd_is_open(fd):
+    try:
+        os.fstat(fd)
+    except _ERROR_TYPES as e:
+        if e.errno == errno.EBADF:
+            return False
+    return True
+
+
+def _bisect_closed_fds(fds):
+    """ Finds the closed file descriptors in fds by splitting them in half
+    until select.select() stops failing with EBADF. Checking n file
+    descriptors with k closed takes O(k * log(n)) system calls. """
+    try:
+        _select_once(fds, [], 0)
+    except (OSError, IOError, select.error) as e:
+        if _error_errno(e) not in _BAD_FD_ERRNOS:
+            raise
+        if len(fds) == 1:
+            return list(fds)
+        middle = len(fds) // 2
+        return _bisect_closed_fds(fds[:middle]) + _bisect_closed_fds(fds[middle:])
+    return []
+
+
+def _poll_event_mask(events):
+    """ Converts selector events into a select.poll() event mask """
+    event_mask = 0
+    if events & EVENT_READ:
+        event_mask |= select.POLLIN
+    if events & EVENT_WRITE:
+        event_mask |= select.POLLOUT
+    if events & EVENT_RDHUP:
+        event_mask |= _POLLRDHUP
+    return event_mask
+
+
+def _poll_extended_events(event_mask):
+    """ Converts a select.poll() event mask into the opt-in selector events """
+    events = 0
+    if event_mask & select.POLLHUP:
+        events |= EVENT_HUP
+    if event_mask & select.POLLERR:
+        events |= EVENT_ERROR
+    if event_mask & _POLLRDHUP:
+        events |= EVENT_RDHUP
+    return events
+
+
+def _epoll_event_mask(events):
+    """ Converts selector events into a select.epoll() event mask """
+    event_mask = 0
+    if events & EVENT_READ:
+        event_mask |= select.EPOLLIN
+    if events & EVENT_WRITE:
+        event_mask |= select.EPOLLOUT
+    if events & EVENT_RDHUP:
+        event_mask |= _EPOLLRDHUP
+    return event_mask
+
+
+def _epoll_exclusive_supported():
+    """ Returns True if the kernel supports EPOLLEXCLUSIVE (Linux 4.5+) """
+    global _EPOLLEXCLUSIVE_SUPPORTED
+    if _EPOLLEXCLUSIVE_SUPPORTED is None:
+        try:
+            release = os.uname()[2]
+            version = tuple(int(part) for part in release.split('-')[0].split('.')[:2])
+            _EPOLLEXCLUSIVE_SUPPORTED = version >= (4, 5)
+        except (AttributeError, ValueError):
+            _EPOLLEXCLUSIVE_SUPPORTED = False
+    return _EPOLLEXCLUSIVE_SUPPORTED
+
+
+def _epoll_extended_events(event_mask):
+    """ Converts a select.epoll() event mask into the opt-in selector events """
+    events = 0
+    if event_mask & select.EPOLLHUP:
+        events |= EVENT_HUP
+    if event_mask & select.EPOLLERR:
+        events |= EVENT_ERROR
+    if event_mask & _EPOLLRDHUP:
+        events |= EVENT_RDHUP
+    return events
+
+
+def _poll_ready_events(event_mask):
+    """ Converts a select.poll() event mask into selector events """
+    events = 0
+    if event_mask & ~select.POLLIN:
+        events |= EVENT_WRITE
+    if event_mask & ~select.POLLOUT:
+        events |= EVENT_READ
+    return events
+
+
+def _wait_for_select(fd, events, timeout):
+    """ Waits on a single file descriptor with select.select() """
+    r, w = _select_once([fd] if events & EVENT_READ else [],
+                        [fd] if events & EVENT_WRITE else [],
+                        timeout)
+    ready = 0
+    if r:
+        ready |= EVENT_READ
+    if w:
+        ready |= EVENT_WRITE
+    return ready
+
+
+def _wait_for_poll(fd, events, timeout):
+    """ Waits on a single file descriptor with select.poll() """
+    poller = select.poll()
+    poller.register(fd, _poll_event_mask(events))
+    ready = 0
+    for _, event_mask in _poll_once(poller, timeout):
+        ready |= _poll_ready_events(event_mask)
+    return ready & events
+
+
+def wait_for(fileobj, events, timeout=None):
+    """ Waits for a single file object to become ready for a set of events
+    without allocating and registering with a selector. Returns the events
+    which are ready or 0 if the timeout expired. Uses select() for file
+    descriptors below FD_SETSIZE and otherwise falls back to poll(). """
+    if (not events) or (events & ~(EVENT_READ | EVENT_WRITE)):
+        raise ValueError("Invalid events: {0!r}".format(events))
+    if timeout is not None and timeout < 0:
+        timeout = 0
+
+    # Jython's select.select() only accepts socket objects.
+    if _IS_JYTHON:  # Platform-specific: Jython
+        return _wait_for_select(fileobj, events, timeout)
+
+    fd = _fileobj_to_fd(fileobj)
+    if hasattr(select, 'select') and (fd < _FD_SETSIZE or sys.platform == 'win32'):
+        return _wait_for_select(fd, events, timeout)
+    elif hasattr(select, 'poll'):
+        return _wait_for_poll(fd, events, timeout)
+    elif hasattr(select, 'select'):
+        raise ValueError("File descriptor {0} is too large for select()".format(fd))
+    else:  # Platform-specific: AppEngine
+        raise RuntimeError('Platform does not have a selector.')
+
+
+def wait_for_read(fileobj, timeout=None):
+    """ Waits for a file object to be readable. Returns True
+    if the file object is readable and False on timeout. """
+    return bool(wait_for(fileobj, EVENT_READ, timeout))
+
+
+def wait_for_write(fileobj, timeout=None):
+    """ Waits for a file object to be writable. Returns True
+    if the file object is writable and False on timeout. """
+    return bool(wait_for(fileobj, EVENT_WRITE, timeout))
+
+
+def wait_for_any(fileobjs, timeout=None):
+    """ Waits once for any of a mapping of file objects to events without
+    creating a selector. This is useful for waiting on a small set of file
+    objects that changes between waits. Returns a list of (key, events)
+    tuples the same as BaseSelector.select() where each key is a SelectorKey
+    with data set to None. Uses a single poll() call when available and
+    otherwise select(). Returns immediately if the mapping is empty. """
+    keys = {}
+    for fileobj, events in fileobjs.items():
+        if (not events) or (events & ~(EVENT_READ | EVENT_WRITE)):
+            raise ValueError("Invalid events: {0!r}".format(events))
+
+        # Jython's select.select() only accepts socket objects.
+        if _IS_JYTHON:  # Platform-specific: Jython
+            handle, fd = fileobj, -1
+        else:
+            handle = fd = _fileobj_to_fd(fileobj)
+        if handle in keys:
+            raise KeyError("{0!r} (FD {1}) is already registered".format(fileobj, fd))
+        keys[handle] = SelectorKey(fileobj, fd, events, None)
+
+    if not keys:
+        return []
+    if timeout is not None and timeout < 0:
+        timeout = 0
+
+    ready = []
+    if hasattr(select, 'poll') and not _IS_JYTHON:
+        poller = select.poll()
+        for key in keys.values():
+            poller.register(key.fd, _poll_event_mask(key.events))
+        for fd, event_mask in _poll_once(poller, timeout):
+            key = keys[fd]
+            ready.append((key, _poll_ready_events(event_mask) & key.events))
+
+    elif hasattr(select, 'select'):
+        readers = []
+        writers = []
+        for handle, key in keys.items():
+            if key.fd >= _FD_SETSIZE and sys.platform != 'win32':
+                raise ValueError("File descriptor {0} is too large for select()".format(key.fd))
+            if key.events & EVENT_READ:
+                readers.append(handle)
+            if key.events & EVENT_WRITE:
+                writers.append(handle)
+        r, w = _select_once(readers, writers, timeout)
+        r = set(r)
+        w = set(w)
+        for handle in r | w:
+            events = 0
+            if handle in r:
+                events |= EVENT_READ
+            if handle in w:
+                events |= EVENT_WRITE
+            ready.append((keys[handle], events))
+
+    else:  # Platform-specific: AppEngine
+        raise RuntimeError('Platform does not have a selector.')
+    return ready
+
+
+class Dispatcher(object):
+    """ Runs the callbacks stored in SelectorKey.data when file objects
+    registered with a selector become ready. Callbacks are called with
+    the key and the ready events::
+
+        def on_readable(key, events):
+            data = key.fileobj.recv(4096)
+
+        selector.register(sock, EVENT_READ, on_readable)
+        Dispatcher(selector).run_forever()
+
+    Exceptions raised by callbacks don't stop the rest of the ready
+    callbacks from running. After each batch of callbacks the errors are
+    passed to error_handler(key, events, error) if one was given and
+    otherwise the first error is raised.
+
+    If an executor (ie: concurrent.futures.ThreadPoolExecutor) is given
+    callbacks are submitted to it instead of being run inline. While a
+    callback is running its file object is suspended in the selector and
+    it's re-armed with modify() once the callback completes. Callbacks
+    running in an executor must not use the selector themselves. """
+
+    def __init__(self, selector, error_handler=None, executor=None):
+        self.selector = selector
+        self.error_handler = error_handler
+        self.executor = executor
+        self._stopping = False
+
+        # Callbacks completed by the executor waiting to be re-armed
+        # and the socket pair used to wake up the selector for them.
+        self._completed = None
+        self._waker = None
+        self._in_flight = 0
+        if executor is not None:
+            self._completed = deque()
+            self._waker = _socketpair()
+            for sock in self._waker:
+                sock.setblocking(False)
+            selector.register(self._waker[0], EVENT_READ)
+
+    def stop(self):
+        """ Stops run_forever() after the current batch of callbacks.
+        Can be called from a callback or a signal handler. """
+        self._stopping = True
+
+    def close(self):
+        """ Releases the resources used for running callbacks in an executor.
+        Doesn't wait for callbacks that are still running. """
+        if self._waker is not None:
+            self.selector.unregister(self._waker[0])
+            for sock in self._waker:
+                sock.close()
+            self._waker = None
+
+    def run_once(self, timeout=None):
+        """ Waits once for file objects to be ready and runs their
+        callbacks. Returns the number of callbacks that were run
+        or submitted to the executor. """
+        ready = self.selector.select(timeout)
+        if self.executor is not None:
+            return self._submit(ready)
+
+        errors = None
+        for key, events in ready:
+            try:
+                key.data(key, events)
+            except Exception as e:
+                if errors is None:
+                    errors = []
+                errors.append((key, events, e))
+        if errors is not None:
+            self._handle_errors(errors)
+        return len(ready)
+
+    def run_forever(self, timeout=None):
+        """ Runs callbacks until stop() is called, until timeout seconds
+        have passed or until no file objects are registered and no
+        callbacks are running. Returns the number of callbacks that were
+        run or submitted to the executor. """
+        self._stopping = False
+        expires = None if timeout is None else monotonic() + max(timeout, 0.0)
+        run_once = self.run_once
+        selector_map = self.selector.get_map()
+        internal = 0 if self._waker is None else 1
+        dispatched = 0
+        while not self._stopping and (len(selector_map) > internal or self._in_flight):
+            if expires is None:
+                dispatched += run_once(None)
+            else:
+                remaining = expires - monotonic()
+                if remaining <= 0:
+                    break
+                dispatched += run_once(remaining)
+        self._stopping = False
+        return dispatched
+
+    def _submit(self, ready):
+        """ Suspends each ready key and submits its callback to the executor. """
+        waker = self._waker[0]
+        suspend = self.selector._suspend
+        submit = self.executor.submit
+        complete = self._complete
+        errors = None
+        submitted = 0
+        for key, events in ready:
+            if key.fileobj is waker:
+                errors = self._rearm_completed()
+                continue
+            suspend(key)
+            future = submit(key.data, key, events)
+            future.add_done_callback(lambda future, key=key, events=events:
+                                     complete(key, events, future))
+            self._in_flight += 1
+            submitted += 1
+        if errors:
+            self._handle_errors(errors)
+        return submitted
+
+    def _complete(self, key, events, future):
+        """ Called from the executor when a callback completes. """
+        self._completed.append((key, events, future))
+        waker = self._waker
+        if waker is not None:
+            try:
+                waker[1].send(b'\x00')
+            except _ERROR_TYPES:
+                # A wake up is already pending or the Dispatcher was closed.
+                pass
+
+    def _rearm_completed(self):
+        """ Re-arms the keys whose callbacks have completed and
+        returns the errors raised by those callbacks. """
+        try:
+            while self._waker[0].recv(4096):
+                pass
+        except _ERROR_TYPES:
+            pass
+
+        errors = []
+        selector = self.selector
+        completed = self._completed
+        while completed:
+            key, events, future = completed.popleft()
+            self._in_flight -= 1
+            error = None if future.cancelled() else future.exception()
+            if error is not None:
+                errors.append((key, events, error))
+
+            # The callback may have unregistered or closed the file object.
+            current = selector._key_from_fd(key.fd)
+            if current is None or current.fileobj is not key.fileobj:
+                continue
+            if _fileobj_is_stale(current):
+                try:
+                    selector.unregister(current.fd)
+                except _ERROR_TYPES:
+                    # The underlying selector may fail on a closed file
+                    # descriptor after the key has been removed.
+                    pass
+                continue
+            try:
+                selector.modify(current.fileobj, current.events, current.data)
+            except (ValueError,) + _ERROR_TYPES as e:
+                selector.unregister(current.fileobj)
+                errors.append((key, events, e))
+        return errors
+
+    def _handle_errors(self, errors):
+        if self.error_handler is None:
+            raise errors[0][2]
+        for key, events, error in errors:
+            self.error_handler(key, events, error)
+
+
+def _ssl_would_block(error):
+    """ Returns True if error is raised by an ssl.SSLSocket which can't
+    send or receive without blocking, its equivalent of EAGAIN. """
+    ssl = sys.modules.get('ssl')
+    if ssl is None:
+        return False
+    return isinstance(error, (getattr(ssl, 'SSLWantReadError', ()),
+                              getattr(ssl, 'SSLWantWriteError', ())))
+
+
+class BufferedWriter(object):
+    """ Buffers data written to a non-blocking socket registered with a
+    selector. Data is sent right away while the socket accepts it and the
+    rest is queued, in which case EVENT_WRITE is added to the registration
+    until flush() has sent the whole queue. The registration is only
+    modified when the queue goes from empty to non-empty and back. A socket
+    that isn't registered is registered with data while the queue isn't
+    empty. The queue holds memoryviews of the written objects so they must
+    not be modified until they're sent::
+
+        writer = BufferedWriter(selector, sock, on_ready)
+
+        def on_ready(key, events):
+            if events & EVENT_WRITE:
+                writer.flush()
+
+    Queued buffers are sent together with sendmsg() where it's available,
+    sockets like ssl.SSLSocket whose sendmsg() raises NotImplementedError
+    send one buffer at a time. Errors other than EAGAIN, and SSLWantReadError
+    or SSLWantWriteError, are raised from write() and flush(). """
+
+    def __init__(self, selector, fileobj, data=None):
+        self.selector = selector
+        self.fileobj = fileobj
+        self.data = data
+        self.buffered = 0  # Bytes in the queue
+        self._buffers = deque()
+        self._sendmsg = getattr(fileobj, 'sendmsg', None)
+        self._max_buffers = _iov_max() if self._sendmsg is not None else 1
+
+    def write(self, data):
+        """ Sends or queues data and returns the number of bytes queued """
+        view = _memoryview(data)
+        if getattr(view, 'itemsize', 1) != 1:
+            view = _memoryview(view.tobytes())
+        if not len(view):
+            return self.buffered
+        if self._buffers:
+            self._buffers.append(view)
+            self.buffered += len(view)
+            return self.buffered
+
+        sent = self._send([view])
+        if sent < len(view):
+            self._buffers.append(view[sent:])
+            self.buffered = len(view) - sent
+            self._set_writing(True)
+        return self.buffered
+
+    def flush(self):
+        """ Sends queued data until the socket stops accepting it, to be
+        called when the socket is writable. Removes EVENT_WRITE once the
+        queue is empty. Returns the number of bytes still queued. """
+        buffers = self._buffers
+        while buffers:
+            batch = [buffers[i] for i in range(min(len(buffers), self._max_buffers))]
+            sent = self._send(batch)
+            self.buffered -= sent
+            full = sent < sum(len(view) for view in batch)
+            while sent:
+                first = buffers[0]
+                if sent < len(first):
+                    buffers[0] = first[sent:]
+                    break
+                sent -= len(first)
+                buffers.popleft()
+            if full:
+                # The socket's send buffer is full.
+                break
+        if not buffers:
+            self._set_writing(False)
+        return self.buffered
+
+    def _send(self, batch):
+        try:
+            if len(batch) > 1:
+                try:
+                    return self._sendmsg(batch)
+                except NotImplementedError:
+                    self._sendmsg = None
+                    self._max_buffers = 1
+            return self.fileobj.send(batch[0])
+        except _ERROR_TYPES as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) or \
+                    _ssl_would_block(e):
+                return 0
+            raise
+
+    def _set_writing(self, writing):
+        """ Adds or removes EVENT_WRITE from the registration """
+        try:
+            key = self.selector.get_key(self.fileobj)
+        except KeyError:
+            key = None
+        if writing:
+            if key is None:
+                self.selector.register(self.fileobj, EVENT_WRITE, self.data)
+            elif not key.events & EVENT_WRITE:
+                self.selector.modify(self.fileobj, key.events | EVENT_WRITE, key.data)
+        elif key is not None and key.events & EVENT_WRITE:
+            events = key.events & ~EVENT_WRITE
+            if events:
+                self.selector.modify(self.fileobj, events, key.data)
+            else:
+                self.selector.unregister(self.fileobj)
+
+
+class BufferPool(object):
+    """ Receives data from sockets into a pool of preallocated bytearrays
+    with recv_into() instead of allocating a new bytes object for every
+    recv(). Data is returned as a memoryview of part of a bytearray which
+    must be passed to release() when the handler is done with it so the
+    bytearray can be reused. Neither the view nor anything sliced from it
+    may be used after it's released::
+
+        pool = BufferPool()
+        for key, events, data in pool.recv_ready(selector.select()):
+            if data is not None:
+                handle(key, data)
+                pool.release(data)
+
+    Up to 'buffers' bytearrays of 'buffer_size' bytes are kept. More are
+    allocated while all of them are in use and dropped when released once
+    the pool is full again. 'allocated' counts the bytearrays allocated. """
+
+    def __init__(self, buffer_size=65536, buffers=16):
+        self.buffer_size = buffer_size
+        self.buffers = buffers
+        self.allocated = buffers
+        # Free buffers are kept as views of the whole bytearray so each
+        # recv() only has to slice one, _views finds them again on release.
+        self._views = dict((id(buffer), _memoryview(buffer))
+                           for buffer in [bytearray(buffer_size) for _ in range(buffers)])
+        self._free = list(self._views.values())
+
+    def recv(self, sock, size=0):
+        """ Receives up to size bytes, or buffer_size if size is 0, from
+        sock. Returns an empty view when the peer has closed the connection
+        and None if the socket isn't readable. Other errors are raised. """
+        free = self._free
+        if free:
+            view = free.pop()
+        else:
+            view = _memoryview(bytearray(self.buffer_size))
+            self.allocated += 1
+        try:
+            received = sock.recv_into(view, size)
+        except _ERROR_TYPES as e:
+            free.append(view)
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+        if not received:
+            free.append(view)
+            return _memoryview(b'')
+        return view[:received]
+
+    def recv_ready(self, ready):
+        """ Yields (key, events, data) for each (key, events) tuple returned
+        by select() where data is the result of recv() for file objects that
+        are ready for EVENT_READ and None otherwise. """
+        recv = self.recv
+        for key, events in ready:
+            yield key, events, recv(key.fileobj) if events & EVENT_READ else None
+
+    def release(self, data):
+        """ Returns the bytearray behind a view returned by recv() to the
+        pool. Views can only be released once. """
+        try:
+            buffer = data.obj
+        except AttributeError:
+            # Python 2.x memoryviews don't have 'obj' so nothing is reused.
+            return
+        data.release()
+        views = self._views
+        if len(self._free) >= self.buffers:
+            views.pop(id(buffer), None)
+            return
+        view = views.get(id(buffer))
+        if view is None:
+            if len(buffer) != self.buffer_size:
+                return
+            view = views[id(buffer)] = _memoryview(buffer)
+        self._free.append(view)
+
+
+class DatagramReader(object):
+    """ Drains queued datagrams from readable datagram sockets in one go
+    instead of one datagram per select(). Up to max_datagrams are received
+    with recvfrom_into() into a preallocated slab with a slot of max_size
+    bytes per datagram. Longer datagrams are truncated to max_size bytes,
+    or raise an error on Windows.
+    Datagrams are returned as a list of (memoryview, address) tuples which
+    refer to the slab so they're only valid until the next drain. Sockets
+    must be non-blocking, or blocking where MSG_DONTWAIT exists::
+
+        reader = DatagramReader()
+        for key, events, datagrams in reader.drain_ready(selector.select()):
+            for data, address in datagrams:
+                handle(data, address)
+    """
+
+    def __init__(self, max_datagrams=64, max_size=2048):
+        self.max_datagrams = max_datagrams
+        self.max_size = max_size
+        self._slab = bytearray(max_datagrams * max_size)
+        view = _memoryview(self._slab)
+        self._slots = [view[i * max_size:(i + 1) * max_size] for i in range(max_datagrams)]
+        import socket
+        self._dontwait = getattr(socket, 'MSG_DONTWAIT', 0)
+
+    def drain(self, sock):
+        """ Receives datagrams from sock until it would block or
+        max_datagrams have been received and returns them. Errors are
+        raised unless some datagrams were received before them. Raises
+        ValueError for sockets with a timeout, and for blocking sockets
+        where MSG_DONTWAIT doesn't exist, as they would wait for data. """
+        timeout = sock.gettimeout()
+        if timeout == 0.0:
+            flags = 0
+        elif timeout is None and self._dontwait:
+            flags = self._dontwait
+        else:
+            raise ValueError("{0!r} must be non-blocking".format(sock))
+        recvfrom_into = sock.recvfrom_into
+        datagrams = []
+        for slot in self._slots:
+            try:
+                size, address = recvfrom_into(slot, 0, flags)
+            except _ERROR_TYPES as e:
+                if datagrams or e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            datagrams.append((slot[:size], address))
+        return datagrams
+
+    def drain_ready(self, ready):
+        """ Yields (key, events, datagrams) for each (key, events) tuple
+        returned by select() where datagrams is the result of drain() for
+        file objects that are ready for EVENT_READ and an empty list
+        otherwise. Every batch reuses the same slab so handle each one
+        before advancing the generator, ie: list(drain_ready(ready))
+        leaves only the last batch's data in every view. """
+        for key, events in ready:
+            datagrams = []
+            if events & EVENT_READ:
+                datagrams = self.drain(key.fileobj)
+            yield key, events, datagrams
+
+
+class Relay(object):
+    """ Copies data in both directions between two connected sockets, ie:
+    for a proxy that doesn't look at the data. Both sockets are made
+    non-blocking and registered with the selector with a callback for
+    Dispatcher as their data. EVENT_READ is registered while the data read
+    from a socket has been written to the other one and EVENT_WRITE while
+    data is waiting to be written to a socket. When one socket reaches EOF
+    the other is shut down for writing once everything has been written.
+    The relay is closed when both sides are shut down or on an error which
+    is stored in 'error'. on_close(relay) is then called so the sockets
+    can be closed, they aren't closed by the relay::
+
+        relay = Relay(selector, client, upstream, on_close=close_sockets)
+        Dispatcher(selector).run_forever()
+
+    On Linux with Python 3.10+ data is moved with os.splice() through a
+    pipe so it's never copied into Python. Elsewhere, or if splice is
+    False, it's copied with recv_into() and send() through a buffer. """
+
+    def __init__(self, selector, a, b, buffer_size=65536, on_close=None, splice=None):
+        self.selector = selector
+        self.sockets = (a, b)
+        self.on_close = on_close
+        self.error = None
+        self.closed = False
+        if splice is None:
+            splice = hasattr(os, 'splice')
+        self._directions = (_RelayDirection(a, b, buffer_size, splice),
+                            _RelayDirection(b, a, buffer_size, splice))
+        self._events = [0, 0]
+        for sock in self.sockets:
+            sock.setblocking(False)
+        self._update()
+
+    def close(self):
+        """ Unregisters the sockets and releases the relay's buffers or
+        pipes. Calls on_close(relay) the first time it's called. """
+        if self.closed:
+            return
+        self.closed = True
+        for i, sock in enumerate(self.sockets):
+            if self._events[i]:
+                self.selector.unregister(sock)
+                self._events[i] = 0
+        for direction in self._directions:
+            direction.close()
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def _handle(self, key, events):
+        """ Callback stored in both keys' data """
+        if self.closed:
+            # Closed by the other socket's callback for the same select().
+            return
+        i = 0 if key.fileobj is self.sockets[0] else 1
+        try:
+            if events & EVENT_READ:
+                self._directions[i].read()
+            if events & EVENT_WRITE:
+                self._directions[1 - i].write()
+        except _ERROR_TYPES as e:
+            self.error = e
+            self.close()
+            return
+        if self._directions[0].done and self._directions[1].done:
+            self.close()
+        else:
+            self._update()
+
+    def _update(self):
+        """ Registers each socket for the events it's waiting for """
+        for i, sock in enumerate(self.sockets):
+            events = 0
+            if self._directions[i].reading:
+                events |= EVENT_READ
+            if self._directions[1 - i].pending:
+                events |= EVENT_WRITE
+            if events == self._events[i]:
+                continue
+            if not self._events[i]:
+                self.selector.register(sock, events, self._handle)
+            elif not events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, events, self._handle)
+            self._events[i] = events
+
+
+class _RelayDirection(object):
+    """ Moves data from one socket of a Relay to the other """
+
+    def __init__(self, source, sink, buffer_size, splice):
+        self.source = source
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.pending = 0  # Bytes read from source not yet written to sink
+        self.eof = False
+        self.done = False
+        self._pipe = None
+        self._buffer = None
+        self._offset = 0
+        if splice:
+            self._pipe = os.pipe()
+            for fd in self._pipe:
+                os.set_blocking(fd, False)
+            self._resize_pipe()
+            self._flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        else:
+            self._buffer = _memoryview(bytearray(buffer_size))
+
+    def _resize_pipe(self):
+        """ Pipes hold 64 KiB by default which limits how much one splice()
+        moves so they're grown to buffer_size where the kernel allows it. """
+        import fcntl
+        try:
+            fcntl.fcntl(self._pipe[1], fcntl.F_SETPIPE_SZ, self.buffer_size)
+        except (AttributeError,) + _ERROR_TYPES:
+            # Larger than /proc/sys/fs/pipe-max-size or not supported.
+            pass
+
+    @property
+    def reading(self):
+        return not self.eof and not self.pending
+
+    def read(self):
+        """ Reads once from source if everything read before was written
+        and then writes as much as sink accepts. """
+        if not self.reading:
+            return
+        try:
+            if self._pipe is not None:
+                read = os.splice(self.source.fileno(), self._pipe[1],
+                                 self.buffer_size, flags=self._flags)
+            else:
+                read = self.source.recv_into(self._buffer)
+                self._offset = 0
+        except _ERROR_TYPES as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if read:
+            self.pending = read
+        else:
+            self.eof = True
+        self.write()
+
+    def write(self):
+        """ Writes pending data to sink until it would block and shuts
+        sink down for writing after source reached EOF. """
+        while self.pending:
+            try:
+                if self._pipe is not None:
+                    written = os.splice(self._pipe[0], self.sink.fileno(),
+                                        self.pending, flags=self._flags)
+                else:
+                    written = self.sink.send(
+                        self._buffer[self._offset:self._offset + self.pending])
+                    self._offset += written
+            except _ERROR_TYPES as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.pending -= written
+        if self.eof and not self.done:
+            self.done = True
+            try:
+                self.sink.shutdown(_SHUT_WR)
+            except _ERROR_TYPES as e:
+                # The other side may have gone away already.
+                if e.errno != errno.ENOTCONN:
+                    raise
+
+    def close(self):
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+        self._buffer = None
+
+
+def handoff_channel():
+    """ Returns a (balancer end, worker end) pair of connected Unix
+    datagram sockets for handing off connections to a worker process with
+    HandoffBalancer and HandoffWorker. Create one per worker before forking
+    it and close the end the process doesn't use. """
+    import socket
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+
+class HandoffBalancer(object):
+    """ Hands off sockets, ie: connections accepted by an acceptor process,
+    to the least loaded of several worker processes which receive them with
+    HandoffWorker. Each socket is sent over the worker's channel from
+    handoff_channel() with SCM_RIGHTS. Workers report how many file objects
+    their selector has registered each time they receive sockets and the
+    balancer adds the sockets sent since the last report to estimate each
+    worker's load. The channels are registered with the selector with a
+    callback for Dispatcher to read the reports::
+
+        balancer = HandoffBalancer(selector)
+        for channel in channels:
+            balancer.add_worker(channel)
+
+        def on_accept(key, events):
+            conn, _ = listener.accept()
+            balancer.send(conn)
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.workers = []
+        # Per channel: [registrations reported, sockets sent, sockets received]
+        self._loads = {}
+
+    def add_worker(self, channel):
+        channel.setblocking(False)
+        self.selector.register(channel, EVENT_READ, self._handle)
+        self.workers.append(channel)
+        self._loads[channel] = [0, 0, 0]
+
+    def remove_worker(self, channel):
+        """ Stops sending sockets to a worker. The channel isn't closed. """
+        self.selector.unregister(channel)
+        self.workers.remove(channel)
+        del self._loads[channel]
+
+    def load(self, channel):
+        """ Returns the estimated number of file objects registered by a worker """
+        reported, sent, received = self._loads[channel]
+        return reported + sent - received
+
+    def send(self, sock):
+        """ Sends sock to the least loaded worker and closes it, the worker
+        has its own copy of the file descriptor. Workers whose channels are
+        full are skipped and workers that have exited are removed. Returns
+        the channel of the worker. """
+        error = None
+        for channel in sorted(self.workers, key=self.load):
+            try:
+                _send_fds(channel, [sock.fileno()])
+            except _ERROR_TYPES as e:
+                error = e
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    self.remove_worker(channel)
+                continue
+            self._loads[channel][1] += 1
+            sock.close()
+            return channel
+        if error is None:
+            raise RuntimeError("No workers to hand off {0!r} to".format(sock))
+        raise error
+
+    def _handle(self, key, events):
+        """ Reads load reports from a worker """
+        loads = self._loads[key.fileobj]
+        while True:
+            try:
+                report = key.fileobj.recv(_HANDOFF_REPORT_SIZE)
+            except _ERROR_TYPES as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            if len(report) == _HANDOFF_REPORT_SIZE:
+                loads[0], loads[2] = _HANDOFF_REPORT_STRUCT.unpack(report)
+
+
+class HandoffWorker(object):
+    """ Receives sockets sent by HandoffBalancer over a channel from
+    handoff_channel() and registers each of them with the worker's selector
+    for events with data. on_receive(key) is called with each new key. The
+    channel is registered with a callback for Dispatcher::
+
+        HandoffWorker(selector, channel, EVENT_READ, on_readable)
+        Dispatcher(selector).run_forever()
+
+    The number of received sockets that are still registered with the
+    selector is reported to the balancer after each batch of sockets. Other
+    registrations, like the channel, aren't counted. Call report() to update
+    it at other times, ie: when connections close. """
+
+    def __init__(self, selector, channel, events=EVENT_READ, data=None, on_receive=None):
+        self.selector = selector
+        self.channel = channel
+        self.events = events
+        self.data = data
+        self.on_receive = on_receive
+        self.received = 0
+        self._sockets = {}  # fd: socket for every socket received
+        channel.setblocking(False)
+        selector.register(channel, EVENT_READ, self._handle)
+
+    def report(self):
+        """ Sends the number of received sockets that are still
+        registered with the selector to the balancer """
+        sockets = self._sockets
+        for fd, sock in list(sockets.items()):
+            key = self.selector._key_from_fd(fd)
+            if key is None or key.fileobj is not sock:
+                del sockets[fd]
+        registered = len(sockets)
+        try:
+            self.channel.send(_HANDOFF_REPORT_STRUCT.pack(registered, self.received))
+        except _ERROR_TYPES as e:
+            # Reports only need to be sent eventually and a worker keeps
+            # serving its connections after the balancer has gone away.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS,
+                               errno.ECONNREFUSED, errno.ENOTCONN):
+                raise
+
+    def _handle(self, key, events):
+        """ Receives and registers sockets from the balancer """
+        keys = []
+        while True:
+            try:
+                fds = _recv_fds(self.channel, _HANDOFF_MAX_FDS)
+            except _ERROR_TYPES as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            for fd in fds:
+                sock = _socket_from_fd(fd)
+                sock.setblocking(False)
+                keys.append(self.selector.register(sock, self.events, self.data))
+                self._sockets[fd] = sock
+                self.received += 1
+        self.report()
+        if self.on_receive is not None:
+            for new_key in keys:
+                self.on_receive(new_key)
+
+
+# Workers report (registrations, sockets received) to the balancer.
+_HANDOFF_REPORT_STRUCT = struct.Struct('<QQ')
+_HANDOFF_REPORT_SIZE = _HANDOFF_REPORT_STRUCT.size
+_HANDOFF_MAX_FDS = 16
+
+
+def _send_fds(sock, fds):
+    """ Sends file descriptors with SCM_RIGHTS like socket.send_fds() which
+    was added in Python 3.9. """
+    import array
+    import socket
+    if hasattr(socket, 'send_fds'):
+        return socket.send_fds(sock, [b'F'], fds)
+    return sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def _recv_fds(sock, max_fds):
+    """ Receives file descriptors sent by _send_fds() """
+    import array
+    import socket
+    if hasattr(socket, 'recv_fds'):
+        return socket.recv_fds(sock, 1, max_fds)[1]
+    fds = array.array('i')
+    _, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_SPACE(max_fds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
+
+
+def _socket_from_fd(fd):
+    """ Returns a socket object which owns fd """
+    import socket
+    if sys.version_info >= (3, 7):
+        # The family and type are detected from the file descriptor.
+        return socket.socket(fileno=fd)
+    try:
+        return socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    finally:
+        os.close(fd)
+
+
+def _iov_max():
+    """ Returns how many buffers can be passed to one sendmsg() call """
+    global _IOV_MAX
+    if _IOV_MAX is None:
+        try:
+            _IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+        except (AttributeError, ValueError, OSError):
+            _IOV_MAX = 16  # The minimum POSIX allows.
+        if _IOV_MAX <= 0:
+            _IOV_MAX = 16
+    return _IOV_MAX
+
+
+class SignalSource(object):
+    """ A file object which becomes readable when one of 'signals' is
+    received so signals can be registered with any selector for EVENT_READ
+    and handled from the loop. read() returns the signal numbers received
+    since the last read()::
+
+        source = SignalSource([signal.SIGTERM, signal.SIGHUP])
+        selector.register(source, EVENT_READ)
+
+    On Linux with Python 3.3+ the signals are blocked and read from a
+    signalfd so they never interrupt select() or any other system call.
+    The signal mask is per-thread and inherited by new threads and child
+    processes so create the source in the main thread before starting
+    threads, and unblock the signals in children that need them.
+    Elsewhere, or with signalfd=False, a handler is installed for each
+    signal and signal.set_wakeup_fd() makes one end of a socket pair
+    readable when a signal arrives, replacing any other wakeup fd until
+    close(). Signals received more than once before they're handled may
+    be reported once with either implementation.
+
+    signalfd=True raises RuntimeError where signalfd isn't available.
+    Sources must be created and closed in the main thread. """
+
+    def __init__(self, signals, signalfd=None):
+        import signal
+        self.signals = list(signals)
+        self._fd = -1
+        self._mask = None
+        self._handlers = {}
+        self._wakeup = None
+        self._pending = []
+
+        create = _load_signalfd()
+        if signalfd is None:
+            signalfd = create is not None
+        elif signalfd and create is None:
+            raise RuntimeError("signalfd isn't available on this platform")
+
+        if signalfd:
+            self._mask = signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+            try:
+                self._fd = create(self.signals)
+            except BaseException:
+                signal.pthread_sigmask(signal.SIG_SETMASK, self._mask)
+                raise
+            return
+
+        rd, wr = _socketpair()
+        try:
+            rd.setblocking(False)
+            wr.setblocking(False)
+            self._wakeup = (rd, wr, signal.set_wakeup_fd(wr.fileno()))
+        except BaseException:
+            rd.close()
+            wr.close()
+            raise
+        self._fd = rd.fileno()
+        try:
+            for signum in self.signals:
+                self._handlers[signum] = signal.signal(signum, self._handle)
+        except BaseException:
+            # Restores the handlers installed so far and the wakeup fd.
+            self.close()
+            raise
+
+    def fileno(self):
+        return self._fd
+
+    def _handle(self, signum, frame):
+        self._pending.append(signum)
+
+    def read(self):
+        """ Returns a list of the signal numbers received since the last
+        call, which is empty if none were. """
+        if self._wakeup is not None:
+            # The wakeup fd only wakes up the loop, handlers record signals.
+            _drain(self._wakeup[0])
+            pending, self._pending = self._pending, []
+            return pending
+
+        received = []
+        while True:
+            try:
+                data = os.read(self._fd, _SIGNALFD_SIGINFO_SIZE * 64)
+            except _ERROR_TYPES as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return received
+                raise
+            # ssi_signo is the first field of each signalfd_siginfo.
+            unpack_from = _SIGNALFD_SIGNO_STRUCT.unpack_from
+            for offset in range(0, len(data), _SIGNALFD_SIGINFO_SIZE):
+                received.append(unpack_from(data, offset)[0])
+
+    def close(self):
+        """ Restores the signal mask or the previous handlers and wakeup
+        fd. Signals blocked by the source are delivered once they're
+        unblocked if any arrived after the last read(). """
+        import signal
+        if self._fd < 0:
+            return
+        if self._wakeup is not None:
+            rd, wr, previous = self._wakeup
+            for signum, handler in self._handlers.items():
+                signal.signal(signum, handler)
+            signal.set_wakeup_fd(previous)
+            rd.close()
+            wr.close()
+            self._wakeup = None
+        else:
+            os.close(self._fd)
+            signal.pthread_sigmask(signal.SIG_SETMASK, self._mask)
+        self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TimerSource(object):
+    """ A file object which becomes readable when a timer expires so timers
+    can be registered with any selector for EVENT_READ. The timer first
+    expires after 'delay' seconds and then every 'interval' seconds, or
+    only once if interval is 0. read() returns how many times it expired
+    since the last read() so a loop which fell behind handles all of the
+    missed ticks at once::
+
+        timer = TimerSource(1.0, 1.0)
+        selector.register(timer, EVENT_READ)
+
+    Uses a timerfd on CLOCK_MONOTONIC so it raises RuntimeError on
+    platforms other than Linux. """
+
+    def __init__(self, delay, interval=0):
+        timerfd = _load_timerfd()
+        if timerfd is None:
+            raise RuntimeError("timerfd isn't available on this platform")
+        create, self._settime = timerfd
+        self._fd = create()
+        try:
+            self.set(delay, interval)
+        except Exception:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self._fd
+
+    def set(self, delay, interval=0):
+        """ Re-arms the timer. Expirations which weren't read are dropped. """
+        if delay < 0 or interval < 0:
+            raise ValueError("Invalid delay {0!r} or interval {1!r}".format(delay, interval))
+        # A delay of 0 would disarm the timer instead of expiring right away.
+        self._settime(self._fd, max(delay, 1e-9), interval)
+
+    def cancel(self):
+        """ Disarms the timer until set() is called again """
+        self._settime(self._fd, 0, 0)
+
+    def read(self):
+        """ Returns how many times the timer expired since the last call """
+        try:
+            data = os.read(self._fd, 8)
+        except _ERROR_TYPES as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise
+        return _TIMERFD_EXPIRATIONS_STRUCT.unpack(data)[0]
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChildSource(object):
+    """ A file object which becomes readable when a child process exits so
+    it can be registered with any selector for EVENT_READ instead of polling
+    waitpid(). 'process' is a process id or a subprocess.Popen object.
+    read() reaps the child and returns its exit code, which is the negative
+    signal number if it was killed like Popen.returncode, or None while it
+    is still running. Popen objects are reaped with their poll() method.
+
+    The child must not have been reaped before the source is created. Uses
+    pidfd_open() so it needs Linux 5.3+ and Python 3.9+ and raises
+    RuntimeError elsewhere. Use SignalSource([signal.SIGCHLD]) there. """
+
+    def __init__(self, process):
+        if not hasattr(os, 'pidfd_open'):
+            raise RuntimeError("pidfd isn't available on this platform")
+        self.process = process
+        self.pid = getattr(process, 'pid', process)
+        self.returncode = None
+        try:
+            self._fd = os.pidfd_open(self.pid)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            raise RuntimeError("pidfd isn't supported by this kernel")
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        """ Returns the exit code of the child or None if it's running """
+        if self.returncode is None:
+            if hasattr(self.process, 'poll'):
+                self.returncode = self.process.poll()
+            else:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _drain(sock):
+    """ Reads everything queued on a non-blocking socket """
+    while True:
+        try:
+            if not sock.recv(4096):
+                return
+        except _ERROR_TYPES as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+
+
+def _load_signalfd():
+    """ Returns a function which creates a non-blocking signalfd for a list
+    of signals, or None if signalfd() or pthread_sigmask() isn't available. """
+    import signal
+    if not sys.platform.startswith('linux') or not hasattr(signal, 'pthread_sigmask'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        signalfd = libc.signalfd
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    def create(signals):
+        # glibc's sigset_t is 1024 bits, sigemptyset() and sigaddset()
+        # hide its layout.
+        mask = ctypes.create_string_buffer(128)
+        libc.sigemptyset(mask)
+        for signum in signals:
+            if libc.sigaddset(mask, int(signum)) < 0:
+                raise ValueError("Invalid signal {0!r}".format(signum))
+        fd = signalfd(-1, mask, _FD_NONBLOCK | _FD_CLOEXEC)
+        if fd < 0:
+            _raise_ctypes_error(ctypes)
+        return fd
+    return create
+
+
+def _load_timerfd():
+    """ Returns (create, settime) functions for a non-blocking timerfd on
+    CLOCK_MONOTONIC, or None if timerfd isn't available. """
+    if hasattr(os, 'timerfd_create'):  # Python 3.13+
+        def create():
+            return os.timerfd_create(time.CLOCK_MONOTONIC,
+                                     flags=os.TFD_NONBLOCK | os.TFD_CLOEXEC)
+
+        def settime(fd, delay, interval):
+            os.timerfd_settime(fd, initial=delay, interval=interval)
+        return create, settime
+
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        timerfd_create = libc.timerfd_create
+        timerfd_settime = libc.timerfd_settime
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    class itimerspec(ctypes.Structure):
+        _fields_ = [('it_interval', timespec), ('it_value', timespec)]
+
+    def to_timespec(seconds):
+        nanoseconds = int(round(seconds * 1e9))
+        return timespec(nanoseconds // 1000000000, nanoseconds % 1000000000)
+
+    def create():
+        fd = timerfd_create(_CLOCK_MONOTONIC, _FD_NONBLOCK | _FD_CLOEXEC)
+        if fd < 0:
+            _raise_ctypes_error(ctypes)
+        return fd
+
+    def settime(fd, delay, interval):
+        spec = itimerspec(to_timespec(interval), to_timespec(delay))
+        if timerfd_settime(fd, 0, ctypes.byref(spec), None) < 0:
+            _raise_ctypes_error(ctypes)
+    return create, settime
+
+
+def _raise_ctypes_error(ctypes):
+    """ Raises OSError for errno after a failed call through ctypes """
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+
+
+class ReplaySelector(BaseSelector):
+    """ Selector which replays a trace written by BaseSelector.record_trace()
+    so that code using a selector can be benchmarked against recorded load
+    without any sockets. Each call to select() first applies the recorded
+    register(), modify() and unregister() calls which came before the next
+    recorded select() and then returns its ready file descriptors. Calls
+    before the first select() are applied when the selector is created.
+
+    File descriptors registered by the trace are plain integers whose data
+    is data_factory(fd) if a data_factory is given and otherwise data.
+    Ready file descriptors which aren't registered are skipped and recorded
+    calls which no longer apply are ignored so the code being benchmarked
+    may register, modify and unregister file descriptors as well. select()
+    never blocks and raises EOFError once the trace has been replayed. """
+
+    def __init__(self, trace, data=None, data_factory=None):
+        super(ReplaySelector, self).__init__()
+        self._records = read_trace(trace)
+        self._data = data
+        self._data_factory = data_factory
+
+        # Apply the calls before the first select() so that the
+        # file descriptors are registered before select() is called.
+        self._next_select = self._replay_until_select()
+
+    def _replay_until_select(self):
+        """ Applies recorded calls until the next select() record which is
+        returned. Returns None if the end of the trace is reached. """
+        fd_to_key = self._fd_to_key
+        for record in self._records:
+            operation = record.operation
+            if operation == 'select':
+                return record
+
+            key = fd_to_key.get(record.fd)
+            if operation == 'unregister':
+                if key is not None:
+                    self.unregister(record.fd)
+            elif key is None:
+                data = self._data if self._data_factory is None else self._data_factory(record.fd)
+                self.register(record.fd, record.events, data)
+            elif key.events != record.events:
+                self.modify(key.fileobj, record.events, key.data)
+        return None
+
+    def select(self, timeout=None):
+        record, self._next_select = self._next_select, None
+        if record is None:
+            record = self._replay_until_select()
+            if record is None:
+                raise EOFError("Trace has been replayed")
+
+        ready = []
+        fd_to_key = self._fd_to_key
+        for fd, events in record.ready:
+            key = fd_to_key.get(fd)
+            if key is not None and fd not in self._suspended:
+                events &= key.events
+                if events:
+                    ready.append((key, events))
+        return ready
+
+    def close(self):
+        self._records.close()
+        super(ReplaySelector, self).close()
+
+
+class SimulatedSelector(BaseSelector):
+    """ Selector for load testing code that uses a selector without opening
+    any sockets. Any non-negative integer can be registered as a virtual
+    file descriptor so there is no limit to how many can be registered.
+
+    File descriptors registered for EVENT_READ become readable in bursts
+    which arrive as a Poisson process at rate bursts per second. Each burst
+    makes burst_size file descriptors readable on average (the size is
+    geometrically distributed) and hot_share of the readable file descriptors
+    are picked from the hot_fraction of registered file descriptors which
+    are hot. Each readable file descriptor is reported by one select() call,
+    as if it had been drained by the caller. File descriptors registered for
+    EVENT_WRITE are always writable.
+
+    Time is read from clock but select() never sleeps. When nothing is ready
+    time is skipped forwards to the next burst, or by timeout if that is
+    sooner, so load is generated as fast as the caller can handle it. Pass
+    seed to generate the same readiness every time. """
+
+    def __init__(self, rate=1000.0, burst_size=1.0, hot_fraction=0.0, hot_share=0.0,
+                 seed=None, clock=monotonic):
+        if rate <= 0:
+            raise ValueError("Invalid rate: {0!r}".format(rate))
+        if burst_size < 1:
+            raise ValueError("Invalid burst_size: {0!r}".format(burst_size))
+        if not 0 <= hot_fraction <= 1 or not 0 <= hot_share <= 1:
+            raise ValueError("hot_fraction and hot_share must be between 0 and 1")
+        super(SimulatedSelector, self).__init__()
+        import random
+        self._random = random.Random(seed)
+        self.rate = rate
+        self.burst_size = burst_size
+        self.hot_fraction = hot_fraction
+        self.hot_share = hot_share
+        self._clock = clock
+        self._skipped = 0.0
+        self._next_burst = None
+
+        # File descriptors registered for reading in a list so one can be
+        # picked at random, with each one's position in the list.
+        self._readers = []
+        self._reader_index = {}
+        self._writers = set()
+
+        # Readable file descriptors which were suspended and ones
+        # which have been re-armed and are reported by the next select().
+        self._deferred = set()
+        self._rearmed = set()
+
+    def register(self, fileobj, events, data=None):
+        key = super(SimulatedSelector, self).register(fileobj, events, data)
+        if events & EVENT_READ:
+            self._reader_index[key.fd] = len(self._readers)
+            self._readers.append(key.fd)
+        if events & EVENT_WRITE:
+            self._writers.add(key.fd)
+        return key
+
+    def unregister(self, fileobj):
+        key = super(SimulatedSelector, self).unregister(fileobj)
+        index = self._reader_index.pop(key.fd, None)
+        if index is not None:
+            last = self._readers.pop()
+            if index < len(self._readers):
+                self._readers[index] = last
+                self._reader_index[last] = index
+        self._writers.discard(key.fd)
+        self._deferred.discard(key.fd)
+        self._rearmed.discard(key.fd)
+        return key
+
+    def _rearm(self, key):
+        if key.fd in self._deferred:
+            self._deferred.remove(key.fd)
+            self._rearmed.add(key.fd)
+
+    def select(self, timeout=None):
+        suspended = self._suspended
+        ready = {}
+        for fd in self._rearmed:
+            ready[fd] = EVENT_READ
+        self._rearmed.clear()
+        for fd in self._writers:
+            if fd not in suspended:
+                ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+
+        now = self._clock() + self._skipped
+        if self._next_burst is None:
+            # Bursts start arriving at the first call to select().
+            self._next_burst = now + self._random.expovariate(self.rate)
+        if not self._readers:
+            self._next_burst = max(self._next_burst, now)
+        elif not ready and self._next_burst > now and (timeout is None or timeout > 0):
+            skip = self._next_burst - now
+            if timeout is not None:
+                skip = min(skip, timeout)
+            self._skipped += skip
+            now += skip
+
+        random = self._random
+        while self._next_burst <= now:
+            self._next_burst += random.expovariate(self.rate)
+            if not self._readers:
+                continue
+            for fd in self._burst():
+                if fd in suspended:
+                    self._deferred.add(fd)
+                else:
+                    ready[fd] = ready.get(fd, 0) | EVENT_READ
+
+        fd_to_key = self._fd_to_key
+        return [(fd_to_key[fd], events) for fd, events in ready.items()]
+
+    def _burst(self):
+        """ Returns the file descriptors made readable by one burst. """
+        random = self._random.random
+        readers = self._readers
+        size = 1
+        if self.burst_size > 1:
+            stop = 1.0 / self.burst_size
+            while random() > stop:
+                size += 1
+
+        total = len(readers)
+        hot = int(total * self.hot_fraction)
+        if self.hot_fraction and not hot:
+            hot = 1
+        fds = []
+        for _ in range(size):
+            if hot and (hot == total or random() < self.hot_share):
+                fds.append(readers[int(random() * hot)])
+            else:
+                fds.append(readers[hot + int(random() * (total - hot))])
+        return fds
+
+    def close(self):
+        del self._readers[:]
+        self._reader_index.clear()
+        self._writers.clear()
+        self._deferred.clear()
+        self._rearmed.clear()
+        super(SimulatedSelector, self).close()
+
+
+def _read_stats_pages(paths):
+    """ Reads every stats page in paths, which can include directories.
+    Files which aren't stats pages are skipped. """
+    pages = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        else:
+            files = [path]
+        for filename in files:
+            try:
+                pages[filename] = read_stats_page(filename)
+            except ValueError:
+                if filename == path:
+                    raise
+            except _ERROR_TYPES:
+                # The file was removed or isn't readable.
+                if filename == path:
+                    raise
+    return pages
+
+
+def _main(argv=None):
+    """ Command line reader for pages written by BaseSelector.publish_stats()
+    which prints the counters summed across all of the processes. """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m selectors2',
+        description='Sums selector statistics published with publish_stats().')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='stats page or a directory of stats pages')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='report rates over this many seconds instead of since start')
+    parser.add_argument('--per-process', action='store_true',
+                        help='also print a line for every process')
+    parser.add_argument('--prometheus', action='store_true',
+                        help='print the summed statistics in the Prometheus text format')
+    args = parser.parse_args(argv)
+
+    try:
+        previous = None
+        pages = _read_stats_pages(args.paths)
+        if args.interval is not None:
+            previous, started = pages, monotonic()
+            time.sleep(args.interval)
+            pages = _read_stats_pages(args.paths)
+            interval = monotonic() - started
+    except (ValueError,) + _ERROR_TYPES as e:
+        sys.stderr.write('error: {0}\n'.format(e))
+        return 1
+
+    names = set(page.selector_name for page in pages.values())
+    total = SelectorStats(names.pop() if len(names) == 1 else 'mixed')
+    rows = []
+    for filename, page in sorted(pages.items()):
+        total._merge(page)
+        events = page.ready_events
+        selects = page.select_calls
+        if previous is None:
+            elapsed = page.updated - page.started
+        else:
+            elapsed = interval
+            before = previous.get(filename)
+            if before is not None and before.started == page.started:
+                events -= before.ready_events
+                selects -= before.select_calls
+        if elapsed > 0:
+            events /= elapsed
+            selects /= elapsed
+        rows.append((str(page.pid), page, selects, events))
+
+    if args.prometheus:
+        sys.stdout.write(total.to_prometheus())
+        return 0
+
+    line = '{0:<10} {1:<16} {2:>12} {3:>12} {4:>12} {5:>10} {6:>10} {7:>10}\n'
+    sys.stdout.write(line.format('PID', 'SELECTOR', 'SELECTS/SEC', 'EVENTS/SEC',
+                                 'BLOCKED', 'MAX BATCH', 'REGISTERS', 'FDS'))
+
+    def write_row(name, stats, selects, events):
+        sys.stdout.write(line.format(
+            name, stats.selector_name, '{0:.1f}'.format(selects), '{0:.1f}'.format(events),
+            '{0:.3f}s'.format(stats.blocked_time), stats.max_batch_size,
+            stats.registers, stats.registers - stats.unregisters))
+
+    if args.per_process:
+        for row in rows:
+            write_row(*row)
+    write_row('total', total, sum(row[2] for row in rows), sum(row[3] for row in rows))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
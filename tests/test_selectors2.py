@@ -1,12 +1,19 @@
 from __future__ import with_statement
 import errno
+import io
 import os
 import psutil
 import platform
 import mock
 import select
+import shutil
 import signal
+import socket
+import ssl
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 from .support import socketpair, AlarmMixin, TimerMixin
 
@@ -29,6 +36,11 @@ try:  # Python 2.6 doesn't have the resource module.
 except ImportError:
     resource = None
 
+try:  # Python 2.x doesn't have concurrent.futures.
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 HAS_ALARM = hasattr(signal, "alarm")
 
 LONG_SELECT = 1.0
@@ -158,6 +170,113 @@ class _AllSelectorsTestCase(_BaseSelectorTestCase):
 
         self.assertRaises(ValueError, s.register, rd, 99999)
 
+    def test_extended_events(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        name = type(s).__name__
+        hangup = selectors2.EVENT_HUP | selectors2.EVENT_RDHUP | selectors2.EVENT_ERROR
+        key = s.register(rd, selectors2.EVENT_READ | hangup)
+        self.assertEqual([], s.select(timeout=0))
+
+        rdhup = None
+        if name == 'PollSelector':
+            rdhup = selectors2._POLLRDHUP and selectors2.EVENT_RDHUP
+        elif name == 'EpollSelector':
+            rdhup = selectors2._EPOLLRDHUP and selectors2.EVENT_RDHUP
+        elif name == 'KqueueSelector':
+            # Without EVENT_WRITE kqueue can't tell a shutdown from a close.
+            rdhup = selectors2.EVENT_RDHUP | selectors2.EVENT_HUP
+
+        wr.shutdown(socket.SHUT_WR)
+        ready = s.select(timeout=SHORT_SELECT)
+        if rdhup is not None:
+            self.assertEqual([(key, selectors2.EVENT_READ | rdhup)], ready)
+        else:
+            self.assertEqual([(key, selectors2.EVENT_READ)], ready)
+
+        wr.close()
+        ready = s.select(timeout=SHORT_SELECT)
+        if name in ('PollSelector', 'EpollSelector', 'DevpollSelector', 'KqueueSelector'):
+            self.assertEqual([(key, selectors2.EVENT_READ | selectors2.EVENT_HUP | (rdhup or 0))],
+                             ready)
+        elif rdhup is None:
+            self.assertEqual([(key, selectors2.EVENT_READ)], ready)
+
+    def test_extended_events_not_reported_unless_registered(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ)
+        wr.close()
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=SHORT_SELECT))
+
+    def test_register_only_extended_events(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_HUP)
+        self.assertEqual(selectors2.EVENT_HUP, key.events)
+        self.assertEqual([], s.select(timeout=0))
+
+        wr.close()
+        if type(s).__name__ in ('PollSelector', 'EpollSelector', 'DevpollSelector'):
+            self.assertEqual([(key, selectors2.EVENT_HUP)], s.select(timeout=SHORT_SELECT))
+
+    def test_prune_stale_closed_fileobj(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ)
+        s.register(wr, selectors2.EVENT_WRITE)
+        self.assertEqual([], s.prune_stale())
+
+        rd.close()
+        self.assertEqual([key], s.prune_stale())
+        self.assertEqual([wr.fileno()], list(s.get_map()))
+
+    def test_prune_stale_closed_fd(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        fd = os.dup(rd.fileno())
+        key = s.register(fd, selectors2.EVENT_READ)
+        os.close(fd)
+
+        stale = []
+        s.enable_pruning(handler=stale.append)
+        self.assertEqual([key], s.prune_stale())
+        self.assertEqual([key], stale)
+        self.assertEqual(0, len(s.get_map()))
+
+    def test_register_prunes_reused_fd(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ)
+        rd.close()
+        new_rd, new_wr = self.make_socketpair()
+        if new_rd.fileno() != key.fd:
+            self.skipTest("File descriptor wasn't reused")
+        self.assertRaises(KeyError, s.register, new_rd, selectors2.EVENT_READ)
+
+        stale = []
+        s.enable_pruning(handler=stale.append)
+        new_key = s.register(new_rd, selectors2.EVENT_READ)
+        self.assertEqual([key], stale)
+        self.assertIs(new_key, s.get_key(new_rd))
+
+        new_wr.send(b'x')
+        self.assertEqual([(new_key, selectors2.EVENT_READ)], s.select(timeout=SHORT_SELECT))
+
+    def test_select_prunes_closed_fileobj(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        s.register(rd, selectors2.EVENT_READ)
+        wr_key = s.register(wr, selectors2.EVENT_WRITE)
+        stale = []
+        s.enable_pruning(handler=stale.append)
+
+        rd.close()
+        self.assertEqual([(wr_key, selectors2.EVENT_WRITE)], s.select(timeout=0))
+        if type(s).__name__ in ('SelectSelector', 'PollSelector', 'DevpollSelector'):
+            self.assertEqual([rd], [key.fileobj for key in stale])
+            self.assertEqual([wr.fileno()], list(s.get_map()))
+
     def test_register_negative_fd(self):
         s = self.make_selector()
         self.assertRaises(ValueError, s.register, -1, selectors2.EVENT_READ)
@@ -273,6 +392,180 @@ class _AllSelectorsTestCase(_BaseSelectorTestCase):
         # Modify invalid fileobj
         self.assertRaises(KeyError, s.modify, 999999, selectors2.EVENT_READ)
 
+    def test_suspend_and_rearm(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(wr, selectors2.EVENT_WRITE)
+
+        self.assertEqual([(key, selectors2.EVENT_WRITE)], s.select(timeout=0))
+        s._suspend(key)
+        self.assertEqual([], s.select(timeout=0))
+        self.assertEqual(key, s.get_key(wr))
+
+        # modify() re-arms a suspended file object.
+        self.assertEqual(key, s.modify(wr, selectors2.EVENT_WRITE))
+        self.assertEqual([(key, selectors2.EVENT_WRITE)], s.select(timeout=0))
+
+        s._suspend(key)
+        s.unregister(wr)
+        self.assertEqual(0, len(s.get_map()))
+
+    def test_rearmed_key_is_reported_inline(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ)
+        wr.send(b'x')
+
+        for _ in range(2):
+            self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+            s._suspend(key)
+            s.modify(rd, selectors2.EVENT_READ)
+
+        # The data is never read so every select() reports it.
+        for _ in range(3):
+            self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+        s.modify(rd, selectors2.EVENT_READ)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+
+    def test_stall_handler(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(wr, selectors2.EVENT_WRITE)
+        stalls = []
+        s.set_stall_handler(SHORT_SELECT, lambda *args: stalls.append(args))
+
+        ready = s.select(timeout=0)
+        self.assertEqual([(key, selectors2.EVENT_WRITE)], ready)
+        s.select(timeout=0)
+        self.assertEqual([], stalls)
+
+        time.sleep(SHORT_SELECT * 2)
+        s.select(timeout=0)
+        self.assertEqual(1, len(stalls))
+        stall_time, stalled = stalls[0]
+        self.assertGreater(stall_time, SHORT_SELECT)
+        self.assertEqual(ready, stalled)
+
+        s.set_stall_handler(None)
+        time.sleep(SHORT_SELECT * 2)
+        s.select(timeout=0)
+        self.assertEqual(1, len(stalls))
+
+    def test_stats(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        self.assertIsNone(s.stats())
+
+        s.enable_stats()
+        s.register(rd, selectors2.EVENT_READ)
+        s.register(wr, selectors2.EVENT_WRITE)
+        s.modify(wr, selectors2.EVENT_WRITE, "data")
+        s.modify(rd, selectors2.EVENT_READ | selectors2.EVENT_WRITE)
+        s.unregister(rd)
+        self.assertEqual(0, s.stats().select_calls)
+
+        self.assertEqual(1, len(s.select(timeout=0)))
+        self.assertEqual(1, len(s.select(timeout=0)))
+        s.unregister(wr)
+        self.assertEqual([], s.select(timeout=0))
+
+        stats = s.stats()
+        self.assertEqual(type(s).__name__, stats.selector_name)
+        self.assertEqual(3, stats.select_calls)
+        self.assertEqual(2, stats.ready_events)
+        self.assertEqual([1, 2] + [0] * 11, stats.batch_sizes)
+        self.assertEqual((2, 2, 2), (stats.registers, stats.modifies, stats.unregisters))
+        self.assertEqual(0, stats.eintr_retries)
+        self.assertGreaterEqual(stats.blocked_time, 0.0)
+        self.assertGreaterEqual(stats.busy_time, 0.0)
+
+        # Snapshots aren't updated.
+        s.select(timeout=0)
+        self.assertEqual(3, stats.select_calls)
+
+        s.enable_stats(False)
+        self.assertIsNone(s.stats())
+        self.assertNotIn('select', s.__dict__)
+
+    def test_record_trace(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        trace = io.BytesIO()
+
+        s.register(rd, selectors2.EVENT_READ)
+        s.record_trace(trace)
+        s.register(wr, selectors2.EVENT_WRITE)
+        self.assertEqual(1, len(s.select(timeout=0)))
+        s.modify(wr, selectors2.EVENT_READ)
+        s.modify(rd, selectors2.EVENT_READ, "data")
+        s.unregister(wr)
+        s.record_trace(None)
+        self.assertNotIn('select', s.__dict__)
+        s.select(timeout=0)
+
+        trace.seek(0)
+        records = list(selectors2.read_trace(trace))
+        self.assertEqual([('register', rd.fileno(), selectors2.EVENT_READ),
+                          ('register', wr.fileno(), selectors2.EVENT_WRITE),
+                          ('select', None, None),
+                          ('modify', wr.fileno(), selectors2.EVENT_READ),
+                          ('modify', rd.fileno(), selectors2.EVENT_READ),
+                          ('unregister', wr.fileno(), None)],
+                         [(r.operation, r.fd, r.events) for r in records])
+        self.assertEqual([(wr.fileno(), selectors2.EVENT_WRITE)], records[2].ready)
+        self.assertEqual(0.0, records[2].timeout)
+        self.assertGreaterEqual(records[2].duration, 0.0)
+        times = [r.time for r in records]
+        self.assertEqual(sorted(times), times)
+
+    def test_publish_stats(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'worker.stats')
+
+        s.publish_stats(path, interval=0)
+        page = selectors2.read_stats_page(path)
+        self.assertEqual(type(s).__name__, page.selector_name)
+        self.assertEqual(os.getpid(), page.pid)
+        self.assertEqual(0, page.select_calls)
+
+        s.register(wr, selectors2.EVENT_WRITE)
+        s.select(timeout=0)
+        s.select(timeout=0)
+        page = selectors2.read_stats_page(path)
+        stats = s.stats()
+        self.assertEqual(2, page.select_calls)
+        self.assertEqual(2, page.ready_events)
+        self.assertEqual(1, page.max_batch_size)
+        self.assertEqual(1, page.registers)
+        self.assertEqual(stats.batch_sizes, page.batch_sizes)
+        self.assertEqual(stats.blocked_time, page.blocked_time)
+        self.assertGreaterEqual(page.updated, page.started)
+
+        # Stops publishing without removing the file.
+        s.publish_stats(None)
+        s.select(timeout=0)
+        self.assertEqual(2, selectors2.read_stats_page(path).select_calls)
+        self.assertEqual(3, s.stats().select_calls)
+
+    def test_publish_stats_interval(self):
+        s = self.make_selector()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'worker.stats')
+
+        s.publish_stats(path, interval=LONG_SELECT * 60)
+        s.select(timeout=0)
+        s.select(timeout=0)
+        self.assertEqual(0, selectors2.read_stats_page(path).select_calls)
+
+        # Closing the selector publishes the final values.
+        s.close()
+        self.assertEqual(2, selectors2.read_stats_page(path).select_calls)
+
     def test_empty_select(self):
         s = self.make_selector()
         self.assertEqual([], s.select(timeout=SHORT_SELECT))
@@ -595,6 +888,31 @@ class TestUniqueSelectScenarios(_BaseSelectorTestCase):
         selector = self.make_selector()
         self.assertIsInstance(selector, selectors2.SelectSelector)
         
+    @skipUnless(hasattr(unittest.TestCase, 'assertLogs'), "Test case doesn't have assertLogs()")
+    def test_stall_handler_logs_by_default(self):
+        s, rd, wr = self.standard_setup()
+        s.set_stall_handler(0.0)
+
+        s.select(timeout=0)
+        with self.assertLogs('selectors2', level='WARNING') as logs:
+            s.select(timeout=0)
+        self.assertIn(str(wr.fileno()), logs.output[0])
+
+    def test_default_selector_pinned_by_environment(self):
+        selectors2._DEFAULT_SELECTOR = None
+        self.addCleanup(setattr, selectors2, '_DEFAULT_SELECTOR', None)
+
+        with mock.patch.dict(os.environ, {'SELECTORS2_DEFAULT_SELECTOR': 'select'}):
+            selector = self.make_selector()
+        self.assertIsInstance(selector, selectors2.SelectSelector)
+
+    def test_default_selector_pinned_to_unavailable_selector(self):
+        selectors2._DEFAULT_SELECTOR = None
+        self.addCleanup(setattr, selectors2, '_DEFAULT_SELECTOR', None)
+
+        with mock.patch.dict(os.environ, {'SELECTORS2_DEFAULT_SELECTOR': 'notaselector'}):
+            self.assertRaises(RuntimeError, selectors2.DefaultSelector)
+
     @skipIfRetriesInterrupts
     def test_selector_raises_timeout_error_on_interrupt_over_time(self):
         selectors2._DEFAULT_SELECTOR = None
@@ -620,6 +938,30 @@ class TestUniqueSelectScenarios(_BaseSelectorTestCase):
         else:
             self.fail('Didn\'t raise an OSError')
         
+    @skipIfRetriesInterrupts
+    def test_stats_count_interrupts(self):
+        selectors2._DEFAULT_SELECTOR = None
+
+        mock_socket = mock.Mock()
+        mock_socket.fileno.return_value = 1
+        calls = []
+
+        def interrupting_select(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                error = OSError()
+                error.errno = errno.EINTR
+                raise error
+            return [1], [], []
+
+        patch_select_module(self, select=interrupting_select)
+
+        selector = self.make_selector()
+        selector.enable_stats()
+        selector.register(mock_socket, selectors2.EVENT_READ)
+        self.assertEqual(1, len(selector.select(timeout=1.0)))
+        self.assertEqual(1, selector.stats().eintr_retries)
+
     @skipIfRetriesInterrupts
     def test_timeout_is_recalculated_after_interrupt(self):
         selectors2._DEFAULT_SELECTOR = None
@@ -667,6 +1009,1248 @@ class TestUniqueSelectScenarios(_BaseSelectorTestCase):
         # args is ([r], [w], [x], timeout).
         self.assertLess(mock_select.calls[1][0][3], mock_select.calls[0][0][3])
 
+    @skipUnless(sys.version_info >= (3, 5), "Platform doesn't retry interrupts")
+    def test_select_calls_syscall_directly(self):
+        s, rd, wr = self.standard_setup()
+
+        with mock.patch.object(selectors2, '_syscall_wrapper') as wrapper:
+            self.assertEqual(1, len(s.select(timeout=0)))
+        self.assertFalse(wrapper.called)
+
+
+class TestClosedFds(unittest.TestCase):
+    def test_closed_fds(self):
+        fds = []
+        for _ in range(5):
+            rd, wr = socketpair()
+            self.addCleanup(wr.close)
+            fds.append(rd.detach() if hasattr(rd, 'detach') else os.dup(rd.fileno()))
+            rd.close()
+        self.addCleanup(lambda: [os.close(fd) for fd in fds[::2]])
+        os.close(fds[1])
+        os.close(fds[3])
+        self.assertEqual([fds[1], fds[3]], selectors2._closed_fds(fds))
+        self.assertEqual([fds[1], fds[3]], selectors2._bisect_closed_fds(fds))
+
+    def test_closed_fds_batches(self):
+        rd, wr = socketpair()
+        self.addCleanup(rd.close)
+        self.addCleanup(wr.close)
+        fds = [rd.fileno()] * (selectors2._PRUNE_BATCH_SIZE + 1)
+        self.assertEqual([], selectors2._closed_fds(fds))
+
+
+class TestBorrowSelector(_BaseSelectorTestCase):
+    def test_borrow_reuses_selector(self):
+        rd, wr = self.make_socketpair()
+
+        with selectors2.borrow_selector() as s1:
+            key = s1.register(wr, selectors2.EVENT_WRITE)
+            self.assertEqual([(key, selectors2.EVENT_WRITE)], s1.select(timeout=0))
+
+        with selectors2.borrow_selector() as s2:
+            self.assertIs(s1, s2)
+            self.assertEqual(0, len(s2.get_map()))
+            s2.register(wr, selectors2.EVENT_WRITE)
+
+    def test_nested_borrow_gets_different_selector(self):
+        with selectors2.borrow_selector() as s1:
+            with selectors2.borrow_selector() as s2:
+                self.assertIsNot(s1, s2)
+
+    def test_borrow_after_closed_fileobj(self):
+        rd, wr = self.make_socketpair()
+
+        with selectors2.borrow_selector() as s1:
+            s1.register(rd, selectors2.EVENT_READ)
+            rd.close()
+
+        with selectors2.borrow_selector() as s2:
+            self.assertEqual(0, len(s2.get_map()))
+
+    def test_borrow_after_closing_selector(self):
+        with selectors2.borrow_selector() as s1:
+            s1.close()
+
+        with selectors2.borrow_selector() as s2:
+            self.assertIsNot(s1, s2)
+            self.assertEqual(0, len(s2.get_map()))
+
+    def test_borrow_resets_instrumentation(self):
+        rd, wr = self.make_socketpair()
+        trace = io.BytesIO()
+
+        with selectors2.borrow_selector() as s1:
+            s1.register(wr, selectors2.EVENT_WRITE)
+            s1.enable_stats()
+            s1.record_trace(trace)
+            s1.set_stall_handler(0.0, lambda *_: None)
+            s1.enable_pruning()
+            s1.select(timeout=0)
+        recorded = trace.getvalue()
+
+        with selectors2.borrow_selector() as s2:
+            self.assertIs(s1, s2)
+            self.assertIsNone(s2.stats())
+            self.assertIsNone(s2._stall_threshold)
+            self.assertIsNone(s2._stale_handler)
+            self.assertNotIn('select', s2.__dict__)
+            s2.register(wr, selectors2.EVENT_WRITE)
+            s2.select(timeout=0)
+        self.assertEqual(recorded, trace.getvalue())
+
+    @skipUnless(hasattr(os, 'fork'), "Platform doesn't have os.fork()")
+    def test_borrow_after_fork_uses_new_selector(self):
+        with selectors2.borrow_selector() as s1:
+            pass
+
+        pid = os.fork()
+        if pid == 0:  # Child process
+            ok = False
+            try:
+                with selectors2.borrow_selector() as s2:
+                    ok = s2 is not s1 and s1.get_map() is None
+            finally:
+                os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+
+        with selectors2.borrow_selector() as s3:
+            self.assertIs(s1, s3)
+
+
+class _WaitForTestCase(_BaseSelectorTestCase):
+    def test_wait_for_write(self):
+        rd, wr = self.make_socketpair()
+        self.assertTrue(selectors2.wait_for_write(wr, timeout=SHORT_SELECT))
+        self.assertEqual(selectors2.EVENT_WRITE,
+                         selectors2.wait_for(wr, selectors2.EVENT_READ | selectors2.EVENT_WRITE))
+
+    def test_wait_for_read(self):
+        rd, wr = self.make_socketpair()
+        self.assertFalse(selectors2.wait_for_read(rd, timeout=0))
+
+        wr.send(b'x')
+        self.assertTrue(selectors2.wait_for_read(rd, timeout=LONG_SELECT))
+        self.assertEqual(selectors2.EVENT_READ | selectors2.EVENT_WRITE,
+                         selectors2.wait_for(rd, selectors2.EVENT_READ | selectors2.EVENT_WRITE))
+
+    def test_wait_for_timeout(self):
+        rd, wr = self.make_socketpair()
+
+        with self.assertTakesTime(upper=SHORT_SELECT):
+            self.assertEqual(0, selectors2.wait_for(rd, selectors2.EVENT_READ, timeout=-1))
+
+        with self.assertTakesTime(lower=SHORT_SELECT, upper=SHORT_SELECT):
+            self.assertEqual(0, selectors2.wait_for(rd, selectors2.EVENT_READ, SHORT_SELECT))
+
+    @skipUnlessHasAlarm
+    def test_wait_for_interrupt_with_event(self):
+        rd, wr = self.make_socketpair()
+        self.set_alarm(SHORT_SELECT, lambda *args: wr.send(b'x'))
+
+        with self.assertTakesTime(lower=SHORT_SELECT, upper=SHORT_SELECT):
+            self.assertTrue(selectors2.wait_for_read(rd, LONG_SELECT))
+
+    def test_wait_for_bad_events(self):
+        rd, wr = self.make_socketpair()
+        self.assertRaises(ValueError, selectors2.wait_for, rd, 0)
+        self.assertRaises(ValueError, selectors2.wait_for, rd, 99999)
+
+    def test_wait_for_any(self):
+        rd1, wr1 = self.make_socketpair()
+        rd2, wr2 = self.make_socketpair()
+        events = {rd1: selectors2.EVENT_READ,
+                  rd2: selectors2.EVENT_READ,
+                  wr2: selectors2.EVENT_READ | selectors2.EVENT_WRITE}
+
+        ready = selectors2.wait_for_any(events, timeout=0)
+        self.assertEqual(1, len(ready))
+        key, ready_events = ready[0]
+        self.assertIsInstance(key, selectors2.SelectorKey)
+        self.assertEqual((wr2, wr2.fileno(), events[wr2], None), key)
+        self.assertEqual(selectors2.EVENT_WRITE, ready_events)
+
+        wr1.send(b'x')
+        ready = selectors2.wait_for_any(events, timeout=LONG_SELECT)
+        self.assertEqual(set([(rd1, selectors2.EVENT_READ), (wr2, selectors2.EVENT_WRITE)]),
+                         set((key.fileobj, ready_events) for key, ready_events in ready))
+
+    def test_wait_for_any_timeout(self):
+        rd, wr = self.make_socketpair()
+
+        with self.assertTakesTime(lower=SHORT_SELECT, upper=LONG_SELECT):
+            self.assertEqual([], selectors2.wait_for_any({rd: selectors2.EVENT_READ},
+                                                         SHORT_SELECT))
+
+        # Nothing to wait for returns without waiting out the timeout.
+        with self.assertTakesTime(upper=LONG_SELECT / 2):
+            self.assertEqual([], selectors2.wait_for_any({}, LONG_SELECT))
+
+    def test_wait_for_any_invalid(self):
+        rd, wr = self.make_socketpair()
+        self.assertRaises(ValueError, selectors2.wait_for_any, {rd: 0})
+        self.assertRaises(ValueError, selectors2.wait_for_any, {"string": selectors2.EVENT_READ})
+        self.assertRaises(KeyError, selectors2.wait_for_any, {rd: selectors2.EVENT_READ,
+                                                              rd.fileno(): selectors2.EVENT_READ})
+
+
+@skipUnless(hasattr(select, "select"), "Platform doesn't have select.select()")
+class WaitForSelectTestCase(_WaitForTestCase):
+    def setUp(self):
+        patch_select_module(self, 'select')
+
+
+@skipUnless(hasattr(select, "poll"), "Platform doesn't have select.poll()")
+class WaitForPollTestCase(_WaitForTestCase):
+    def setUp(self):
+        patch_select_module(self, 'poll')
+
+
+class TestDispatcher(_BaseSelectorTestCase):
+    def test_run_once(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        calls = []
+        key = s.register(wr, selectors2.EVENT_WRITE, lambda *args: calls.append(args))
+        s.register(rd, selectors2.EVENT_READ, lambda *args: calls.append(args))
+
+        dispatcher = selectors2.Dispatcher(s)
+        self.assertEqual(1, dispatcher.run_once(timeout=0))
+        self.assertEqual([(key, selectors2.EVENT_WRITE)], calls)
+
+    def test_run_forever_stop(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        dispatcher = selectors2.Dispatcher(s)
+        calls = []
+
+        def callback(key, events):
+            calls.append(events)
+            if len(calls) == 3:
+                dispatcher.stop()
+
+        s.register(wr, selectors2.EVENT_WRITE, callback)
+        self.assertEqual(3, dispatcher.run_forever())
+        self.assertEqual(3, len(calls))
+
+    def test_run_forever_timeout(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        s.register(rd, selectors2.EVENT_READ, lambda *args: None)
+
+        with self.assertTakesTime(lower=SHORT_SELECT, upper=SHORT_SELECT):
+            self.assertEqual(0, selectors2.Dispatcher(s).run_forever(timeout=SHORT_SELECT))
+
+    def test_run_forever_nothing_registered(self):
+        s = self.make_selector()
+        with self.assertTakesTime(upper=SHORT_SELECT):
+            self.assertEqual(0, selectors2.Dispatcher(s).run_forever())
+
+    def test_errors_are_batched(self):
+        s = self.make_selector()
+        calls = []
+
+        def bad_callback(key, events):
+            calls.append(key)
+            raise ValueError(key.fd)
+
+        bad_keys = []
+        for _ in range(2):
+            rd, wr = self.make_socketpair()
+            bad_keys.append(s.register(wr, selectors2.EVENT_WRITE, bad_callback))
+        rd, wr = self.make_socketpair()
+        good_key = s.register(wr, selectors2.EVENT_WRITE, lambda key, events: calls.append(key))
+
+        errors = []
+        dispatcher = selectors2.Dispatcher(s, error_handler=lambda *args: errors.append(args))
+        self.assertEqual(3, dispatcher.run_once(timeout=0))
+        self.assertEqual(set(bad_keys + [good_key]), set(calls))
+        self.assertEqual(set(bad_keys), set(key for key, _, _ in errors))
+        for key, events, error in errors:
+            self.assertEqual(selectors2.EVENT_WRITE, events)
+            self.assertIsInstance(error, ValueError)
+
+        del calls[:]
+        self.assertRaises(ValueError, selectors2.Dispatcher(s).run_once, 0)
+        self.assertEqual(3, len(calls))
+
+
+@skipUnless(futures, "Platform doesn't have concurrent.futures")
+class TestDispatcherExecutor(_BaseSelectorTestCase):
+    def make_dispatcher(self, s, **kwargs):
+        executor = futures.ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(executor.shutdown)
+        dispatcher = selectors2.Dispatcher(s, executor=executor, **kwargs)
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+    def test_callbacks_run_in_executor(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        dispatcher = self.make_dispatcher(s)
+        threads = []
+
+        def callback(key, events):
+            threads.append(threading.current_thread())
+            if len(threads) == 3:
+                dispatcher.stop()
+
+        key = s.register(wr, selectors2.EVENT_WRITE, callback)
+        self.assertEqual(1, dispatcher.run_once(timeout=0))
+
+        # The file object is suspended until the callback completes.
+        self.assertEqual(key, s.get_key(wr))
+        dispatcher.run_forever(timeout=LONG_SELECT)
+        self.assertEqual(3, len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_executor_errors(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        errors = []
+        dispatcher = self.make_dispatcher(s, error_handler=lambda *args: errors.append(args))
+
+        def callback(key, events):
+            raise ValueError()
+
+        key = s.register(wr, selectors2.EVENT_WRITE, callback)
+        while not errors:
+            dispatcher.run_once(timeout=LONG_SELECT)
+        self.assertEqual(key, errors[0][0])
+        self.assertIsInstance(errors[0][2], ValueError)
+
+    def test_select_inline_after_executor(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        dispatcher = self.make_dispatcher(s)
+        done = threading.Event()
+        key = s.register(rd, selectors2.EVENT_READ, lambda key, events: done.set())
+        wr.send(b'x')
+
+        self.assertEqual(1, dispatcher.run_once(timeout=0))
+        self.assertTrue(done.wait(LONG_SELECT))
+        while dispatcher._in_flight:
+            dispatcher._rearm_completed()
+
+        # The callback didn't read the data so it's still ready.
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+
+    def test_run_forever_returns_when_callbacks_unregister(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        dispatcher = self.make_dispatcher(s)
+
+        def callback(key, events):
+            key.fileobj.close()
+
+        key = s.register(wr, selectors2.EVENT_WRITE, callback)
+        dispatcher.run_once(timeout=0)
+        with self.assertTakesTime(upper=LONG_SELECT):
+            dispatcher.run_forever(timeout=LONG_SELECT * 2)
+        self.assertIsNone(s._key_from_fd(key.fd))
+
+
+@skipUnless(hasattr(select, "select"), "Platform doesn't have select.select()")
+class DispatcherExecutorSelectTestCase(TestDispatcherExecutor):
+    def setUp(self):
+        patch_select_module(self, 'select')
+
+
+@skipUnless(hasattr(select, "poll"), "Platform doesn't have select.poll()")
+class DispatcherExecutorPollTestCase(TestDispatcherExecutor):
+    def setUp(self):
+        patch_select_module(self, 'poll')
+
+
+@skipUnless(hasattr(select, "epoll"), "Platform doesn't have select.epoll()")
+class DispatcherExecutorEpollTestCase(TestDispatcherExecutor):
+    def setUp(self):
+        patch_select_module(self, 'epoll')
+
+
+class TestSelectorStats(unittest.TestCase):
+    def test_batch_size_buckets(self):
+        stats = selectors2.SelectorStats('Selector')
+        for batch_size in [0, 1, 2, 3, 4, 5, 1024, 1025]:
+            stats._add_select(0.0, batch_size)
+        self.assertEqual([1, 1, 1, 2, 1, 0, 0, 0, 0, 0, 0, 1, 1], stats.batch_sizes)
+
+    def test_to_prometheus(self):
+        stats = selectors2.SelectorStats('EpollSelector')
+        stats._add_select(0.5, 3)
+        stats.registers = 2
+        text = stats.to_prometheus(labels={'worker': '"1"'})
+
+        self.assertTrue(text.endswith('\n'))
+        lines = text.splitlines()
+        self.assertIn('# TYPE selectors2_select_calls_total counter', lines)
+        self.assertIn('selectors2_select_calls_total'
+                      '{selector="EpollSelector",worker="\\"1\\""} 1', lines)
+        self.assertIn('selectors2_registers_total'
+                      '{selector="EpollSelector",worker="\\"1\\""} 2', lines)
+        self.assertIn('# TYPE selectors2_ready_batch_size histogram', lines)
+        self.assertIn('selectors2_ready_batch_size_bucket'
+                      '{selector="EpollSelector",worker="\\"1\\"",le="2"} 0', lines)
+        self.assertIn('selectors2_ready_batch_size_bucket'
+                      '{selector="EpollSelector",worker="\\"1\\"",le="4"} 1', lines)
+        self.assertIn('selectors2_ready_batch_size_bucket'
+                      '{selector="EpollSelector",worker="\\"1\\"",le="+Inf"} 1', lines)
+        self.assertIn('selectors2_ready_batch_size_sum'
+                      '{selector="EpollSelector",worker="\\"1\\""} 3', lines)
+
+
+class TestStatsPage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def publish(self, name, selects):
+        selector = selectors2.DefaultSelector()
+        self.addCleanup(selector.close)
+        selector.publish_stats(os.path.join(self.directory, name), interval=0)
+        for _ in range(selects):
+            selector.select(timeout=0)
+        return selector
+
+    def test_read_stats_page_rejects_other_files(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'\x00' * 4096)
+        self.assertRaises(ValueError, selectors2.read_stats_page, path)
+
+    def test_read_stats_page_while_being_written(self):
+        self.publish('worker', 1)
+        path = os.path.join(self.directory, 'worker')
+        with open(path, 'r+b') as f:
+            f.seek(selectors2._STATS_PAGE_SEQUENCE_OFFSET)
+            f.write(b'\x01' + b'\x00' * 7)
+        self.assertRaises(ValueError, selectors2.read_stats_page, path, retries=3)
+
+    def test_command_line_sums_pages(self):
+        selector = self.publish('worker-1', 2)
+        self.publish('worker-2', 3)
+        with open(os.path.join(self.directory, 'README'), 'w') as f:
+            f.write('not a stats page')
+
+        with mock.patch('sys.stdout') as stdout:
+            self.assertEqual(0, selectors2._main(['--prometheus', self.directory]))
+        lines = ''.join(call[0][0] for call in stdout.write.call_args_list).splitlines()
+        name = type(selector).__name__
+        self.assertIn('selectors2_select_calls_total{{selector="{0}"}} 5'.format(name), lines)
+
+        with mock.patch('sys.stdout') as stdout:
+            self.assertEqual(0, selectors2._main(['--per-process', self.directory]))
+        lines = ''.join(call[0][0] for call in stdout.write.call_args_list).splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[-1].startswith('total'))
+
+    def test_command_line_rejects_other_files(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'other')
+        with mock.patch('sys.stderr'):
+            self.assertEqual(1, selectors2._main([path]))
+
+
+class TestBufferedWriter(_BaseSelectorTestCase):
+    def make_socketpair(self):
+        rd, wr = super(TestBufferedWriter, self).make_socketpair()
+        wr.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        return rd, wr
+
+    def drain(self, s, writer, rd):
+        received = bytearray()
+        while writer.buffered:
+            for key, events in s.select(timeout=0):
+                if key.fileobj is writer.fileobj and events & selectors2.EVENT_WRITE:
+                    writer.flush()
+            try:
+                received += rd.recv(65536)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        while True:
+            try:
+                data = rd.recv(65536)
+            except socket.error:
+                break
+            received += data
+        return bytes(received)
+
+    def test_write_sends_immediately(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        writer = selectors2.BufferedWriter(s, wr)
+        self.assertEqual(0, writer.write(b'hello'))
+        self.assertEqual(0, len(s.get_map()))
+        self.assertEqual(b'hello', rd.recv(5))
+
+    def test_write_queues_and_registers(self):
+        s = self.make_selector()
+        s.enable_stats()
+        rd, wr = self.make_socketpair()
+        writer = selectors2.BufferedWriter(s, wr, "data")
+        payload = [os.urandom(65536) for _ in range(16)]
+        self.assertGreater(writer.write(payload[0]), 0)
+        key = s.get_key(wr)
+        self.assertEqual(selectors2.EVENT_WRITE, key.events)
+        self.assertEqual("data", key.data)
+
+        for data in payload[1:]:
+            writer.write(bytearray(data))
+        self.assertEqual(b''.join(payload), self.drain(s, writer, rd))
+        self.assertEqual(0, len(s.get_map()))
+        stats = s.stats()
+        self.assertEqual((1, 0, 1), (stats.registers, stats.modifies, stats.unregisters))
+
+    def test_write_keeps_registered_events(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        s.register(wr, selectors2.EVENT_READ, "data")
+        writer = selectors2.BufferedWriter(s, wr)
+        writer.write(b'x' * 1024 * 1024)
+        key = s.get_key(wr)
+        self.assertEqual(selectors2.EVENT_READ | selectors2.EVENT_WRITE, key.events)
+        self.assertEqual("data", key.data)
+
+        self.assertEqual(1024 * 1024, len(self.drain(s, writer, rd)))
+        key = s.get_key(wr)
+        self.assertEqual(selectors2.EVENT_READ, key.events)
+        self.assertEqual("data", key.data)
+
+    def test_flush_without_sendmsg(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        writer = selectors2.BufferedWriter(s, wr)
+        writer._sendmsg = None
+        writer._max_buffers = 1
+        payload = [os.urandom(10000) for _ in range(100)]
+        for data in payload:
+            writer.write(data)
+        self.assertEqual(b''.join(payload), self.drain(s, writer, rd))
+
+    def test_flush_sendmsg_not_implemented(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        sock = mock.Mock(wraps=wr)
+        sock.fileno.return_value = wr.fileno()
+        sock.sendmsg.side_effect = NotImplementedError  # ie: ssl.SSLSocket
+        writer = selectors2.BufferedWriter(s, sock)
+        payload = [os.urandom(10000) for _ in range(100)]
+        for data in payload:
+            writer.write(data)
+        self.assertEqual(b''.join(payload), self.drain(s, writer, rd))
+        self.assertEqual(1, sock.sendmsg.call_count)
+
+    @skipUnless(hasattr(ssl, 'SSLWantWriteError'), "Platform doesn't have ssl.SSLWantWriteError")
+    def test_write_ssl_would_block(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        sock = mock.Mock(wraps=wr)
+        sock.fileno.return_value = wr.fileno()
+        sock.send.side_effect = ssl.SSLWantWriteError()
+        writer = selectors2.BufferedWriter(s, sock)
+        self.assertEqual(5, writer.write(b'hello'))
+        self.assertEqual(selectors2.EVENT_WRITE, s.get_key(sock).events)
+
+        sock.send.side_effect = ssl.SSLWantReadError()
+        self.assertEqual(5, writer.flush())
+
+        sock.send.side_effect = wr.send
+        self.assertEqual(0, writer.flush())
+        self.assertEqual(b'hello', rd.recv(5))
+        self.assertEqual(0, len(s.get_map()))
+
+    def test_flush_empty(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        writer = selectors2.BufferedWriter(s, wr)
+        self.assertEqual(0, writer.flush())
+        self.assertEqual(0, writer.write(b''))
+        self.assertEqual(0, len(s.get_map()))
+
+
+class TestBufferPool(_BaseSelectorTestCase):
+    def test_recv(self):
+        rd, wr = self.make_socketpair()
+        pool = selectors2.BufferPool(buffer_size=1024, buffers=2)
+        wr.send(b'hello')
+        data = pool.recv(rd)
+        self.assertEqual(b'hello', data.tobytes())
+        self.assertIsNone(pool.recv(rd))
+
+        wr.close()
+        self.assertEqual(b'', pool.recv(rd).tobytes())
+
+    @skipUnless(sys.version_info >= (3, 3), "Platform's memoryview doesn't have 'obj'")
+    def test_release_reuses_buffers(self):
+        rd, wr = self.make_socketpair()
+        pool = selectors2.BufferPool(buffer_size=1024, buffers=2)
+        views = []
+        for i in range(4):
+            wr.send(b'x')
+            views.append(pool.recv(rd))
+        self.assertEqual(4, pool.allocated)
+        buffers = set(id(view.obj) for view in views)
+        for view in views:
+            pool.release(view)
+        self.assertEqual(2, len(pool._free))
+        self.assertEqual(2, len(pool._views))
+        self.assertRaises(ValueError, pool.release, views[0])
+
+        for i in range(4):
+            wr.send(b'x')
+            data = pool.recv(rd)
+            self.assertIn(id(data.obj), buffers)
+            pool.release(data)
+        self.assertEqual(4, pool.allocated)
+
+    def test_recv_ready(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        s.register(rd, selectors2.EVENT_READ)
+        s.register(wr, selectors2.EVENT_WRITE)
+        wr.send(b'data')
+        pool = selectors2.BufferPool(buffer_size=1024)
+
+        results = {}
+        for key, events, data in pool.recv_ready(s.select(timeout=SHORT_SELECT)):
+            results[key.fileobj] = (events, data if data is None else data.tobytes())
+            if data is not None:
+                pool.release(data)
+        self.assertEqual({rd: (selectors2.EVENT_READ, b'data'),
+                          wr: (selectors2.EVENT_WRITE, None)}, results)
+
+
+class TestDatagramReader(_BaseSelectorTestCase):
+    def make_udp_pair(self):
+        rd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(rd.close)
+        rd.bind(('127.0.0.1', 0))
+        rd.setblocking(False)
+        wr = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(wr.close)
+        wr.bind(('127.0.0.1', 0))
+        wr.connect(rd.getsockname())
+        return rd, wr
+
+    def test_drain(self):
+        rd, wr = self.make_udp_pair()
+        reader = selectors2.DatagramReader(max_datagrams=4, max_size=8)
+        self.assertEqual([], reader.drain(rd))
+
+        for data in (b'a', b'bb', b'123456789', b'', b'ccc', b'dddd'):
+            wr.send(data)
+        selectors2.wait_for_read(rd, timeout=LONG_SELECT)
+        datagrams = reader.drain(rd)
+        self.assertEqual([b'a', b'bb', b'12345678', b''],
+                         [data.tobytes() for data, _ in datagrams])
+        self.assertEqual([wr.getsockname()] * 4, [address for _, address in datagrams])
+        self.assertEqual([b'ccc', b'dddd'], [data.tobytes() for data, _ in reader.drain(rd)])
+
+    @skipUnless(hasattr(socket, 'MSG_DONTWAIT'), "Platform doesn't have MSG_DONTWAIT")
+    def test_drain_blocking_socket(self):
+        rd, wr = self.make_udp_pair()
+        rd.setblocking(True)
+        reader = selectors2.DatagramReader(max_datagrams=4, max_size=64)
+        wr.send(b'x')
+        selectors2.wait_for_read(rd, timeout=LONG_SELECT)
+        with self.assertTakesTime(upper=SHORT_SELECT):
+            self.assertEqual([b'x'], [data.tobytes() for data, _ in reader.drain(rd)])
+            self.assertEqual([], reader.drain(rd))
+
+    def test_drain_socket_with_timeout(self):
+        rd, wr = self.make_udp_pair()
+        rd.settimeout(LONG_SELECT)
+        reader = selectors2.DatagramReader()
+        self.assertRaises(ValueError, reader.drain, rd)
+
+    def test_drain_raises_errors(self):
+        reader = selectors2.DatagramReader()
+        sock = mock.Mock()
+        sock.gettimeout.return_value = 0.0
+        sock.recvfrom_into.side_effect = socket.error(errno.ECONNREFUSED, "refused")
+        self.assertRaises(socket.error, reader.drain, sock)
+
+        sock.recvfrom_into.side_effect = [(1, "addr"), socket.error(errno.ECONNREFUSED, "")]
+        self.assertEqual(1, len(reader.drain(sock)))
+
+    def test_drain_ready(self):
+        s = self.make_selector()
+        rd, wr = self.make_udp_pair()
+        s.register(rd, selectors2.EVENT_READ)
+        s.register(wr, selectors2.EVENT_WRITE)
+        for _ in range(3):
+            wr.send(b'x')
+        selectors2.wait_for_read(rd, timeout=LONG_SELECT)
+        reader = selectors2.DatagramReader()
+
+        results = {}
+        for key, events, datagrams in reader.drain_ready(s.select(timeout=SHORT_SELECT)):
+            results[key.fileobj] = (events, len(datagrams))
+        self.assertEqual({rd: (selectors2.EVENT_READ, 3), wr: (selectors2.EVENT_WRITE, 0)},
+                         results)
+
+
+class TestRelay(_BaseSelectorTestCase):
+    splice = False
+
+    def make_relay(self):
+        s = self.make_selector()
+        client, relay_a = self.make_socketpair()
+        relay_b, server = self.make_socketpair()
+        closed = []
+        relay = selectors2.Relay(s, relay_a, relay_b, buffer_size=4096,
+                                 on_close=closed.append, splice=self.splice)
+        self.addCleanup(relay.close)
+        return s, relay, client, server, closed
+
+    def pump(self, s, condition):
+        dispatcher = selectors2.Dispatcher(s)
+        for _ in range(1000):
+            if condition():
+                return
+            dispatcher.run_once(timeout=SHORT_SELECT)
+        self.fail("Relay didn't finish")
+
+    def receiver(self, sock, received, size=None):
+        """ Returns a condition for pump() which reads from sock and is
+        True once size bytes or EOF have been received. """
+        def condition():
+            if not selectors2.wait_for_read(sock, timeout=0):
+                return False
+            data = sock.recv(65536)
+            received.append(data)
+            return not data or (size is not None and len(b''.join(received)) >= size)
+        return condition
+
+    def test_relay_both_directions(self):
+        s, relay, client, server, closed = self.make_relay()
+        upload = os.urandom(100000)
+        download = os.urandom(50000)
+        senders = [threading.Thread(target=client.sendall, args=(upload,)),
+                   threading.Thread(target=server.sendall, args=(download,))]
+        client.settimeout(LONG_SELECT)
+        server.settimeout(LONG_SELECT)
+        for thread in senders:
+            thread.start()
+
+        received = []
+        self.pump(s, self.receiver(server, received, len(upload)))
+        for thread in senders:
+            thread.join()
+        self.assertEqual(upload, b''.join(received))
+        client.settimeout(0.0)
+        server.settimeout(0.0)
+
+        client.shutdown(socket.SHUT_WR)
+        received = []
+        self.pump(s, self.receiver(server, received))
+        self.assertEqual(b'', b''.join(received))
+        self.assertEqual([], closed)
+
+        server.shutdown(socket.SHUT_WR)
+        received = []
+        self.pump(s, self.receiver(client, received))
+        self.assertEqual(download, b''.join(received))
+        self.pump(s, lambda: closed)
+        self.assertEqual([relay], closed)
+        self.assertIsNone(relay.error)
+        self.assertEqual(0, len(s.get_map()))
+
+    def test_relay_error(self):
+        s, relay, client, server, closed = self.make_relay()
+        server.close()
+        client.send(b'x' * 1000)
+        self.pump(s, lambda: closed)
+        self.assertEqual(errno.EPIPE, relay.error.errno)
+        self.assertEqual(0, len(s.get_map()))
+
+    def test_relay_closed_during_batch(self):
+        s, relay, client, server, closed = self.make_relay()
+        relay_a, relay_b = relay.sockets
+        server.close()
+        client.send(b'x' * 1000)
+        ready = s.select(timeout=SHORT_SELECT)
+        self.assertEqual(2, len(ready))
+
+        # Handling relay_a fails writing to relay_b and closes the relay
+        # but relay_b's callback is still called for the same batch.
+        ready.sort(key=lambda item: item[0].fileobj is not relay_a)
+        for key, events in ready:
+            key.data(key, events)
+        self.assertEqual([relay], closed)
+        self.assertEqual(errno.EPIPE, relay.error.errno)
+        self.assertEqual(0, len(s.get_map()))
+
+
+@skipUnless(hasattr(os, 'splice'), "Platform doesn't have os.splice()")
+class TestRelaySplice(TestRelay):
+    splice = True
+
+
+@skipUnless(hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg'),
+            "Platform can't pass file descriptors")
+class TestHandoff(_BaseSelectorTestCase):
+    def make_workers(self, count):
+        balancer = selectors2.HandoffBalancer(self.make_selector())
+        workers = []
+        for _ in range(count):
+            balancer_end, worker_end = selectors2.handoff_channel()
+            self.addCleanup(balancer_end.close)
+            self.addCleanup(worker_end.close)
+            balancer.add_worker(balancer_end)
+            received = []
+            worker = selectors2.HandoffWorker(self.make_selector(), worker_end,
+                                              selectors2.EVENT_READ, "data", received.append)
+            workers.append((balancer_end, worker, received))
+        return balancer, workers
+
+    def run_once(self, selector):
+        selectors2.Dispatcher(selector).run_once(timeout=SHORT_SELECT)
+
+    def test_handoff(self):
+        balancer, [(channel, worker, received)] = self.make_workers(1)
+        rd, wr = self.make_socketpair()
+        self.assertIs(channel, balancer.send(rd))
+        self.assertEqual(-1, rd.fileno())
+        self.assertEqual(1, balancer.load(channel))
+
+        self.run_once(worker.selector)
+        self.assertEqual(1, len(received))
+        key = received[0]
+        self.assertEqual((selectors2.EVENT_READ, "data"), (key.events, key.data))
+        self.assertIs(key, worker.selector.get_key(key.fileobj))
+        self.addCleanup(key.fileobj.close)
+
+        wr.send(b'hello')
+        self.assertEqual(b'hello', key.fileobj.recv(5))
+
+        self.run_once(balancer.selector)
+        self.assertEqual([1, 1, 1], balancer._loads[channel])
+        self.assertEqual(1, balancer.load(channel))
+
+    def test_least_loaded(self):
+        balancer, workers = self.make_workers(3)
+        sent = []
+        for _ in range(6):
+            rd, wr = self.make_socketpair()
+            sent.append(balancer.send(rd))
+        channels = [channel for channel, _, _ in workers]
+        self.assertEqual(channels * 2, sent)
+
+        for _, worker, received in workers[:2]:
+            self.run_once(worker.selector)
+            for key in received:
+                self.addCleanup(key.fileobj.close)
+        first = workers[0][2][0]
+        worker = workers[0][1]
+        worker.selector.unregister(first.fileobj)
+        worker.report()
+        self.run_once(balancer.selector)
+        self.assertEqual([1, 2, 2], [balancer.load(channel) for channel in channels])
+
+        rd, wr = self.make_socketpair()
+        self.assertIs(channels[0], balancer.send(rd))
+
+    def test_worker_reports_received_sockets(self):
+        balancer, [(channel, worker, received)] = self.make_workers(1)
+        other, _ = self.make_socketpair()
+        worker.selector.register(other, selectors2.EVENT_READ)
+        for _ in range(2):
+            rd, wr = self.make_socketpair()
+            balancer.send(rd)
+        self.run_once(worker.selector)
+        for key in received:
+            self.addCleanup(key.fileobj.close)
+        self.run_once(balancer.selector)
+        self.assertEqual([2, 2, 2], balancer._loads[channel])
+
+        worker.selector.unregister(received[0].fileobj)
+        worker.report()
+        self.run_once(balancer.selector)
+        self.assertEqual(1, balancer.load(channel))
+
+    def test_worker_exited(self):
+        balancer, workers = self.make_workers(2)
+        workers[0][1].channel.close()
+        rd, wr = self.make_socketpair()
+        self.assertIs(workers[1][0], balancer.send(rd))
+        self.assertEqual([workers[1][0]], balancer.workers)
+
+        balancer.remove_worker(workers[1][0])
+        rd, wr = self.make_socketpair()
+        self.assertRaises(RuntimeError, balancer.send, rd)
+
+    def test_balancer_exited(self):
+        balancer, [(channel, worker, received)] = self.make_workers(1)
+        channel.close()
+        worker.report()
+        worker.report()
+
+
+@skipUnless(hasattr(signal, 'SIGUSR1'), "Platform doesn't have signal.SIGUSR1")
+class TestSignalSource(_BaseSelectorTestCase):
+    signalfd = False
+
+    def make_source(self, signals):
+        source = selectors2.SignalSource(signals, signalfd=self.signalfd)
+        self.addCleanup(source.close)
+        return source
+
+    def test_read_signals(self):
+        s = self.make_selector()
+        source = self.make_source([signal.SIGUSR1, signal.SIGUSR2])
+        key = s.register(source, selectors2.EVENT_READ)
+        self.assertEqual([], s.select(timeout=0))
+        self.assertEqual([], source.read())
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=SHORT_SELECT))
+        self.assertEqual([signal.SIGUSR1, signal.SIGUSR2], source.read())
+        self.assertEqual([], source.read())
+        self.assertEqual([], s.select(timeout=0))
+
+    def test_close_restores_signals(self):
+        handler = signal.getsignal(signal.SIGUSR1)
+        source = self.make_source([signal.SIGUSR1])
+        source.close()
+        source.close()
+        self.assertEqual(-1, source.fileno())
+        self.assertIs(handler, signal.getsignal(signal.SIGUSR1))
+        if hasattr(signal, 'pthread_sigmask'):
+            self.assertNotIn(signal.SIGUSR1, signal.pthread_sigmask(signal.SIG_BLOCK, []))
+        self.assertEqual(-1, signal.set_wakeup_fd(-1))
+
+    @skipUnless(hasattr(signal, 'SIGKILL'), "Platform doesn't have signal.SIGKILL")
+    def test_handler_failure_restores_signals(self):
+        handler = signal.getsignal(signal.SIGUSR1)
+        pairs = []
+
+        def make_socketpair():
+            pairs.append(socketpair())
+            return pairs[-1]
+
+        with mock.patch('selectors2._socketpair', make_socketpair):
+            self.assertRaises((OSError, RuntimeError, ValueError), selectors2.SignalSource,
+                              [signal.SIGUSR1, signal.SIGKILL], signalfd=False)
+        self.assertIs(handler, signal.getsignal(signal.SIGUSR1))
+        self.assertEqual(-1, signal.set_wakeup_fd(-1))
+        self.assertEqual([-1, -1], [sock.fileno() for sock in pairs[0]])
+
+    def test_wakeup_fd_failure_closes_sockets(self):
+        pairs = []
+
+        def make_socketpair():
+            pairs.append(socketpair())
+            return pairs[-1]
+
+        with mock.patch('selectors2._socketpair', make_socketpair):
+            with mock.patch('signal.set_wakeup_fd', side_effect=ValueError):
+                self.assertRaises(ValueError, selectors2.SignalSource, [signal.SIGUSR1],
+                                  signalfd=False)
+        self.assertEqual([-1, -1], [sock.fileno() for sock in pairs[0]])
+
+    def test_signalfd_unavailable(self):
+        with mock.patch('selectors2._load_signalfd', return_value=None):
+            self.assertRaises(RuntimeError, selectors2.SignalSource, [signal.SIGUSR1],
+                              signalfd=True)
+            source = selectors2.SignalSource([signal.SIGUSR1])
+            self.addCleanup(source.close)
+            self.assertIsNot(None, source._wakeup)
+
+
+@skipUnless(selectors2._load_signalfd() is not None, "Platform doesn't have signalfd()")
+class TestSignalSourceSignalfd(TestSignalSource):
+    signalfd = True
+
+    def test_failure_restores_mask(self):
+        def create(signals):
+            raise ValueError("Invalid signal")
+
+        with mock.patch('selectors2._load_signalfd', return_value=create):
+            self.assertRaises(ValueError, selectors2.SignalSource, [signal.SIGUSR1])
+        self.assertNotIn(signal.SIGUSR1, signal.pthread_sigmask(signal.SIG_BLOCK, []))
+
+    def test_signals_are_blocked(self):
+        calls = []
+        previous = signal.signal(signal.SIGUSR1, lambda *args: calls.append(args))
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+        source = self.make_source([signal.SIGUSR1])
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertEqual([signal.SIGUSR1], source.read())
+        self.assertEqual([], calls)
+
+
+@skipUnless(selectors2._load_timerfd() is not None, "Platform doesn't have timerfd")
+class TestTimerSource(_BaseSelectorTestCase):
+    def make_timer(self, delay, interval=0):
+        timer = selectors2.TimerSource(delay, interval)
+        self.addCleanup(timer.close)
+        return timer
+
+    def test_one_shot(self):
+        s = self.make_selector()
+        timer = self.make_timer(SHORT_SELECT)
+        key = s.register(timer, selectors2.EVENT_READ)
+        self.assertEqual([], s.select(timeout=0))
+        self.assertEqual(0, timer.read())
+
+        with self.assertTakesTime(upper=LONG_SELECT):
+            self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=LONG_SELECT))
+        self.assertEqual(1, timer.read())
+        self.assertEqual(0, timer.read())
+        self.assertEqual([], s.select(timeout=SHORT_SELECT))
+
+    def test_periodic_expirations_are_batched(self):
+        timer = self.make_timer(0.001, 0.001)
+        time.sleep(SHORT_SELECT * 2)
+        self.assertGreaterEqual(timer.read(), 10)
+
+    def test_zero_delay(self):
+        s = self.make_selector()
+        timer = self.make_timer(0)
+        key = s.register(timer, selectors2.EVENT_READ)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=SHORT_SELECT))
+        self.assertEqual(1, timer.read())
+
+    def test_cancel_and_set(self):
+        s = self.make_selector()
+        timer = self.make_timer(0.001)
+        key = s.register(timer, selectors2.EVENT_READ)
+        timer.cancel()
+        self.assertEqual([], s.select(timeout=SHORT_SELECT))
+
+        timer.set(0.001)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=LONG_SELECT))
+        self.assertEqual(1, timer.read())
+
+    def test_invalid_delay(self):
+        self.assertRaises(ValueError, selectors2.TimerSource, -1)
+        timer = self.make_timer(LONG_SELECT)
+        self.assertRaises(ValueError, timer.set, 1, -1)
+
+    def test_close(self):
+        timer = self.make_timer(LONG_SELECT)
+        timer.close()
+        timer.close()
+        self.assertEqual(-1, timer.fileno())
+
+    def test_timerfd_unavailable(self):
+        with mock.patch('selectors2._load_timerfd', return_value=None):
+            self.assertRaises(RuntimeError, selectors2.TimerSource, 1)
+
+
+@skipUnless(hasattr(os, 'pidfd_open'), "Platform doesn't have pidfd_open()")
+class TestChildSource(_BaseSelectorTestCase):
+    def make_source(self, process):
+        source = selectors2.ChildSource(process)
+        self.addCleanup(source.close)
+        return source
+
+    def spawn(self, code):
+        process = subprocess.Popen([sys.executable, '-c', code])
+        self.addCleanup(process.wait)
+        return process
+
+    def test_popen_exit(self):
+        s = self.make_selector()
+        process = self.spawn('import sys; sys.exit(3)')
+        source = self.make_source(process)
+        key = s.register(source, selectors2.EVENT_READ)
+
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=LONG_SELECT * 5))
+        self.assertEqual(3, source.read())
+        self.assertEqual(3, process.returncode)
+
+    def test_pid_killed(self):
+        s = self.make_selector()
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(LONG_SELECT * 5)
+            os._exit(0)
+        source = self.make_source(pid)
+        key = s.register(source, selectors2.EVENT_READ)
+        self.assertEqual([], s.select(timeout=0))
+        self.assertEqual(None, source.read())
+
+        os.kill(pid, signal.SIGKILL)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=LONG_SELECT))
+        self.assertEqual(-signal.SIGKILL, source.read())
+        self.assertEqual(-signal.SIGKILL, source.read())
+
+    def test_pidfd_unsupported(self):
+        error = OSError(errno.ENOSYS, "Function not implemented")
+        with mock.patch('os.pidfd_open', side_effect=error):
+            self.assertRaises(RuntimeError, selectors2.ChildSource, os.getpid())
+
+
+class TestReplaySelector(unittest.TestCase):
+    def record(self):
+        selector = selectors2.DefaultSelector()
+        self.addCleanup(selector.close)
+        rd, wr = socketpair()
+        self.addCleanup(rd.close)
+        self.addCleanup(wr.close)
+        self.rd, self.wr = rd.fileno(), wr.fileno()
+
+        trace = io.BytesIO()
+        selector.record_trace(trace)
+        selector.register(rd, selectors2.EVENT_READ)
+        selector.register(wr, selectors2.EVENT_WRITE)
+        selector.select(timeout=0)
+        wr.send(b'x')
+        selector.select(timeout=0)
+        selector.modify(wr, selectors2.EVENT_READ)
+        selector.select(timeout=0)
+        selector.unregister(rd)
+        selector.select(timeout=0)
+        trace.seek(0)
+        return trace
+
+    def test_replay(self):
+        s = selectors2.ReplaySelector(self.record(), data_factory=lambda fd: fd * 2)
+        self.addCleanup(s.close)
+        self.assertEqual([(self.wr, selectors2.EVENT_WRITE, self.wr * 2)],
+                         [(key.fd, events, key.data) for key, events in s.select()])
+        self.assertEqual([(self.rd, selectors2.EVENT_READ), (self.wr, selectors2.EVENT_WRITE)],
+                         sorted((key.fd, events) for key, events in s.select()))
+        self.assertEqual([(self.rd, selectors2.EVENT_READ)],
+                         [(key.fd, events) for key, events in s.select()])
+        self.assertEqual(selectors2.EVENT_READ, s.get_key(self.wr).events)
+        self.assertEqual([], s.select())
+        self.assertEqual([self.wr], list(s.get_map()))
+        self.assertRaises(EOFError, s.select)
+
+    def test_replay_skips_file_descriptors_unregistered_by_caller(self):
+        s = selectors2.ReplaySelector(self.record(), data="data")
+        self.addCleanup(s.close)
+        self.assertEqual("data", s.select()[0][0].data)
+        s.unregister(self.rd)
+        self.assertEqual([self.wr], [key.fd for key, _ in s.select()])
+        self.assertEqual([], s.select())
+        self.assertEqual([], s.select())
+        self.assertRaises(EOFError, s.select)
+
+    def test_replay_through_dispatcher(self):
+        ready = []
+        s = selectors2.ReplaySelector(self.record(),
+                                      data=lambda key, events: ready.append(key.fd))
+        self.addCleanup(s.close)
+        self.assertRaises(EOFError, selectors2.Dispatcher(s).run_forever)
+        self.assertEqual(4, len(ready))
+
+    def test_read_trace_rejects_other_files(self):
+        records = selectors2.read_trace(io.BytesIO(b'not a trace'))
+        self.assertRaises(ValueError, list, records)
+
+    def test_read_trace_rejects_partial_records(self):
+        data = self.record().getvalue()
+        records = selectors2.read_trace(io.BytesIO(data[:-1]))
+        self.assertRaises(ValueError, list, records)
+
+
+class TestSimulatedSelector(unittest.TestCase):
+    def make_selector(self, **kwargs):
+        kwargs.setdefault('seed', 0)
+        kwargs.setdefault('clock', lambda: 0.0)
+        s = selectors2.SimulatedSelector(**kwargs)
+        self.addCleanup(s.close)
+        return s
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, selectors2.SimulatedSelector, rate=0)
+        self.assertRaises(ValueError, selectors2.SimulatedSelector, burst_size=0.5)
+        self.assertRaises(ValueError, selectors2.SimulatedSelector, hot_fraction=2)
+        self.assertRaises(ValueError, selectors2.SimulatedSelector, hot_share=-1)
+
+    def test_many_virtual_file_descriptors(self):
+        s = self.make_selector(rate=1000.0, burst_size=8)
+        for fd in range(20000):
+            s.register(fd, selectors2.EVENT_READ, fd * 2)
+        ready = []
+        while len(ready) < 1000:
+            ready.extend(s.select())
+        for key, events in ready:
+            self.assertEqual(selectors2.EVENT_READ, events)
+            self.assertEqual(key.fd * 2, key.data)
+        self.assertTrue(any(key.fd >= 1024 for key, _ in ready))
+
+    def test_select_skips_time_instead_of_sleeping(self):
+        s = self.make_selector(rate=1.0)
+        s.register(1, selectors2.EVENT_READ)
+        self.assertEqual([], s.select(timeout=0))
+        self.assertEqual([], s.select(timeout=0.000001))
+        self.assertAlmostEqual(0.000001, s._skipped)
+
+        start = get_time()
+        self.assertEqual([1], [key.fd for key, _ in s.select()])
+        self.assertLess(get_time() - start, 0.5)
+        self.assertGreater(s._skipped, 0.000001)
+
+    def test_writers_are_always_writable(self):
+        s = self.make_selector()
+        s.register(1, selectors2.EVENT_WRITE)
+        s.register(2, selectors2.EVENT_READ)
+        for _ in range(3):
+            self.assertEqual([(1, selectors2.EVENT_WRITE)],
+                             [(key.fd, events) for key, events in s.select(timeout=0)])
+
+    def test_unregistered_file_descriptors_are_not_ready(self):
+        s = self.make_selector(rate=1000.0, burst_size=4)
+        for fd in range(10):
+            s.register(fd, selectors2.EVENT_READ)
+        for fd in range(0, 10, 2):
+            s.unregister(fd)
+        self.assertEqual([1, 3, 5, 7, 9], sorted(s._readers))
+        for _ in range(100):
+            for key, _ in s.select():
+                self.assertEqual(1, key.fd % 2)
+
+    def test_same_seed_is_repeatable(self):
+        results = []
+        for _ in range(2):
+            s = self.make_selector(rate=100.0, burst_size=3, hot_fraction=0.1, hot_share=0.5)
+            for fd in range(100):
+                s.register(fd, selectors2.EVENT_READ)
+            results.append([sorted(key.fd for key, _ in s.select()) for _ in range(50)])
+        self.assertEqual(results[0], results[1])
+
+    def test_hot_set_and_burst_size(self):
+        s = self.make_selector(burst_size=4, hot_fraction=0.01, hot_share=0.9)
+        for fd in range(10000):
+            s.register(fd, selectors2.EVENT_READ)
+        fds = []
+        for _ in range(5000):
+            fds.extend(s._burst())
+        self.assertAlmostEqual(4.0, len(fds) / 5000.0, delta=0.3)
+        hot = sum(1 for fd in fds if fd < 100)
+        self.assertAlmostEqual(0.9, hot / float(len(fds)), delta=0.03)
+
+    def test_suspended_file_descriptors_are_ready_when_rearmed(self):
+        s = self.make_selector()
+        key = s.register(1, selectors2.EVENT_READ)
+        s._suspend(key)
+        for _ in range(5):
+            self.assertEqual([], s.select(timeout=1.0))
+        self.assertEqual(set([1]), s._deferred)
+        s.modify(1, selectors2.EVENT_READ)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(timeout=0))
+
+    def test_dispatcher(self):
+        s = self.make_selector(rate=1000.0)
+        calls = []
+        for fd in range(100):
+            s.register(fd, selectors2.EVENT_READ, lambda key, events: calls.append(key.fd))
+        dispatcher = selectors2.Dispatcher(s)
+        while len(calls) < 100:
+            dispatcher.run_once()
+        self.assertTrue(set(calls) <= set(range(100)))
+
 
 class TestSelectors2Module(unittest.TestCase):
     def test__all__has_correct_contents(self):
@@ -695,6 +2279,100 @@ class EpollSelectorTestCase(_AllSelectorsTestCase, ScalableSelectorMixin):
     def setUp(self):
         patch_select_module(self, 'epoll')
 
+    @skipIfRetriesInterrupts
+    def test_stats_count_interrupts(self):
+        s = self.make_selector()
+        s.enable_stats()
+        calls = []
+
+        def interrupting_poll(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise IOError(errno.EINTR, 'Interrupted system call')
+            return []
+
+        s._poll_func = interrupting_poll
+        self.assertEqual([], s.select(timeout=SHORT_SELECT))
+        self.assertEqual(1, s.stats().eintr_retries)
+
+    def make_listener(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        listener.setblocking(False)
+        return listener
+
+    @skipUnless(selectors2._epoll_exclusive_supported(), "Kernel doesn't support EPOLLEXCLUSIVE")
+    def test_register_exclusive(self):
+        s = self.make_selector()
+        listener = self.make_listener()
+        s.register(listener, selectors2.EVENT_READ, exclusive=True)
+        self.assertEqual([], s.select(0))
+
+        client = socket.create_connection(listener.getsockname())
+        self.addCleanup(client.close)
+        self.assertEqual([(s.get_key(listener), selectors2.EVENT_READ)], s.select(1))
+
+    @skipUnless(selectors2._epoll_exclusive_supported(), "Kernel doesn't support EPOLLEXCLUSIVE")
+    def test_modify_keeps_exclusive(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ, exclusive=True)
+        s.modify(rd, selectors2.EVENT_READ | selectors2.EVENT_WRITE, "data")
+        self.assertIn(key.fd, s._exclusive)
+        self.assertEqual("data", s.get_key(rd).data)
+        self.assertEqual([(s.get_key(rd), selectors2.EVENT_WRITE)], s.select(0))
+
+        s.unregister(rd)
+        self.assertNotIn(key.fd, s._exclusive)
+
+    @skipUnless(selectors2._epoll_exclusive_supported(), "Kernel doesn't support EPOLLEXCLUSIVE")
+    def test_rearm_keeps_exclusive(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ, exclusive=True)
+        wr.send(b'x')
+        s._suspend(key)
+        self.assertEqual([], s.select(0))
+
+        s.modify(rd, selectors2.EVENT_READ)
+        self.assertIn(key.fd, s._exclusive)
+        self.assertEqual([(s.get_key(rd), selectors2.EVENT_READ)], s.select(0))
+
+    @skipUnless(selectors2._epoll_exclusive_supported(), "Kernel doesn't support EPOLLEXCLUSIVE")
+    def test_modify_exclusive_failure_keeps_registration(self):
+        s = self.make_selector()
+        listener = self.make_listener()
+        key = s.register(listener, selectors2.EVENT_READ, "data", exclusive=True)
+        self.assertRaises(ValueError, s.modify, listener,
+                          selectors2.EVENT_READ | selectors2.EVENT_RDHUP)
+        self.assertRaises(ValueError, s.modify, listener, 0)
+        with mock.patch.object(selectors2, '_EPOLLEXCLUSIVE_SUPPORTED', False):
+            self.assertRaises(RuntimeError, s.modify, listener, selectors2.EVENT_WRITE)
+        self.assertEqual(key, s.get_key(listener))
+        self.assertEqual(set([key.fd]), s._exclusive)
+
+        client = socket.create_connection(listener.getsockname())
+        self.addCleanup(client.close)
+        self.assertEqual([(key, selectors2.EVENT_READ)], s.select(1))
+
+    def test_register_exclusive_rdhup(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        self.assertRaises(ValueError, s.register, rd,
+                          selectors2.EVENT_READ | selectors2.EVENT_RDHUP, exclusive=True)
+        self.assertRaises(KeyError, s.get_key, rd)
+
+    def test_register_exclusive_unsupported_kernel(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        with mock.patch.object(selectors2, '_EPOLLEXCLUSIVE_SUPPORTED', False):
+            self.assertRaises(RuntimeError, s.register, rd, selectors2.EVENT_READ,
+                              exclusive=True)
+        self.assertRaises(KeyError, s.get_key, rd)
+        s.register(rd, selectors2.EVENT_READ)
+
 
 @skipUnless(hasattr(selectors2, "DevpollSelector"), "Platform doesn't have an DevpollSelector")
 class DevpollSelectorTestCase(_AllSelectorsTestCase, ScalableSelectorMixin):
@@ -707,6 +2385,23 @@ class KqueueSelectorTestCase(_AllSelectorsTestCase, ScalableSelectorMixin):
     def setUp(self):
         patch_select_module(self, 'kqueue')
 
+    def test_hup_reported_by_read_filter(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        key = s.register(rd, selectors2.EVENT_READ | selectors2.EVENT_HUP)
+        wr.close()
+        self.assertEqual([(key, selectors2.EVENT_READ | selectors2.EVENT_HUP)],
+                         s.select(timeout=SHORT_SELECT))
+
+    def test_hup_reported_by_write_filter(self):
+        s = self.make_selector()
+        rd, wr = self.make_socketpair()
+        events = selectors2.EVENT_READ | selectors2.EVENT_WRITE | selectors2.EVENT_HUP
+        key = s.register(rd, events)
+        wr.shutdown(socket.SHUT_WR)
+        ready = s.select(timeout=SHORT_SELECT)
+        self.assertEqual([(key, selectors2.EVENT_READ | selectors2.EVENT_WRITE)], ready)
+
 
 @skipUnlessJython
 @skipUnless(hasattr(selectors2, "JythonSelectSelector"), "Platform doesn't have a SelectSelector")